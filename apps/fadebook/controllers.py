@@ -1,7 +1,10 @@
 from py4web import action, redirect, URL, Field, HTTP
 from py4web.utils.form import Form
-from .common import flash, session, db, auth
+from .common import flash, session, db, auth, profiler, metrics, assets, templates
+from .common import write_limit, hot_post_limit
+from ..shared.export import export
 from .make_up_data import make
+from .models import likes
 
 #
 # Convenience functions
@@ -13,10 +16,35 @@ def check_liked(items):
     query = db.item_like.created_by == auth.user_id
     query &= db.item_like.item_id.belongs([item.id for item in items])
     liked_ids = set(row.item_id for row in db(query).select(db.item_like.item_id))
+    # include the toggles still in the write-behind buffer
+    for item_id, liked in likes.pending_likes(auth.user_id).items():
+        if liked:
+            liked_ids.add(item_id)
+        else:
+            liked_ids.discard(item_id)
     for item in items:
         item["liked"] = "true" if item.id in liked_ids else "false"
 
 
+def add_authors(items):
+    """add the author names to the items without denormalized ones, with one query"""
+    names = ("author_first_name", "author_last_name")
+    missing = set(
+        item.created_by for item in items if item.get("author_first_name") is None
+    )
+    users = {}
+    if missing:
+        rows = db(db.auth_user.id.belongs(missing)).select(
+            db.auth_user.id, db.auth_user.first_name, db.auth_user.last_name
+        )
+        users = {row.id: (row.first_name, row.last_name) for row in rows}
+    for item in items:
+        if item.get("author_first_name") is None:
+            # a deleted user has no name
+            for name, value in zip(names, users.get(item.created_by, ("", ""))):
+                item[name] = value
+
+
 def friend_ids(user_id):
     """return a list of ids of friends (included user_id self)"""
     query = db.friend_request.status == "accepted"
@@ -37,7 +65,7 @@ def friend_ids(user_id):
 
 
 @action("index")
-@action.uses("index.html", auth)
+@action.uses(metrics, assets, templates("index.html"), auth)
 def index():
     if auth.user_id:
         redirect(URL("feed"))
@@ -45,7 +73,7 @@ def index():
 
 
 @action("feed", method=["GET", "POST"])
-@action.uses("feed.html", auth.user)
+@action.uses(metrics, assets, profiler, templates("feed.html"), auth.user)
 def feed():
     # make up some random data if only one user
     make()
@@ -57,11 +85,12 @@ def feed():
     )
     # determine if they were liked or not
     check_liked(items)
+    add_authors(items)
     return locals()
 
 
 @action("home/<user_id:int>", method=["GET", "POST"])
-@action.uses("home.html", auth.user)
+@action.uses(metrics, assets, profiler, templates("home.html"), auth.user)
 def home(user_id):
     if user_id not in friend_ids(auth.user_id):
         raise HTTP(400)
@@ -72,11 +101,12 @@ def home(user_id):
     )
     # determine if they were liked or not
     check_liked(items)
+    add_authors(items)
     return locals()
 
 
 @action("friends", method=["GET", "POST"])
-@action.uses("friends.html", auth.user)
+@action.uses(metrics, assets, profiler, templates("friends.html"), auth.user)
 def friends():
     # a search form (simply by first name)
     form = Form([Field("name", required=True)])
@@ -114,18 +144,64 @@ def friends():
 
 
 @action("like/<item_id:int>", method=["POST"])
-@action.uses(auth.user)
+@action.uses(metrics, hot_post_limit, write_limit, auth.user)
 def like(item_id):
-    # try unlike
-    if db(db.item_like.item_id == item_id).delete():
-        return dict(liked=False)
-    # else like
-    db.item_like.insert(item_id=item_id)
-    return dict(liked=True)
+    # unlike if liked, else like
+    return dict(liked=likes.toggle(auth.user_id, item_id))
+
+
+#
+# Exports (streamed, ?format=ndjson|csv, resume with ?after=<last id>)
+#
+
+
+@action("export/feed", method=["GET"])
+@action.uses(metrics, auth.user)
+def export_feed():
+    """all the items posted by the user or friends, with their likes"""
+    user_id = auth.user_id
+
+    def expand(db, items):
+        ids = [item["id"] for item in items]
+        count = db.item_like.id.count()
+        rows = db(db.item_like.item_id.belongs(ids)).select(
+            db.item_like.item_id, count, groupby=db.item_like.item_id
+        )
+        likes = {row.item_like.item_id: row[count] for row in rows}
+        query = db.item_like.item_id.belongs(ids) & (db.item_like.created_by == user_id)
+        liked = set(row.item_id for row in db(query).select(db.item_like.item_id))
+        for item in items:
+            item["likes"] = likes.get(item["id"], 0)
+            item["liked"] = item["id"] in liked
+
+    export(
+        db,
+        db.feed_item.created_by.belongs(friend_ids(user_id)),
+        [
+            db.feed_item.id,
+            db.feed_item.body,
+            db.feed_item.created_on,
+            db.feed_item.created_by,
+        ],
+        expand=expand,
+        filename="feed",
+    )
+
+
+@action("export/likes", method=["GET"])
+@action.uses(metrics, auth.user)
+def export_likes():
+    """all the likes of the user"""
+    export(
+        db,
+        db.item_like.created_by == auth.user_id,
+        [db.item_like.id, db.item_like.item_id, db.item_like.created_on],
+        filename="likes",
+    )
 
 
 @action("friendship/request/<user_id:int>", method=["POST"])
-@action.uses(auth.user)
+@action.uses(metrics, write_limit, auth.user)
 def friendship_request(user_id):
     # if request does not exist already, create it
     query = (db.friend_request.to_user == user_id) & (
@@ -141,7 +217,7 @@ def friendship_request(user_id):
 
 
 @action("friendship/<id:int>/accept", method=["POST"])
-@action.uses(auth.user)
+@action.uses(metrics, write_limit, auth.user)
 def friendship_accept(id):
     # the target user can accept the request
     db(
@@ -151,7 +227,7 @@ def friendship_accept(id):
 
 # make a button factory to reject frindship
 @action("friendship/<id:int>/reject", method=["POST"])
-@action.uses(auth.user)
+@action.uses(metrics, write_limit, auth.user)
 def friendship_reject(id):
     # both origin and target users can delete a request
     db(db.friend_request.id == id).delete()
@@ -0,0 +1,168 @@
+"""
+Write-behind buffer for the like toggles (settings.LIKE_BUFFER_SECONDS)
+
+    liked = likes.toggle(auth.user_id, item_id)
+
+With a window of 0 (the synchronous mode) the toggle is written in the
+transaction of the request, as usual. Otherwise it only changes the state
+kept in memory for (user, item) and returns it, so a double click costs
+no write at all, and a background thread writes the net changes of the
+last window seconds in a single transaction. check_liked() shows the
+pending toggles before they are written.
+
+They are written when the process exits normally (atexit) and on SIGTERM,
+which skips atexit by default: a handler writes them, then chains to the
+handler installed before it (by default the signal then terminates the
+process, as without it). It is installed when the app is loaded in the
+main thread. A server that installs its own handler later (Rocket,
+tools/prefork.py) stops gracefully on SIGTERM and atexit writes them. A
+SIGKILL loses the toggles of the last window seconds.
+
+The buffer belongs to the process: with several workers the toggles of a
+user are buffered by whichever worker serves them, in any case the last
+one written wins.
+"""
+import atexit
+import logging
+import os
+import signal
+import threading
+import time
+
+
+class LikeBuffer:
+    def __init__(self, db, window=1.0, logger=None):
+        self.db = db
+        self.window = window
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        # (user_id, item_id) -> (liked in the db, liked now)
+        self.pending = {}
+        # (user_id, item_id) -> liked, being written by flush()
+        self.flushing = {}
+        self.thread = None
+        if window:
+            atexit.register(self.flush)
+            os.register_at_fork(after_in_child=self._after_fork)
+            self._handle_sigterm()
+
+    def toggle(self, user_id, item_id):
+        """Likes or unlikes item_id for user_id, returns whether it is liked"""
+        if not self.window:
+            liked = not self.is_liked(self.db, user_id, item_id)
+            self.write(self.db, [(user_id, item_id, liked)])
+            return liked
+        key = (user_id, item_id)
+        with self.lock:
+            known = key in self.pending or key in self.flushing
+        # the query runs outside the lock, a concurrent toggle of the same
+        # key wins and this one applies on top of it
+        stored = None if known else self.is_liked(self.db, user_id, item_id)
+        with self.lock:
+            if key in self.pending:
+                stored, liked = self.pending[key]
+            elif key in self.flushing:
+                stored = liked = self.flushing[key]
+            else:
+                liked = stored
+            self.pending[key] = (stored, not liked)
+            self.start()
+        return not liked
+
+    def pending_likes(self, user_id):
+        """{item_id: liked} for the toggles of user_id not yet written"""
+        with self.lock:
+            return {
+                item_id: liked
+                for (uid, item_id), (stored, liked) in self.pending.items()
+                if uid == user_id
+            }
+
+    def is_liked(self, db, user_id, item_id):
+        query = (db.item_like.item_id == item_id) & (db.item_like.created_by == user_id)
+        return not db(query).isempty()
+
+    def write(self, db, changes):
+        """Applies a list of (user_id, item_id, liked)"""
+        for user_id, item_id, liked in changes:
+            query = db.item_like.item_id == item_id
+            query &= db.item_like.created_by == user_id
+            if not liked:
+                db(query).delete()
+            elif db(query).isempty():
+                # outside of requests there is no auth.user_id to default to
+                db.item_like.insert(item_id=item_id, created_by=user_id, modified_by=user_id)
+
+    def flush(self):
+        """Writes the net changes buffered so far, returns their number"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushing = {key: liked for key, (stored, liked) in pending.items()}
+        changes = [
+            (user_id, item_id, liked)
+            for (user_id, item_id), (stored, liked) in pending.items()
+            if liked != stored
+        ]
+        db = getattr(self.db, "primary", self.db)
+        try:
+            if changes:
+                db.get_connection_from_pool_or_new()
+                try:
+                    self.write(db, changes)
+                except Exception:
+                    db.recycle_connection_in_pool_or_close("rollback")
+                    raise
+                db.recycle_connection_in_pool_or_close("commit")
+        except Exception:
+            self.logger.exception("unable to write %i like toggles", len(changes))
+            with self.lock:
+                # keep the newer toggles, retry the others with the next flush
+                for key, (stored, liked) in pending.items():
+                    if key in self.pending:
+                        self.pending[key] = (stored, self.pending[key][1])
+                    else:
+                        self.pending[key] = (stored, liked)
+            return 0
+        finally:
+            with self.lock:
+                self.flushing = {}
+        return len(changes)
+
+    def start(self):
+        """Starts the thread that flushes every window seconds (call with the lock)"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def _handle_sigterm(self):
+        if threading.current_thread() is not threading.main_thread():
+            # signal() only works in the main thread, e.g. not on a reload
+            return
+        previous = signal.getsignal(signal.SIGTERM)
+        # the buffer of a previous load of the app takes no more toggles
+        if getattr(previous, "__name__", None) == "_on_sigterm":
+            previous = previous.__self__.previous_sigterm
+        self.previous_sigterm = previous
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def _on_sigterm(self, signum, frame):
+        self.flush()
+        previous = self.previous_sigterm
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            # terminated by the signal, as without this handler
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def _after_fork(self):
+        """A forked worker starts empty, the parent writes what it buffered"""
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushing = {}
+        self.thread = None
+
+    def loop(self):
+        while True:
+            time.sleep(self.window)
+            self.flush()
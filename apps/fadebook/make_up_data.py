@@ -6,6 +6,8 @@ def make():
     from .common import db, action
     from py4web.utils.populate import populate
 
+    # writes must go to the primary when read replicas are configured
+    db = getattr(db, "primary", db)
     if db(db.auth_user).count() == 1:
         populate(db.auth_user, 10, contents={"is_active": True})
         populate(db.feed_item, 100, contents={"is_active": True})
@@ -1,12 +1,28 @@
 from .common import *
+from ..shared.authors import Authors
+from .likes import LikeBuffer
+from ..shared.schema import migrate_on_change
 from pydal.validators import IS_NOT_EMPTY
 
+# optional copies of the author names in the feed items (see authors.py)
+authors = Authors(db, logger=logger) if settings.DENORMALIZE_AUTHORS else None
+
 db.define_table(
-    "feed_item", Field("body", "text", requires=IS_NOT_EMPTY()), auth.signature
+    "feed_item",
+    Field("body", "text", requires=IS_NOT_EMPTY()),
+    auth.signature,
+    *(authors.fields() if authors else [])
 )
 
+if authors:
+    authors.track(db.feed_item)
+    authors.start(settings.AUTHORS_FIXUP_SECONDS)
+
 db.define_table("item_like", Field("item_id", "reference feed_item"), auth.signature)
 
+# the like toggles, optionally buffered and written in batches (see likes.py)
+likes = LikeBuffer(db, settings.LIKE_BUFFER_SECONDS, logger=logger)
+
 db.define_table(
     "friend_request",
     Field("from_user", "reference auth_user"),
@@ -14,4 +30,13 @@ db.define_table(
     Field("status", options=("accepted", "pending", "rejected")),
 )
 
+# all the tables are defined, migrate them if they changed
+if settings.DB_MIGRATE and settings.DB_SCHEMA_FINGERPRINT:
+    migrate_on_change(
+        getattr(db, "primary", db),
+        settings.DB_FOLDER,
+        fake_migrate=settings.DB_FAKE_MIGRATE,
+        logger=logger,
+    )
+
 db.commit()
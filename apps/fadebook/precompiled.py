@@ -0,0 +1,162 @@
+"""
+Precompiled templates and cached fragments
+
+    @action.uses(metrics, assets, profiler, templates("feed.html"), auth.user)
+
+renders like the py4web Template fixture, but the Python code compiled from
+every template is also kept on disk (in settings.TEMPLATE_CACHE_FOLDER) and
+reused across restarts as long as the template and everything it extends or
+includes are unchanged. Templates.precompile() compiles all the templates at
+startup (or ahead of time: python apps/fadebook/precompiled.py), so the
+first requests after a deploy do not parse anything.
+
+The templates rendered this way can also use fragment(), which caches a
+rendered piece of the page by key, for example a post card:
+
+    [[=fragment(("post", item.id, item.modified_on, item.liked), "post.html", item=item)]]
+
+The key must include everything the fragment shows that can change (the
+post card also shows the names of its author). The fragments have a cache
+of their own, sized by settings.FRAGMENT_CACHE_SIZE.
+"""
+import glob
+import hashlib
+import marshal
+import os
+import sys
+
+from py4web import URL, request
+from py4web.core import HELPERS, Renoir, Template
+from renoir.__version__ import __version__ as renoir_version
+from yatl.helpers import XML
+
+VERSION = "%s-%s" % (sys.implementation.cache_tag, renoir_version)
+
+
+class PrecompiledRenoir(Renoir):
+    """A Renoir engine that stores the compiled templates in cache_folder"""
+
+    def __init__(self, path, cache_folder, delimiters="[[ ]]"):
+        super().__init__(path=path, delimiters=delimiters.split(" "), reload=True)
+        self.cache_folder = cache_folder
+
+    def parse(self, file_path, source, context):
+        code, content = self.cache.parse.get(file_path, source)
+        if code:
+            return code, content
+        filename = self._cache_filename(file_path, source)
+        loaded = self._load_compiled(filename)
+        if loaded:
+            code, dependencies = loaded
+            self.cache.parse.set(file_path, source, code, None, dependencies)
+            return code, None
+        code, content = super().parse(file_path, source, context)
+        self._store_compiled(filename, code, self.cache.parse.dependencies[file_path])
+        return code, content
+
+    def _cache_filename(self, file_path, source):
+        name = os.path.relpath(file_path, self.path)
+        key = "%s:%s:%s" % (VERSION, name, source)
+        digest = hashlib.sha1(key.encode("utf8")).hexdigest()
+        return os.path.join(
+            self.cache_folder, "%s.%s.marshal" % (name.replace(os.sep, "."), digest[:16])
+        )
+
+    def _dependency_hashes(self, dependencies):
+        hashes = {}
+        for name, preload_params in dependencies.values():
+            file_path = os.path.join(*self.preload(name, **preload_params))
+            source = self.load(file_path)
+            hashes[name] = hashlib.sha1(source.encode("utf8")).hexdigest()
+        return hashes
+
+    def _load_compiled(self, filename):
+        """Returns (code, dependencies) if filename is still valid, else None"""
+        try:
+            with open(filename, "rb") as stream:
+                code, dependencies, hashes = marshal.load(stream)
+            if self._dependency_hashes(dependencies) != hashes:
+                return None
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return code, dependencies
+
+    def _store_compiled(self, filename, code, dependencies):
+        hashes = self._dependency_hashes(dependencies)
+        os.makedirs(self.cache_folder, exist_ok=True)
+        tmp = "%s.%i.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as stream:
+            marshal.dump((code, dependencies, hashes), stream)
+        os.replace(tmp, filename)
+
+    def compile(self, filename):
+        file_path = os.path.join(*self.preload(filename))
+        source = self.prerender(self.load(file_path), file_path)
+        self.parse(file_path, source, {})
+
+
+class Templates:
+    """Makes the template fixtures of the app and owns their engine and caches"""
+
+    def __init__(self, path, cache_folder, cache, expiration=3600):
+        self.engine = PrecompiledRenoir(path, cache_folder)
+        self.cache = cache
+        self.expiration = expiration
+
+    def __call__(self, filename):
+        return CompiledTemplate(filename, self)
+
+    def precompile(self):
+        """Compiles (or loads from the disk cache) all the templates"""
+        for file_path in sorted(glob.glob(os.path.join(self.engine.path, "*.html"))):
+            try:
+                self.engine.compile(os.path.basename(file_path))
+            except Exception:
+                # layouts cannot be compiled alone, they are compiled as part
+                # of the pages extending them (errors also surface there)
+                pass
+
+    def context(self, variables):
+        ctx = dict(request=request)
+        ctx.update(HELPERS)
+        ctx.update(URL=URL, fragment=self.fragment)
+        ctx.update(variables)
+        return ctx
+
+    def render(self, filename, ctx):
+        return self.engine.render(filename, context=ctx)
+
+    def fragment(self, key, filename, **variables):
+        """Renders filename with variables once per key (until it expires)"""
+        return self.cache.get(
+            (filename, key),
+            lambda: XML(self.render(filename, self.context(variables))),
+            self.expiration,
+        )
+
+
+class CompiledTemplate(Template):
+    """The Template fixture, rendered by the precompiling engine of templates"""
+
+    def __init__(self, filename, templates):
+        super().__init__(filename, path=templates.engine.path)
+        self.templates = templates
+
+    def on_success(self, context):
+        output = context["output"]
+        if not isinstance(output, dict):
+            return
+        ctx = self.templates.context(context["template_inject"])
+        ctx.update(output)
+        ctx["__vars__"] = output
+        context["output"] = self.templates.render(self.filename, ctx)
+
+
+if __name__ == "__main__":
+    app_folder = os.path.dirname(os.path.abspath(__file__))
+    templates = Templates(
+        os.path.join(app_folder, "templates"),
+        os.path.join(app_folder, "cache", "templates"),
+        cache=None,
+    )
+    templates.precompile()
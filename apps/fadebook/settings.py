@@ -18,10 +18,47 @@ DB_URI = "sqlite://storage.db"
 DB_POOL_SIZE = 1
 DB_MIGRATE = True
 DB_FAKE_MIGRATE = False  # maybe?
+# DB_SCHEMA_FINGERPRINT: Skip the migration checks on boot unless the schema
+#                        changed since the last migration, which runs under a
+#                        file lock so workers booting together do not race
+#                        (see schema.py)
+DB_SCHEMA_FINGERPRINT = False
+# DB_READ_URIS: Optional read replicas, GET requests are served by them
+#               e.g. ["sqlite://replica1.db", "sqlite://replica2.db"]
+#               (SQLite replicas are full copies of storage.db made by
+#               db.sync_sqlite_replicas(), for tests only, see replicas.py)
+DB_READ_URIS = []
+# DB_STICKY_SECONDS: After a write a client reads from the primary for this long
+DB_STICKY_SECONDS = 5
+# QUERY_SLOW_MS: The profiler fixture logs slower queries with their query plan
+QUERY_SLOW_MS = 50
+# QUERY_REPEATS: The profiler fixture logs a possible N+1 when a request runs
+#                the same query (up to its literals) this many times or more
+QUERY_REPEATS = 5
 
 # location where static files are stored:
 STATIC_FOLDER = required_folder(APP_FOLDER, "static")
 
+# location where the build step of assets.py writes the hashed static files:
+ASSETS_FOLDER = os.path.join(APP_FOLDER, "assets")
+
+# location where the compiled templates are cached between restarts:
+TEMPLATE_CACHE_FOLDER = os.path.join(APP_FOLDER, "cache", "templates")
+# TEMPLATE_PRECOMPILE: compile all the templates when the app is loaded
+TEMPLATE_PRECOMPILE = True
+# FRAGMENT_CACHE_SIZE: rendered fragments (the post cards) kept in memory, in
+#                      a cache of their own so they do not evict the pages
+FRAGMENT_CACHE_SIZE = 5000
+# DENORMALIZE_AUTHORS: copy the author names into the feed items (see
+#                      authors.py), a background thread keeps them in sync
+#                      with profiles every AUTHORS_FIXUP_SECONDS
+DENORMALIZE_AUTHORS = False
+AUTHORS_FIXUP_SECONDS = 5.0
+# LIKE_BUFFER_SECONDS: 0 writes every like toggle in its request, else the
+#                      toggles are kept in memory and their net changes
+#                      written every LIKE_BUFFER_SECONDS (see likes.py)
+LIKE_BUFFER_SECONDS = 0
+
 # location where to store uploaded files:
 UPLOAD_FOLDER = required_folder(APP_FOLDER, "uploads")
 
@@ -60,6 +97,14 @@ REDIS_SERVER = "localhost:6379"
 LOGGERS = [
     "warning:stdout"
 ]  # syntax "severity:filename" filename can be stderr or stdout
+# files ending in .jsonl are written as JSON lines, e.g. "info:logs/app.jsonl"
+# records go through a queue written by a background thread, 0 to log
+# synchronously, when the queue is full records are dropped and counted
+LOG_QUEUE_SIZE = 10000
+# rotate log files by size and/or age (0 disables), keep LOG_BACKUP_COUNT old files
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_MAX_SECONDS = 24 * 3600
+LOG_BACKUP_COUNT = 5
 
 # Disable default login when using OAuth
 DEFAULT_LOGIN_ENABLED = True
@@ -89,13 +134,37 @@ LDAP_SETTINGS = {
     "base_dn": "cn=Users,dc=domain,dc=com", # base dn, i.e. where the users are located
 }
 
+# metrics settings, set to a folder (e.g. os.path.join(APP_FOLDER, "metrics"))
+# when running several worker processes, or celery, so the metrics page
+# shows the totals of all of them
+METRICS_MULTIPROCESS_DIR = None
+# METRICS_TOKEN: the metrics page requires "Authorization: Bearer <token>",
+#                None serves it only to the requests from this host
+METRICS_TOKEN = None
+
+# rate limits of the write actions (see ratelimit.py), in requests per second
+# and burst, per user and route. RATE_LIMIT_STORE None keeps the buckets in
+# the memory of each process, a file name (in DB_FOLDER) shares them across
+# the worker processes of the host
+RATE_LIMIT_WRITES = (2, 20)
+# likes of a single post, from all the users together
+RATE_LIMIT_HOT_POST = (20, 100)
+RATE_LIMIT_STORE = None
+
 # i18n settings
 T_FOLDER = required_folder(APP_FOLDER, "translations")
+# location where the compiled catalogs of T_FOLDER are cached (see catalogs.py):
+T_CACHE_FOLDER = os.path.join(APP_FOLDER, "cache", "translations")
 
 # Celery settings
 USE_CELERY = False
 CELERY_BROKER = "redis://localhost:6379/0"
 
+# STARTUP_PROFILE: log the time taken by the steps and the imports of
+#                  loading the app (see startup.py), at INFO: add an
+#                  "info:..." entry to LOGGERS to see it
+STARTUP_PROFILE = False
+
 # try import private settings
 try:
     from .settings_private import *
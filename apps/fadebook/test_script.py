@@ -0,0 +1,97 @@
+import json
+import os
+import re
+import sys
+
+THIS_FOLDER = os.path.dirname(__file__)
+sys.path.append(os.path.join(THIS_FOLDER, "../../tools/"))
+from tester import Tester, needs_browser
+
+
+class TestFadebook:
+    def __init__(self, browser=True):
+        self.tester = Tester(headless=True, browser=browser)
+        self.url = self.tester.start_py4web(THIS_FOLDER)
+        self.cookies = None
+
+    def run(self):
+        self.tester.run_steps(self)
+
+    @needs_browser
+    def step_01(self):
+        "check we can open the page"
+        self.tester.open(self.url)
+        self.tester.notify("Success in opening page")
+
+    def step_02(self):
+        "check login"
+        db = self.tester.app_as_module.db
+        for table in ("feed_item", "item_like", "friend_request"):
+            assert table in db.tables, f"table {table} not found in models.py"
+        self.tester.notify("Tables defined correctly", score=1.0)
+
+        user = dict(
+            username="tester",
+            email="tester@example.com",
+            password="1234qwerQWER!@#$",
+            first_name="Tester",
+            last_name="TESTER",
+        )
+        self.tester.create_user(user)
+        self.cookies = self.tester.auth_api_sign_in(user)
+        self.tester.notify("Login works", score=1.0)
+
+    def step_03(self):
+        "check feed"
+        if not self.cookies:
+            self.tester.notify("Cannot proceed if unable to login")
+            self.tester.stop()
+        response = self.tester.http.get(self.url + "feed", cookies=self.cookies)
+        assert response.status_code == 200, "unable to open the feed"
+        # the first visit makes up users, friends and items
+        db = self.tester.app_as_module.db
+        assert db(db.feed_item).count() == 100, "expected the made up items"
+        links = re.findall(
+            r'<div class="post">\s*<a href="[^"]*home/(\d+)">([^<]*)</a>', response.text
+        )
+        assert links, "expected the links to the authors"
+        for user_id, name in links:
+            user = db.auth_user(int(user_id))
+            assert name.split() == [
+                user.first_name,
+                user.last_name,
+            ], "expected the names of the authors"
+        self.tester.notify("Feed works", score=1.0)
+
+        # the cached post cards show the names of a renamed author
+        user_id = int(links[0][0])
+        db(db.auth_user.id == user_id).update(first_name="Renamed")
+        db.commit()
+        response = self.tester.http.get(self.url + "feed", cookies=self.cookies)
+        assert re.search(
+            r'home/%i">\s*Renamed\s' % user_id, response.text
+        ), "expected the new name of the author"
+        self.tester.notify("Cached posts show renamed authors", score=1.0)
+
+    def step_04(self):
+        "check likes"
+        res = self.tester.fetch("POST", self.url + "like/1", cookies=self.cookies)
+        assert res == {"liked": True}, "expected the item to be liked"
+        res = self.tester.fetch("POST", self.url + "like/2", cookies=self.cookies)
+        assert res == {"liked": True}, "expected the item to be liked"
+        res = self.tester.fetch("POST", self.url + "like/1", cookies=self.cookies)
+        assert res == {"liked": False}, "expected the item to be unliked"
+        self.tester.notify("Like toggling works", score=1.0)
+
+        response = self.tester.http.get(
+            self.url + "export/likes", cookies=self.cookies
+        )
+        assert response.status_code == 200, "unable to export the likes"
+        likes = [json.loads(line) for line in response.text.splitlines()]
+        assert [like["item_id"] for like in likes] == [2], "expected one like"
+        self.tester.notify("Exporting likes works", score=1.0)
+
+
+if __name__ == "__main__":
+    # --api only runs the steps that do not need a browser
+    TestFadebook(browser="--api" not in sys.argv).run()
@@ -0,0 +1,141 @@
+"""
+Precompressed, fingerprinted static assets
+
+The build step (run it after changing anything in static/)
+
+    python apps/shared/assets.py apps/fadebook
+
+copies every file of static/ under a name with a hash of its content
+(js/utils.js -> js/utils.1f3a9c0b2e.js), writes .gz (and .br if the brotli
+module is installed) variants next to it and a manifest.json mapping the
+original names to the hashed ones, all in the assets/ folder.
+
+The Assets fixture injects asset() in the templates:
+
+    <script src="[[=asset('js/utils.js')]]"></script>
+
+which returns the url of the hashed file, served with immutable cache
+headers and in the precompressed variant the browser accepts. Without a
+manifest (the build step was not run) it returns the plain static/ url.
+"""
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+from py4web import HTTP, URL, request
+from py4web.core import Fixture
+
+# the files are not minified: without a real parser minifying breaks strings,
+# template literals and regexps, and compression gets most of the savings
+COMPRESSIBLE = (".css", ".js", ".html", ".svg", ".json", ".txt", ".ico")
+
+
+def build(static_folder, build_folder):
+    """Builds the assets of static_folder into build_folder, returns the manifest"""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.startswith(".") or filename == "README.md":
+                continue
+            fullpath = os.path.join(root, filename)
+            name = os.path.relpath(fullpath, static_folder).replace(os.sep, "/")
+            with open(fullpath, "rb") as stream:
+                data = stream.read()
+            base, ext = os.path.splitext(name)
+            digest = hashlib.sha256(data).hexdigest()[:10]
+            hashed = "%s.%s%s" % (base, digest, ext)
+            target = os.path.join(build_folder, hashed)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                write(target, data)
+                if ext in COMPRESSIBLE:
+                    write(target + ".gz", gzip.compress(data, 9, mtime=0))
+                    if brotli:
+                        write(target + ".br", brotli.compress(data))
+            manifest[name] = hashed
+    write(
+        os.path.join(build_folder, "manifest.json"),
+        json.dumps(manifest, indent=2, sort_keys=True).encode("utf8"),
+    )
+    return manifest
+
+
+def write(filename, data):
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as stream:
+        stream.write(data)
+    os.replace(tmp, filename)
+
+
+class Assets(Fixture):
+    def __init__(self, build_folder, prefix="assets"):
+        self.build_folder = build_folder
+        self.prefix = prefix
+        self._manifest = {}
+        self._manifest_mtime = None
+        self._hashed = set()
+
+    def manifest(self):
+        """The build manifest, reloaded when the build step rewrites it"""
+        filename = os.path.join(self.build_folder, "manifest.json")
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._manifest_mtime:
+            manifest = {}
+            if mtime is not None:
+                with open(filename) as stream:
+                    manifest = json.load(stream)
+            self._manifest, self._manifest_mtime = manifest, mtime
+            self._hashed = set(manifest.values())
+        return self._manifest
+
+    def url(self, path):
+        hashed = self.manifest().get(path)
+        if hashed:
+            return URL(self.prefix, hashed)
+        return URL("static", path)
+
+    def on_request(self, context):
+        context["template_inject"]["asset"] = self.url
+
+    def serve(self, path):
+        """Raises the response for a hashed asset, precompressed when accepted"""
+        # imported here so that the build step runs as a plain script
+        from .streaming import IMMUTABLE, stream_file
+
+        if not self.manifest() or path not in self._hashed:
+            raise HTTP(404)
+        fullpath = os.path.join(self.build_folder, path)
+        accepted = request.headers.get("Accept-Encoding", "")
+        for encoding, ext in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in accepted and os.path.exists(fullpath + ext):
+                fullpath += ext
+                break
+        else:
+            encoding = None
+        headers = {"Vary": "Accept-Encoding"}
+        stream_file(
+            fullpath,
+            cache_control=IMMUTABLE,
+            headers=headers,
+            content_encoding=encoding,
+        )
+
+
+if __name__ == "__main__":
+    # the folders of the apps whose static/ to build
+    for app_folder in sys.argv[1:]:
+        manifest = build(
+            os.path.join(app_folder, "static"), os.path.join(app_folder, "assets")
+        )
+        for name, hashed in sorted(manifest.items()):
+            sys.stdout.write("%s -> %s\n" % (name, hashed))
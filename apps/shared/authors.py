@@ -0,0 +1,142 @@
+"""
+Optional denormalized author fields (settings.DENORMALIZE_AUTHORS)
+
+    authors = Authors(db)
+    db.define_table("post_item", Field("content", "text"), auth.signature, *authors.fields())
+    authors.track(db.post_item)
+
+copies the display fields of the author (author_username, author_first_name,
+author_last_name) into every post when it is inserted, so rendering a list
+of posts reads a single table and never looks up auth_user.
+
+The copies are eventually consistent: when a profile changes, the user id is
+queued in the author_update table in the same transaction and fixup(), run
+in the background, rewrites the author fields of the posts of the queued
+users, leaving their modified_on and modified_by alone. fixup() also fills
+the fields of the rows written before the setting was turned on (NULL
+author fields), a batch at a time, and the pages fall back to auth_user for
+the rows it has not reached yet.
+"""
+import logging
+import os
+import threading
+import time
+
+from pydal import Field
+
+NAMES = ("username", "first_name", "last_name")
+
+
+class Authors:
+    def __init__(self, db, names=NAMES, logger=None):
+        self.db = db
+        self.names = names
+        self.logger = logger or logging.getLogger(__name__)
+        self.tables = []
+        # per table, the id up to which the rows have been backfilled
+        self.backfilled = {}
+        db.define_table("author_update", Field("user_id", "reference auth_user"))
+        # before the update, the query may select on the fields that change
+        db.auth_user._before_update.append(self._queue)
+
+    def fields(self):
+        """The fields to add to the tables passed to track()"""
+        return [
+            Field("author_" + name, readable=False, writable=False)
+            for name in self.names
+        ]
+
+    def track(self, table):
+        """Fills the author fields of table (which has a created_by) on insert"""
+        table._before_insert.append(self._copy)
+        self.tables.append(table)
+
+    def values(self, user_id):
+        """The author fields for the user user_id"""
+        user = self.db.auth_user(user_id) if user_id else None
+        return {"author_" + name: user and user[name] for name in self.names}
+
+    def _copy(self, fields):
+        for key, value in self.values(fields.get("created_by")).items():
+            fields[key] = value
+
+    def _queue(self, dbset, fields):
+        if any(name in fields for name in self.names):
+            for row in dbset.select(self.db.auth_user.id):
+                self.db.author_update.insert(user_id=row.id)
+
+    def fixup(self, batch_size=100):
+        """
+        Rewrites the author fields of the queued users and backfills those of
+        a batch of older rows, returns the number of queued users and rows
+        """
+        db = self.db
+        pending = db(db.author_update).select(
+            orderby=db.author_update.id, limitby=(0, batch_size)
+        )
+        # take the batch, if another process took part of it leave it to them
+        if pending and db(
+            db.author_update.id.belongs([row.id for row in pending])
+        ).delete() < len(pending):
+            db.rollback()
+            return 0
+        for user_id in set(row.user_id for row in pending):
+            for table in self.tables:
+                self._update(table, table.created_by == user_id, user_id)
+        return len(pending) + self.backfill(batch_size)
+
+    def backfill(self, batch_size=100):
+        """Fills the author fields of up to batch_size rows that have none"""
+        db, count = self.db, 0
+        for table in self.tables:
+            query = table.id > self.backfilled.get(table._tablename, 0)
+            query &= table["author_" + self.names[0]] == None
+            query &= table.created_by != None
+            rows = db(query).select(
+                table.id, table.created_by, orderby=table.id, limitby=(0, batch_size)
+            )
+            if not rows:
+                continue
+            # rows left without authors (deleted users) are not selected again
+            self.backfilled[table._tablename] = rows.last().id
+            ids = [row.id for row in rows]
+            for user_id in set(row.created_by for row in rows):
+                self._update(
+                    table, table.id.belongs(ids) & (table.created_by == user_id), user_id
+                )
+            count += len(rows)
+        return count
+
+    def _update(self, table, query, user_id):
+        # not Set.update, which would also set modified_on and modified_by
+        self.db._adapter.update(
+            table,
+            query,
+            [(table[name], value) for name, value in self.values(user_id).items()],
+        )
+
+    def start(self, interval=5.0):
+        """Runs fixup() every interval seconds in a daemon thread of this process"""
+        thread = self._start_thread(interval)
+        # and in every worker forked from it (tools/prefork.py)
+        os.register_at_fork(after_in_child=lambda: self._start_thread(interval))
+        return thread
+
+    def _start_thread(self, interval):
+        thread = threading.Thread(target=self._loop, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def _loop(self, interval):
+        db = getattr(self.db, "primary", self.db)
+        while True:
+            time.sleep(interval)
+            db.get_connection_from_pool_or_new()
+            try:
+                while self.fixup():
+                    db.commit()
+            except Exception:
+                self.logger.exception("author fixup failed")
+                db.recycle_connection_in_pool_or_close("rollback")
+            else:
+                db.recycle_connection_in_pool_or_close("commit")
@@ -0,0 +1,175 @@
+"""
+Compiled translation catalogs and memoized translations
+
+    T = CatalogTranslator(settings.T_FOLDER, cache_folder=settings.T_CACHE_FOLDER)
+
+is the py4web Translator fixture, but the json catalogs of T_FOLDER (it.json,
+...) are compiled once, parsed and normalized, to marshal files in
+cache_folder, which every process then loads without parsing anything. Run
+the build step after changing a catalog (or let the first load do it):
+
+    python apps/shared/catalogs.py apps/tagged_posts
+
+The translation of every (language, text, arguments) is memoized in a dict
+of at most size entries (the oldest go first), so the strings repeated by
+the pages and the auth forms are looked up and formatted once per process.
+The requests check the mtimes of the catalogs, at most every check_interval
+seconds, and an edited catalog is reloaded (and the memo emptied).
+"""
+import glob
+import hashlib
+import json
+import logging
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+
+from py4web import Translator
+
+VERSION = sys.implementation.cache_tag
+
+# the catalogs pluralize loads: it.json, pt-br.json, ...
+REGEX_LANGUAGE = re.compile(r"^\w\w(-\w+)*\.json$")
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_language(mapping, source=None):
+    """
+    The catalog in the form pluralize translates with, {text: {"0": ...}}:
+    plain string translations (which pluralize accepts too) are wrapped
+    """
+    for key, value in list(mapping.items()):
+        if isinstance(value, str):
+            mapping[key] = {"0": value}
+            logger.warning("the translation of %r in %s is a plain string", key, source)
+        elif isinstance(value, dict):
+            mapping[key] = {str(k): v for k, v in value.items()}
+    return mapping
+
+
+class CatalogTranslator(Translator):
+    def __init__(
+        self, folder, cache_folder=None, size=10000, check_interval=1.0, **kwargs
+    ):
+        self.cache_folder = cache_folder
+        self.size = size
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.memo = {}
+        self.selected = {}
+        self.mtimes = {}
+        self.checked_on = time.monotonic()
+        super().__init__(folder, **kwargs)
+
+    def load(self, folder):
+        """Loads the catalogs of folder, compiling the ones that changed"""
+        languages = {}
+        mtimes = self.catalog_mtimes(folder)
+        for filename in mtimes:
+            path = os.path.join(folder, filename)
+            languages[filename[:-5].lower()] = self.load_catalog(path)
+        self.languages = languages
+        self.mtimes = mtimes
+        # new dicts, a request still using the old ones does not mind
+        self.memo = {}
+        self.selected = {}
+
+    def catalog_mtimes(self, folder):
+        return {
+            entry.name: entry.stat().st_mtime_ns
+            for entry in sorted(os.scandir(folder), key=lambda entry: entry.name)
+            if REGEX_LANGUAGE.match(entry.name)
+        }
+
+    def load_catalog(self, path):
+        with open(path, "rb") as stream:
+            source = stream.read()
+        if not self.cache_folder:
+            return normalize_language(json.loads(source.decode(self.encoding)), path)
+        digest = hashlib.sha1(VERSION.encode() + source).hexdigest()
+        name = os.path.basename(path)[:-5]
+        filename = os.path.join(self.cache_folder, "%s.%s.marshal" % (name, digest[:16]))
+        try:
+            with open(filename, "rb") as stream:
+                return marshal.load(stream)
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        language = normalize_language(json.loads(source.decode(self.encoding)), path)
+        os.makedirs(self.cache_folder, exist_ok=True)
+        tmp = "%s.%i.tmp" % (filename, os.getpid())
+        with open(tmp, "wb") as stream:
+            marshal.dump(language, stream)
+        os.replace(tmp, filename)
+        # the compiled versions of the previous contents are of no use
+        for old in glob.glob(os.path.join(self.cache_folder, "%s.*.marshal" % name)):
+            if old != filename:
+                os.unlink(old)
+        return language
+
+    def check(self):
+        """Reloads the catalogs if any of them changed"""
+        now = time.monotonic()
+        if now - self.checked_on < self.check_interval:
+            return
+        self.checked_on = now
+        try:
+            if self.catalog_mtimes(self.folder) == self.mtimes:
+                return
+        except OSError:
+            return
+        with self.lock:
+            self.load(self.folder)
+
+    def on_request(self, context):
+        self.check()
+        super().on_request(context)
+
+    def select(self, accepted_languages="fr-CH, fr;q=0.9, en;q=0.8, de;q=0.7, *;q=0.5"):
+        """Picks the language for an Accept-Language header, memoized by header"""
+        if not isinstance(accepted_languages, str):
+            return super().select(accepted_languages)
+        try:
+            tag = self.selected[accepted_languages]
+        except KeyError:
+            super().select(accepted_languages)
+            if len(self.selected) >= self.size:
+                self.selected = {}
+            self.selected[accepted_languages] = self.local.tag
+            return
+        self.local.tag = tag
+        self.local.language = self.languages.get(tag) if tag else None
+
+    def _translator(self, text, **kwargs):
+        key = (getattr(self.local, "tag", None), text, tuple(kwargs.items()))
+        memo = self.memo
+        try:
+            return memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments are not memoized
+            return super()._translator(text, **kwargs)
+        translated = super()._translator(text, **kwargs)
+        if len(memo) >= self.size:
+            with self.lock:
+                try:
+                    del memo[next(iter(memo))]
+                except (StopIteration, KeyError, RuntimeError):
+                    pass
+        memo[key] = translated
+        return translated
+
+
+if __name__ == "__main__":
+    # the folders of the apps whose catalogs to compile
+    for app_folder in sys.argv[1:]:
+        translator = CatalogTranslator(
+            os.path.join(app_folder, "translations"),
+            cache_folder=os.path.join(app_folder, "cache", "translations"),
+        )
+        languages = ", ".join(sorted(translator.languages)) or "no catalogs"
+        print("%s: compiled %s" % (app_folder, languages))
@@ -0,0 +1,106 @@
+"""
+Compact results for the JSON APIs
+
+    @action("api/posts", method="GET")
+    @action.uses(metrics, auth.user)
+    def get_api_posts():
+        fields = [db.post_item.id, db.post_item.content]
+        posts = select_compact(db(db.post_item), fields, requested_layout())
+        return compact_json({"posts": posts})
+
+select_compact() runs the select with a processor that keeps the tuples
+returned by the driver, so no Row is built per record: only the values of
+the field types the driver does not return in their final form (boolean,
+list:*, json, ...) are parsed, the others are passed as they are (dates
+and datetimes are serialized by objectify, as py4web does). The result is
+laid out as requested by ?layout= (see requested_layout()):
+
+    records   [{"id": 1, "content": "..."}, ...]   (like Rows.as_list())
+    columns   {"id": [1, ...], "content": ["...", ...]}
+
+the columns layout builds no object per record at all and its payload
+does not repeat the names of the fields in every record. compact_json()
+serializes the output without the indentation and the sorted keys of the
+default py4web JSON responses.
+"""
+import json
+
+from py4web import HTTP, request, response
+from py4web.core import objectify
+
+LAYOUTS = ("records", "columns")
+# the drivers return these as the values of the parsed records
+NATIVE_TYPES = {
+    "id",
+    "big-id",
+    "integer",
+    "bigint",
+    "double",
+    "string",
+    "text",
+    "password",
+    "upload",
+    "date",
+    "time",
+    "datetime",
+}
+
+
+def is_native(field):
+    ftype = field.type
+    return isinstance(ftype, str) and (
+        ftype in NATIVE_TYPES
+        or ftype.startswith("reference ")
+        or ftype.startswith("big-reference ")
+    )
+
+
+def requested_layout():
+    """The layout of ?layout=, records by default"""
+    layout = request.query.get("layout", "records")
+    if layout not in LAYOUTS:
+        raise HTTP(400)
+    return layout
+
+
+def select_compact(dbset, fields, layout="records", **attributes):
+    """
+    Selects fields from dbset (a Set), returns them in layout, attributes
+    are those of Set.select
+    """
+
+    def processor(rows, *args, **kwargs):
+        return lay_out(dbset.db, rows, fields, layout)
+
+    return dbset.select(*fields, processor=processor, **attributes)
+
+
+def lay_out(db, rows, fields, layout):
+    """Turns the tuples of the driver into records or columns"""
+    names = [field.name for field in fields]
+    parse = db._adapter.parse_value
+    parsed = [(k, field) for k, field in enumerate(fields) if not is_native(field)]
+    if layout == "columns":
+        columns = [list(column) for column in zip(*rows)] or [[] for _ in fields]
+        for k, field in parsed:
+            columns[k] = [parse(value, field._itype, field.type) for value in columns[k]]
+        return dict(zip(names, columns))
+    if parsed:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for k, field in parsed:
+                row[k] = parse(row[k], field._itype, field.type)
+    return [dict(zip(names, row)) for row in rows]
+
+
+def column(result, name):
+    """The values of the field name in a result of select_compact, any layout"""
+    if isinstance(result, dict):
+        return result[name]
+    return [record[name] for record in result]
+
+
+def compact_json(obj):
+    """The body of a JSON response with obj, without spaces"""
+    response.headers["Content-Type"] = "application/json"
+    return json.dumps(obj, default=objectify, separators=(",", ":"))
@@ -0,0 +1,65 @@
+"""
+A bound on the requests of a process that use the database at once
+
+    db_limit = ConcurrencyLimit(4, timeout=5, metrics=metrics)
+
+    @action("api/posts", method="GET")
+    @action.uses(metrics, db_limit, auth.user)
+
+lets at most 4 requests of the process run the fixtures listed after it
+(auth, the session, the db) and the action at the same time. The others
+wait up to timeout seconds for a slot and then get a 503 with a
+Retry-After header. However many threads the server keeps for its
+clients, each process opens at most limit transactions, and a burst
+queues in the server instead of in the database. List the limiter before
+auth.user so that the slot is taken before any query runs: it has no
+prerequisites and the slot is given back after the db has committed.
+A limit of 0 (or None) disables it, the fixture does nothing.
+
+py4web serves WSGI (on Rocket3): a thread per connection, which runs the
+action to its end and returns the response. An action cannot hand its
+server thread back while it waits on the db, there is no event loop to
+yield to, and running it on a bounded pool of other threads would only
+keep the server thread blocked waiting for that pool. So the requests are
+not made asynchronous, what is bounded is how many of them hold a
+connection to the db. Compare the shipped limit with the unbounded
+baseline on the workloads of tools/benchmark.py:
+
+    python tools/benchmark.py --compare-concurrency
+"""
+import math
+import threading
+
+from py4web import HTTP, request
+from py4web.core import Fixture
+
+from .metrics import route_rule
+
+
+class ConcurrencyLimit(Fixture):
+    def __init__(self, limit, timeout=5, metrics=None):
+        self.limit = limit
+        self.timeout = timeout
+        self.metrics = metrics
+        self.semaphore = threading.BoundedSemaphore(limit) if limit else None
+
+    def on_request(self, context):
+        if self.semaphore and not self.semaphore.acquire(timeout=self.timeout):
+            if self.metrics:
+                self.metrics.inc("py4web_db_busy_total", route=route_rule())
+            # read the body, else the server parses it as the next request
+            # of a keep-alive connection
+            request.body
+            raise HTTP(
+                503,
+                "Service Unavailable",
+                headers={"Retry-After": str(int(math.ceil(self.timeout)))},
+            )
+
+    def on_success(self, context):
+        if self.semaphore:
+            self.semaphore.release()
+
+    def on_error(self, context):
+        if self.semaphore:
+            self.semaphore.release()
@@ -0,0 +1,102 @@
+"""
+Streaming exports, as NDJSON or CSV
+
+    @action("export/posts")
+    @action.uses(metrics, auth.user)
+    def export_posts():
+        export(db, db.post_item, [db.post_item.id, db.post_item.content])
+
+raises a response whose body is produced while it is sent (chunked transfer
+encoding): the rows are read in chunks of chunk_size ordered by id, each
+chunk is a new query for the ids after the last one sent, so memory use
+does not depend on the size of the table and no cursor stays open between
+chunks. Every record carries its id and an interrupted export resumes with
+?after=<last id received>. The format is picked by ?format=ndjson|csv.
+
+The body is generated after the action returns, on a connection of its own
+(the db fixture has already released the one of the request).
+"""
+import csv
+import io
+import json
+
+from py4web import HTTP, request
+from py4web.core import bottle, objectify
+
+CHUNK_SIZE = 1000
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export(db, query, fields, expand=None, filename="export", chunk_size=CHUNK_SIZE):
+    """
+    Raises the response that streams the records of query, fields[0] must be
+    the id field. expand(db, records) can add keys to the records of a chunk
+    """
+    fmt = request.query.get("format", "ndjson")
+    if fmt not in CONTENT_TYPES:
+        raise HTTP(400)
+    try:
+        after = int(request.query.get("after", 0))
+    except ValueError:
+        raise HTTP(400)
+    # with read replicas, stay on the connection chosen for this request
+    db = getattr(db, "current", db)
+    chunks = iter_chunks(db, query, fields, after, chunk_size, expand)
+    body = iter_csv(chunks) if fmt == "csv" else iter_ndjson(chunks)
+    headers = {
+        "Content-Type": CONTENT_TYPES[fmt],
+        "Content-Disposition": 'attachment; filename="%s.%s"' % (filename, fmt),
+        "Cache-Control": "no-store",
+    }
+    raise bottle.HTTPResponse(body, status=200, **headers)
+
+
+def iter_chunks(db, query, fields, after, chunk_size, expand=None):
+    """Yields lists of records (dicts) with id > after, in id order"""
+    key = fields[0]
+    db.get_connection_from_pool_or_new()
+    try:
+        while True:
+            rows = db(query)(key > after).select(
+                *fields, orderby=key, limitby=(0, chunk_size), cacheable=True
+            )
+            if not rows:
+                break
+            records = rows.as_list()
+            after = records[-1][key.name]
+            if expand:
+                expand(db, records)
+            yield records
+            if len(records) < chunk_size:
+                break
+    finally:
+        db.recycle_connection_in_pool_or_close("commit")
+
+
+def iter_ndjson(chunks):
+    for records in chunks:
+        yield "".join(
+            json.dumps(record, default=objectify, separators=(",", ":")) + "\n"
+            for record in records
+        ).encode("utf8")
+
+
+def iter_csv(chunks):
+    columns = None
+    for records in chunks:
+        stream = io.StringIO()
+        writer = csv.writer(stream)
+        if columns is None:
+            columns = list(records[0])
+            writer.writerow(columns)
+        for record in records:
+            writer.writerow([csv_value(record.get(name)) for name in columns])
+        yield stream.getvalue().encode("utf8")
+
+
+def csv_value(value):
+    if isinstance(value, (list, tuple)):
+        return " ".join(map(str, value))
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return objectify(value)
@@ -0,0 +1,252 @@
+"""
+Non-blocking logging pipeline used by common.py for settings.LOGGERS
+
+The request thread only puts records in a bounded queue. A background
+thread takes them in batches, passes each record to the handlers whose
+level allows it, and flushes every handler once per batch. When the queue
+is full records are dropped (and counted) instead of blocking the request.
+
+LOGGERS entries keep the "severity:filename" syntax, filename can be stdout,
+stderr or a file. Files are rotated by size and by age and files ending in
+.jsonl are written as structured JSON lines.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+FORMATTER = logging.Formatter()
+# the started pipelines: an app reload stops the pipeline of the previous
+# load, and the hooks below (registered once, they cannot be unregistered)
+# only act on the pipelines still running
+PIPELINES = set()
+
+
+def stop_all():
+    for pipeline in list(PIPELINES):
+        pipeline.stop()
+
+
+def after_fork():
+    for pipeline in list(PIPELINES):
+        pipeline._after_fork()
+
+
+atexit.register(stop_all)
+os.register_at_fork(after_in_child=after_fork)
+
+
+class BatchFlushMixin:
+    """A handler that, when batched, is only flushed by the LogPipeline"""
+
+    batched = False
+
+    def flush(self):
+        if not self.batched:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class RotatingHandler(BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    """Rotates the file when it exceeds max_bytes or is older than max_seconds"""
+
+    def __init__(self, filename, max_bytes=0, max_seconds=0, backup_count=5):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+        self.max_seconds = max_seconds
+        self.rollover_at = self._compute_rollover_at()
+
+    def _compute_rollover_at(self):
+        if not self.max_seconds:
+            return None
+        try:
+            started = os.path.getmtime(self.baseFilename)
+        except OSError:
+            started = time.time()
+        return started + self.max_seconds
+
+    def shouldRollover(self, record):
+        if self.rollover_at and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.max_seconds:
+            self.rollover_at = time.time() + self.max_seconds
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        item = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "file": record.filename,
+            "line": record.lineno,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            item["exception"] = record.exc_text
+        return json.dumps(item)
+
+
+def make_handler(item, formatter, max_bytes=0, max_seconds=0, backup_count=5):
+    """Makes a handler from a "severity:filename" LOGGERS entry"""
+    level, filename = item.split(":", 1)
+    if filename in ("stdout", "stderr"):
+        handler = BatchStreamHandler(getattr(sys, filename))
+    else:
+        handler = RotatingHandler(filename, max_bytes, max_seconds, backup_count)
+    if filename.endswith(".jsonl"):
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(formatter)
+    handler.setLevel(getattr(logging, level.upper(), logging.DEBUG))
+    return handler
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler that never blocks, it counts the records it drops"""
+
+    def __init__(self, pipeline):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        """
+        Like QueueHandler.prepare it merges the args into the message and
+        formats the traceback in the calling thread, but it keeps the traceback
+        in exc_text for the formatters of the real handlers (QueueHandler
+        appends it to the message, where the JSON formatter cannot find it)
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = FORMATTER.formatException(record.exc_info)
+            # the traceback would keep the frames of the request alive
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.pipeline.count_dropped()
+
+    def close(self):
+        self.pipeline.stop()
+        super().close()
+
+
+class LogPipeline:
+    """Owns the queue, the writer thread and the real handlers"""
+
+    def __init__(self, handlers, queue_size=10000, batch_size=256, flush_interval=0.5):
+        self.handlers = handlers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.handler = DroppingQueueHandler(self)
+        for handler in handlers:
+            handler.batched = True
+
+    def count_dropped(self):
+        with self.lock:
+            self.dropped += 1
+
+    def start(self):
+        self._start_thread()
+        PIPELINES.add(self)
+
+    def _start_thread(self):
+        self.thread = threading.Thread(target=self._run, name="log-pipeline")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _after_fork(self):
+        """A forked worker gets its own queue and writer thread"""
+        if self.thread is not None:
+            # the queue may have been locked by the writer of the parent
+            self.lock = threading.Lock()
+            self.queue = self.handler.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._start_thread()
+
+    def stop(self):
+        """Flushes pending records and stops the writer thread"""
+        if self.thread is not None:
+            thread, self.thread = self.thread, None
+            PIPELINES.discard(self)
+            self.queue.put(None)
+            thread.join()
+            for handler in self.handlers:
+                handler.close()
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+            self._report_dropped(batch)
+            for record in batch:
+                if record is not None:
+                    self._dispatch(record)
+            if batch:
+                for handler in self.handlers:
+                    handler.flush_batch()
+
+    def _report_dropped(self, batch):
+        dropped = self.dropped - self.reported_dropped
+        if dropped:
+            self.reported_dropped += dropped
+            batch.append(
+                logging.makeLogRecord(
+                    {
+                        "name": "log-pipeline",
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": "log queue full, dropped %i messages" % dropped,
+                    }
+                )
+            )
+
+    def _dispatch(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
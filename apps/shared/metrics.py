@@ -0,0 +1,409 @@
+"""
+Prometheus-style metrics for the app
+
+Metrics is a fixture, add it first to the fixtures of an action to count and
+time it by route, method and status. It also times every query run by the
+instrumented DALs, the hits and misses of a MeteredCache, the operations of a
+MeteredStore (session storage) and, when connected, celery tasks.
+
+Counters are kept per thread in plain dicts (no locks on the hot path) and
+are only summed when the metrics page is scraped. With multiprocess_dir set,
+every process also dumps its totals to a json file in that folder and the
+scrape merges the files of all the processes (workers, celery, ...). A
+process removes its file when it exits, the files of the processes that
+died without doing it are removed by the next scrape (the folder must be
+local to the host, the processes are checked by pid).
+
+The page is served to the scrapes that send the token of the app, or to the
+ones from this host when it has none (see authorize_scrape).
+"""
+import atexit
+import glob
+import hmac
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from py4web import HTTP, Cache, request, response
+from py4web.core import Fixture, bottle
+from pydal.helpers.classes import ExecutionHandler
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    "py4web_action_requests_total": ("counter", "Requests served by actions"),
+    "py4web_action_duration_seconds": ("histogram", "Time spent in actions"),
+    "py4web_db_queries_total": ("counter", "Queries executed"),
+    "py4web_db_query_duration_seconds": ("histogram", "Time spent in queries"),
+    "py4web_cache_requests_total": ("counter", "Cache lookups by result"),
+    "py4web_session_store_operations_total": ("counter", "Session store operations"),
+    "py4web_session_store_duration_seconds": ("histogram", "Session store latency"),
+    "py4web_task_runs_total": ("counter", "Background tasks run"),
+    "py4web_task_duration_seconds": ("histogram", "Background task duration"),
+    "py4web_rate_limited_total": ("counter", "Requests rejected by rate limits"),
+    "py4web_db_busy_total": ("counter", "Requests rejected by the db concurrency limit"),
+}
+
+REGEX_STATEMENT = re.compile(r"^\s*(\w+)")
+
+
+class Metrics(Fixture):
+    def __init__(self, app_name, multiprocess_dir=None, flush_interval=5):
+        self.app_name = app_name
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        self.thread_local = threading.local()
+        self.filename = None
+        self.closed = False
+        if multiprocess_dir:
+            os.makedirs(multiprocess_dir, exist_ok=True)
+            self._start_flusher()
+            atexit.register(self.close)
+        # a worker forked after loading the app (tools/prefork.py) counts,
+        # and flushes to a file of its own, only the requests it serves
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    # #######################################################
+    # recording (hot path, no locks)
+    # #######################################################
+
+    def shard(self):
+        """Returns the dict where the current thread records its metrics"""
+        try:
+            return self.thread_local.shard
+        except AttributeError:
+            shard = self.thread_local.shard = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self.shard()
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        shard = self.shard()
+        item = shard.get(key)
+        if item is None:
+            item = shard[key] = [0, 0.0] + [0] * len(BUCKETS)
+        item[0] += 1
+        item[1] += seconds
+        for k, bucket in enumerate(BUCKETS):
+            if seconds <= bucket:
+                item[2 + k] += 1
+                break
+
+    # #######################################################
+    # the fixture times the actions using it
+    # #######################################################
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.t0 = time.perf_counter()
+
+    def on_success(self, context):
+        self._record_action(action_status(context))
+
+    def on_error(self, context):
+        # a bottle.HTTPError (e.g. abort(404)) is an error with a status
+        self._record_action(getattr(context.get("exception"), "status_code", 500))
+
+    def _record_action(self, status):
+        route = route_rule()
+        labels = dict(route=route, method=request.method, status=str(status))
+        self.inc("py4web_action_requests_total", **labels)
+        self.observe(
+            "py4web_action_duration_seconds",
+            time.perf_counter() - self.local.t0,
+            route=route,
+            method=request.method,
+        )
+
+    # #######################################################
+    # instrumentation of other components
+    # #######################################################
+
+    def instrument_db(self, db, name="db"):
+        """Times every query executed by the DAL db"""
+        metrics = self
+
+        class MetricsHandler(ExecutionHandler):
+            def before_execute(self, command):
+                self.t0 = time.perf_counter()
+
+            def after_execute(self, command):
+                match = REGEX_STATEMENT.match(command)
+                statement = match.group(1).lower() if match else "other"
+                metrics.inc("py4web_db_queries_total", db=name, statement=statement)
+                metrics.observe(
+                    "py4web_db_query_duration_seconds",
+                    time.perf_counter() - self.t0,
+                    db=name,
+                )
+
+        db._adapter.execution_handlers.append(MetricsHandler)
+
+    def connect_celery(self):
+        """Times celery tasks run by this process (use multiprocess_dir)"""
+        from celery import signals
+
+        started = {}
+
+        def prerun(task_id=None, **kwargs):
+            started[task_id] = time.perf_counter()
+
+        def postrun(task_id=None, task=None, state=None, **kwargs):
+            t0 = started.pop(task_id, None)
+            self.inc("py4web_task_runs_total", task=task.name, state=str(state))
+            if t0 is not None:
+                self.observe(
+                    "py4web_task_duration_seconds",
+                    time.perf_counter() - t0,
+                    task=task.name,
+                )
+
+        signals.task_prerun.connect(prerun, weak=False)
+        signals.task_postrun.connect(postrun, weak=False)
+
+    # #######################################################
+    # aggregation and exposition
+    # #######################################################
+
+    def totals(self):
+        """Sums the shards of all the threads of this process"""
+        with self.shards_lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            # copy first, the owner thread may be adding keys right now
+            for key, value in list(shard.items()):
+                merge(totals, key, value)
+        return totals
+
+    def collect(self):
+        """Returns the totals of this process or, in multiprocess mode, of all"""
+        if not self.multiprocess_dir:
+            return self.totals()
+        self.flush()
+        totals = {}
+        pattern = os.path.join(self.multiprocess_dir, "%s-*.json" % self.app_name)
+        for filename in glob.glob(pattern):
+            try:
+                pid = int(filename[:-5].rsplit("-", 1)[1])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not pid_alive(pid):
+                # a process killed before it could remove its file
+                remove(filename)
+                continue
+            try:
+                with open(filename) as stream:
+                    items = json.load(stream)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in items:
+                merge(totals, (name, tuple(map(tuple, labels))), value)
+        return totals
+
+    def flush(self):
+        """Atomically dumps the totals of this process to its json file"""
+        if self.closed:
+            return
+        items = [
+            [name, list(labels), value]
+            for (name, labels), value in self.totals().items()
+        ]
+        tmp = "%s.%i.tmp" % (self.filename, threading.get_ident())
+        with open(tmp, "w") as stream:
+            json.dump(items, stream)
+        os.replace(tmp, self.filename)
+
+    def close(self):
+        """Stops flushing and removes the json file of this process (at exit)"""
+        self.closed = True
+        if self.filename:
+            remove(self.filename)
+
+    def _start_flusher(self):
+        self.filename = os.path.join(
+            self.multiprocess_dir, "%s-%i.json" % (self.app_name, os.getpid())
+        )
+
+        def loop():
+            while not self.closed:
+                time.sleep(self.flush_interval)
+                self.flush()
+
+        thread = threading.Thread(target=loop, name="metrics-flusher")
+        thread.daemon = True
+        thread.start()
+
+    def _after_fork(self):
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        self.thread_local = threading.local()
+        if self.multiprocess_dir:
+            self._start_flusher()
+
+    def render(self):
+        """Returns all the metrics in the Prometheus text format"""
+        lines = []
+        by_name = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            by_name.setdefault(name, []).append((labels, value))
+        for name, items in by_name.items():
+            kind, text = HELP.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in items:
+                labels = (("app", self.app_name),) + labels
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bucket, count in zip(BUCKETS, value[2:]):
+                    cumulative += count
+                    lines.append(
+                        "%s_bucket%s %i"
+                        % (name, format_labels(labels + (("le", bucket),)), cumulative)
+                    )
+                lines.append(
+                    "%s_bucket%s %i"
+                    % (name, format_labels(labels + (("le", "+Inf"),)), value[0])
+                )
+                lines.append("%s_sum%s %f" % (name, format_labels(labels), value[1]))
+                lines.append("%s_count%s %i" % (name, format_labels(labels), value[0]))
+        return "\n".join(lines) + "\n"
+
+
+def action_status(context):
+    """The status of the response of an action that succeeded"""
+    # set by raise HTTP(...)
+    if context.get("status", 200) != 200:
+        return context["status"]
+    # a bottle.HTTPResponse (a file served with a 206 or a 304, a redirect)
+    # is not caught by the action, it is the exception being raised
+    raised = sys.exc_info()[1]
+    if isinstance(raised, bottle.HTTPResponse):
+        return raised.status_code
+    return response.status_code
+
+
+def route_rule():
+    """The rule of the matched route (ombott wraps it in a RouteMethod)"""
+    try:
+        route = request.route
+    except RuntimeError:
+        return "unknown"
+    return getattr(route, "rule", None) or getattr(route.route, "rule", "unknown")
+
+
+def authorize_scrape(token=None):
+    """
+    Raises HTTP 403 unless the request sends "Authorization: Bearer <token>"
+    or, without a token, comes from this host (REMOTE_ADDR, not the spoofable
+    X-Forwarded-For: behind a proxy on this host, set a token)
+    """
+    if token:
+        sent = request.headers.get("Authorization", "")
+        if hmac.compare_digest(sent.encode("utf8"), ("Bearer " + token).encode("utf8")):
+            return
+    elif request.environ.get("REMOTE_ADDR") in ("127.0.0.1", "::1"):
+        return
+    raise HTTP(403)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+def merge(totals, key, value):
+    """Adds a counter (number) or a histogram (list) into totals"""
+    if isinstance(value, list):
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(value)
+        else:
+            totals[key] = [a + b for a, b in zip(current, value)]
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def format_labels(labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+
+
+class MeteredCache(Cache):
+    """A py4web Cache that counts its hits and misses"""
+
+    def __init__(self, metrics, size=1000, name="cache"):
+        super().__init__(size=size)
+        self.metrics = metrics
+        self.name = name
+
+    def get(self, key, callback, expiration=3600, monitor=None):
+        missed = []
+
+        def wrapped_callback():
+            missed.append(True)
+            return callback()
+
+        value = super().get(key, wrapped_callback, expiration, monitor)
+        result = "miss" if missed else "hit"
+        self.metrics.inc("py4web_cache_requests_total", cache=self.name, result=result)
+        return value
+
+
+class MeteredStore:
+    """Wraps a session storage (redis, memcache, DBStore) to time its operations"""
+
+    def __init__(self, storage, metrics, backend):
+        self.storage = storage
+        self.metrics = metrics
+        self.backend = backend
+        self.__prerequisites__ = getattr(storage, "__prerequisites__", [])
+
+    def _timed(self, operation, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return getattr(self.storage, operation)(*args, **kwargs)
+        finally:
+            labels = dict(backend=self.backend, operation=operation)
+            self.metrics.inc("py4web_session_store_operations_total", **labels)
+            self.metrics.observe(
+                "py4web_session_store_duration_seconds",
+                time.perf_counter() - t0,
+                **labels
+            )
+
+    def get(self, key):
+        return self._timed("get", key)
+
+    def set(self, key, value, expiration=None):
+        return self._timed("set", key, value, expiration)
+
+    def delete(self, key):
+        return self._timed("delete", key)
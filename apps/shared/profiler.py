@@ -0,0 +1,128 @@
+"""
+A per-request query profiler fixture
+
+    @action("feed")
+    @action.uses(profiler, "feed.html", auth.user)
+
+records every query issued while the action and its template run, with
+timing and call site. It adds a Server-Timing header to the response, logs
+the queries slower than slow_ms together with their query plan, and warns
+about N+1 patterns (the same query, up to its literals, run repeat times or
+more in one request). List it before the template to profile the template too.
+"""
+import re
+import sys
+import time
+
+from py4web import response
+from py4web.core import Fixture
+from pydal.helpers.classes import ExecutionHandler
+
+REGEX_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+REGEX_LISTS = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+
+def normalize(sql):
+    """Replaces literals with ? so similar queries look the same"""
+    return REGEX_LISTS.sub("(?)", REGEX_LITERALS.sub("?", sql))
+
+
+class QueryProfiler(Fixture):
+    def __init__(self, db, logger, app_folder, slow_ms=50, repeats=5):
+        self.db = db
+        self.logger = logger
+        self.app_folder = app_folder
+        self.slow_ms = slow_ms
+        self.repeats = repeats
+        self.__prerequisites__ = [db]
+        for dal in [getattr(db, "primary", db)] + getattr(db, "replicas", []):
+            dal._adapter.execution_handlers.append(self.handler())
+
+    def handler(self):
+        """Returns a pydal ExecutionHandler class that reports to this fixture"""
+        profiler = self
+
+        class ProfilerHandler(ExecutionHandler):
+            def before_execute(self, command):
+                self.t0 = time.perf_counter()
+
+            def after_execute(self, command):
+                if profiler.is_valid() and not profiler.local.explaining:
+                    profiler.local.queries.append(
+                        (
+                            command,
+                            1000.0 * (time.perf_counter() - self.t0),
+                            profiler.call_site(),
+                            self.adapter.db,
+                        )
+                    )
+
+        return ProfilerHandler
+
+    def call_site(self):
+        """The innermost app or template frame issuing the query"""
+        frame = sys._getframe(2)
+        while frame:
+            filename = frame.f_code.co_filename
+            if filename.endswith(".html"):
+                # compiled templates are named after the template file
+                return "templates/%s:%i" % (filename, frame.f_lineno)
+            if filename.startswith(self.app_folder) and filename != __file__:
+                return "%s:%i" % (filename[len(self.app_folder) + 1 :], frame.f_lineno)
+            frame = frame.f_back
+        return "unknown"
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.queries = []
+        self.local.explaining = False
+        self.local.t0 = time.perf_counter()
+
+    def on_error(self, context):
+        self.report()
+
+    def on_success(self, context):
+        self.report()
+
+    def report(self):
+        queries = self.local.queries
+        total_ms = 1000.0 * (time.perf_counter() - self.local.t0)
+        db_ms = sum(item[1] for item in queries)
+        response.headers["Server-Timing"] = (
+            'db;desc="%i queries";dur=%.2f, app;dur=%.2f'
+            % (len(queries), db_ms, total_ms)
+        )
+        for command, ms, site, dal in queries:
+            if ms >= self.slow_ms:
+                self.logger.warning(
+                    "slow query (%.1fms) at %s: %s\n%s",
+                    ms,
+                    site,
+                    command,
+                    self.explain(dal, command),
+                )
+        groups = {}
+        for command, ms, site, dal in queries:
+            groups.setdefault(normalize(command), []).append(site)
+        for sql, sites in groups.items():
+            if len(sites) >= self.repeats:
+                self.logger.warning(
+                    "possible N+1: %i similar queries from %s: %s",
+                    len(sites),
+                    ", ".join(sorted(set(sites))),
+                    sql,
+                )
+
+    def explain(self, dal, command):
+        """Returns the query plan, or an empty string if it cannot be computed"""
+        if not command.lstrip().upper().startswith("SELECT"):
+            return ""
+        prefix = "EXPLAIN QUERY PLAN " if dal._adapter.dbengine == "sqlite" else "EXPLAIN "
+        self.local.explaining = True
+        try:
+            rows = dal.executesql(prefix + command)
+        except Exception as err:
+            return "explain failed: %s" % err
+        finally:
+            self.local.explaining = False
+        return "\n".join(" | ".join(str(value) for value in row) for row in rows)
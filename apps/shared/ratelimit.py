@@ -0,0 +1,182 @@
+"""
+Token bucket rate limits for the write actions
+
+    limit = RateLimiter(rate=2, burst=10, per=("user", "route"), session=session)
+
+    @action("api/posts", method="POST")
+    @action.uses(metrics, limit, auth.user)
+
+allows every user (or ip, for anonymous requests) bursts of 10 requests to
+the route, refilled at 2 requests per second. per can combine "user", "ip",
+"route" (the rule, e.g. like/<item_id:int>) and "path" (e.g. like/42, to
+protect a hot post). Requests over the limit get a 429 with a Retry-After
+header from on_request, before the fixtures listed after the limiter (auth,
+db) run, so a rejection costs no database work. List the limiter before
+auth.user for that, its only prerequisite is the session.
+
+Buckets live in memory (MemoryStore, per process) or, so that the limits
+hold across the workers of a host, in an SQLite file (SQLiteStore), which
+every purge_interval seconds deletes the buckets idle for idle_seconds.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from py4web import HTTP, request
+from py4web.core import Fixture
+
+from .metrics import route_rule
+
+
+class MemoryStore:
+    """The buckets of this process, the least recently used are dropped"""
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def take(self, key, rate, burst, cost=1):
+        """Takes cost tokens, returns 0 or the seconds to wait for them"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class SQLiteStore:
+    """The buckets in an SQLite file, shared by the processes of the host"""
+
+    def __init__(self, filename, timeout=5, purge_interval=600, idle_seconds=3600):
+        self.filename = filename
+        self.timeout = timeout
+        self.purge_interval = purge_interval
+        self.idle_seconds = idle_seconds
+        self.purge_at = time.time() + purge_interval
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bucket "
+                "(key TEXT PRIMARY KEY, tokens REAL, last REAL);"
+            )
+        # sqlite connections must not cross a fork, workers open their own
+        os.register_at_fork(before=self.close, after_in_child=self._after_fork)
+
+    def close(self):
+        """Closes the connection of the current thread"""
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            self.local.connection = None
+            connection.close()
+
+    def _after_fork(self):
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(
+                self.filename, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA synchronous=OFF;")
+        return connection
+
+    def take(self, key, rate, burst, cost=1):
+        """Takes cost tokens, returns 0 or the seconds to wait for them"""
+        # wall clock time, the monotonic clocks of the processes may differ
+        now = time.time()
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE;")
+        try:
+            row = connection.execute(
+                "SELECT tokens, last FROM bucket WHERE key = ?;", (key,)
+            ).fetchone()
+            tokens, last = row or (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - last) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not wait:
+                tokens -= cost
+            connection.execute(
+                "INSERT OR REPLACE INTO bucket (key, tokens, last) VALUES (?, ?, ?);",
+                (key, tokens, now),
+            )
+        except Exception:
+            connection.execute("ROLLBACK;")
+            raise
+        connection.execute("COMMIT;")
+        # a take now and then (in every process) purges the idle buckets
+        if self.purge_interval and now >= self.purge_at:
+            self.purge_at = now + self.purge_interval
+            self.purge(self.idle_seconds)
+        return wait
+
+    def purge(self, seconds=3600):
+        """Deletes the buckets not used for seconds (they are full again)"""
+        with self.connection() as connection:
+            connection.execute(
+                "DELETE FROM bucket WHERE last < ?;", (time.time() - seconds,)
+            )
+
+
+class RateLimiter(Fixture):
+    def __init__(
+        self,
+        rate,
+        burst=None,
+        per=("user", "route"),
+        session=None,
+        store=None,
+        metrics=None,
+    ):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.per = per
+        self.session = session
+        self.store = store or MemoryStore()
+        self.metrics = metrics
+        # the user is read from the session, which does not need the db
+        self.__prerequisites__ = [session] if session else []
+
+    def key(self):
+        parts = ["%g/%g" % (self.rate, self.burst)]
+        for item in self.per:
+            if item == "user":
+                user = self.session and self.session.get("user")
+                user_id = user and user.get("id")
+                parts.append("user:%s" % user_id if user_id else "ip:%s" % remote_addr())
+            elif item == "ip":
+                parts.append("ip:%s" % remote_addr())
+            elif item == "route":
+                parts.append(route_rule())
+            elif item == "path":
+                parts.append(request.path)
+        return "|".join(parts)
+
+    def on_request(self, context):
+        wait = self.store.take(self.key(), self.rate, self.burst)
+        if wait:
+            if self.metrics:
+                self.metrics.inc("py4web_rate_limited_total", route=route_rule())
+            # read the body, else the server parses it as the next request
+            # of a keep-alive connection
+            request.body
+            raise HTTP(
+                429,
+                "Too Many Requests",
+                headers={"Retry-After": str(int(math.ceil(wait)))},
+            )
+
+
+def remote_addr():
+    return request.remote_addr or "unknown"
@@ -0,0 +1,251 @@
+"""
+Optional read-replica routing for the DAL defined in common.py
+
+When settings.DB_READ_URIS is not empty, common.py wraps the primary DAL
+in a ReplicaRouter. Tables are defined on the primary and on every replica
+(those defined on the primary directly, like the ones of pydal's Tags, are
+mirrored on the next request), GET/HEAD/OPTIONS requests read from a
+replica (round robin) and any other request goes to the primary. After a
+write the client is pinned to the primary for settings.DB_STICKY_SECONDS
+so it can read its own writes.
+
+To try it locally with SQLite file copies acting as replicas:
+
+    DB_READ_URIS = ["sqlite://replica1.db", "sqlite://replica2.db"]
+
+the copies are made from storage.db by db.sync_sqlite_replicas(), called
+explicitly (e.g. by a test after its writes, or from the py4web shell):
+the requests never copy, they read whatever the replicas hold, as they
+would from replicas that lag. Every copy is a full backup, this mode is
+meant for tests and local development only.
+"""
+import itertools
+import sqlite3
+import threading
+import time
+
+from py4web import DAL, Field, request, response
+from py4web.core import Fixture
+from pydal.helpers.classes import ExecutionHandler
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def unbound(fields):
+    """Clones the fields already bound to the primary so replicas can bind them"""
+    clones = []
+    for item in fields:
+        if isinstance(item, Field):
+            item = item.clone()
+        elif isinstance(item, (list, tuple)):
+            item = [field.clone() for field in item]
+        clones.append(item)
+    return clones
+
+
+class ConnectionStats:
+    """Thread safe query counters and cumulative latency per connection"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+    def handler(self, name):
+        """Returns a pydal ExecutionHandler class that reports to this object"""
+        stats = self
+
+        class StatsHandler(ExecutionHandler):
+            def before_execute(self, command):
+                self.t0 = time.perf_counter()
+
+            def after_execute(self, command):
+                stats.add(name, time.perf_counter() - self.t0)
+
+        return StatsHandler
+
+    def add(self, name, seconds):
+        with self.lock:
+            item = self.data.setdefault(name, [0, 0.0])
+            item[0] += 1
+            item[1] += seconds
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                name: {
+                    "queries": count,
+                    "seconds": round(seconds, 6),
+                    "avg_ms": round(1000.0 * seconds / count, 3) if count else 0.0,
+                }
+                for name, (count, seconds) in self.data.items()
+            }
+
+
+class ReplicaRouter(Fixture):
+    """
+    A drop-in replacement for the db object that routes every request either
+    to the primary DAL or to one of the read replicas
+    """
+
+    def __init__(
+        self,
+        primary,
+        read_uris,
+        sticky_seconds=5,
+        primary_routes=("auth/",),
+        cookie_name="db_primary_until",
+    ):
+        self.primary = primary
+        self.replicas = [
+            DAL(
+                uri,
+                folder=primary._folder,
+                pool_size=primary._pool_size,
+                migrate=False,
+                fake_migrate=False,
+            )
+            for uri in read_uris
+        ]
+        self.sticky_seconds = sticky_seconds
+        self.primary_routes = tuple(primary_routes)
+        self.cookie_name = cookie_name
+        self.counter = itertools.count()
+        self.sqlite_replicas = [
+            replica
+            for replica in self.replicas
+            if replica._adapter.dbengine == "sqlite"
+            and primary._adapter.dbengine == "sqlite"
+        ]
+        self.mirrored = 0
+        self.lock = threading.Lock()
+        self.connection_stats = ConnectionStats()
+        self._instrument(self.primary, "primary")
+        for k, replica in enumerate(self.replicas):
+            self._instrument(replica, "replica%i" % (k + 1))
+
+    def _instrument(self, db, name):
+        db._adapter.execution_handlers.append(self.connection_stats.handler(name))
+
+    # #######################################################
+    # delegate the DAL API to the connection used by this request
+    # #######################################################
+
+    @property
+    def current(self):
+        """The DAL serving the current request (the primary outside requests)"""
+        if self.is_valid():
+            return self.local.db
+        return self.primary
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.current, name)
+
+    def __getitem__(self, name):
+        return self.current[name]
+
+    def __contains__(self, name):
+        return name in self.current
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __call__(self, *args, **kwargs):
+        return self.current(*args, **kwargs)
+
+    def define_table(self, tablename, *fields, **kwargs):
+        """Defines the table on the primary and mirrors it on every replica"""
+        table = self.primary.define_table(tablename, *fields, **kwargs)
+        kwargs["migrate"] = False
+        kwargs.pop("fake_migrate", None)
+        with self.lock:
+            for replica in self.replicas:
+                replica.define_table(tablename, *unbound(fields), **kwargs)
+        return table
+
+    def mirror_tables(self):
+        """Mirrors the tables defined on the primary directly (Tags uses table._db)"""
+        with self.lock:
+            for tablename in self.primary.tables:
+                table = self.primary[tablename]
+                for replica in self.replicas:
+                    if tablename not in replica.tables:
+                        replica.define_table(
+                            tablename,
+                            *[field.clone() for field in table],
+                            format=table._format,
+                            migrate=False,
+                        )
+            self.mirrored = len(self.primary.tables)
+
+    # #######################################################
+    # routing logic
+    # #######################################################
+
+    def use_primary(self):
+        """True if the current request must be served by the primary"""
+        if not self.replicas or request.method not in SAFE_METHODS:
+            return True
+        route = request.path.lstrip("/").split("/", 1)[-1]
+        if route.startswith(self.primary_routes):
+            return True
+        try:
+            return float(request.get_cookie(self.cookie_name) or 0) > time.time()
+        except ValueError:
+            return False
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        if self.mirrored != len(self.primary.tables):
+            self.mirror_tables()
+        self.primary.on_request(context)
+        if self.use_primary():
+            self.local.db = self.primary
+        else:
+            replica = self.replicas[next(self.counter) % len(self.replicas)]
+            replica.on_request(context)
+            self.local.db = replica
+
+    def on_success(self, context):
+        db = self.local.db
+        if db is not self.primary:
+            db.on_success(context)
+        elif request.method not in SAFE_METHODS and self.sticky_seconds:
+            # read-your-writes: pin this client to the primary for a while
+            response.set_cookie(
+                self.cookie_name,
+                str(time.time() + self.sticky_seconds),
+                path="/",
+                max_age=int(self.sticky_seconds) + 1,
+            )
+        self.primary.on_success(context)
+        Fixture.local_delete(self)
+
+    def on_error(self, context):
+        db = self.local.db
+        if db is not self.primary:
+            db.on_error(context)
+        self.primary.on_error(context)
+        Fixture.local_delete(self)
+
+    # #######################################################
+    # monitoring and local testing helpers
+    # #######################################################
+
+    def stats(self):
+        """Returns per-connection query counts and latencies"""
+        return self.connection_stats.as_dict()
+
+    def sync_sqlite_replicas(self):
+        """Copies the primary SQLite file onto the SQLite replicas (for testing)"""
+        with self.lock:
+            for replica in self.sqlite_replicas:
+                source = sqlite3.connect(self.primary._adapter.dbpath)
+                target = sqlite3.connect(replica._adapter.dbpath)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                    source.close()
+
@@ -0,0 +1,86 @@
+"""
+Migrations only when the schema changes (settings.DB_SCHEMA_FINGERPRINT)
+
+    db = DAL(uri, folder=folder, migrate=False)
+    ... define all the tables (auth, models) ...
+    migrate_on_change(db, folder)
+
+With migrate=False defining the tables does not touch the database nor the
+.table files. migrate_on_change() then hashes the schema (every table with
+the name, type and constraints of its fields) and compares the hash with
+the one stored in the folder by the last migration. When they match, which
+is every boot but the first after a change of the models, it returns at
+once. Otherwise it takes a file lock, so that of the workers booting
+together only one migrates (the others wait and then find the new hash),
+runs the usual pydal migration of every table and stores the new hash.
+"""
+import hashlib
+import os
+
+import pydal
+from pydal.contrib import portalocker
+
+
+def fingerprint(db):
+    """A hash of the schema of the tables defined in db"""
+    digest = hashlib.sha1()
+    digest.update(("%s %s %s" % (pydal.__version__, db._dbname, db._uri_hash)).encode())
+    for tablename in sorted(db.tables):
+        table = db[tablename]
+        digest.update(("\ntable %s %s" % (tablename, table._rname)).encode())
+        for field in table:
+            ftype = getattr(field.type, "native", None) or getattr(
+                field.type, "type", field.type
+            )
+            default = None if callable(field.default) else field.default
+            item = (
+                field.name,
+                field._rname,
+                ftype,
+                field.length,
+                field.notnull,
+                field.unique,
+                field.ondelete,
+                default,
+            )
+            digest.update(("\n%r" % (item,)).encode())
+    return digest.hexdigest()
+
+
+def migrate_on_change(db, folder, fake_migrate=False, logger=None, name="schema"):
+    """
+    Migrates the tables of db if the schema changed, returns whether it did.
+    Each DAL on the same database (e.g. the one of the job queue) needs a
+    name of its own, the fingerprints are stored per database and name
+    """
+    filename = os.path.join(folder, "%s_%s.fingerprint" % (db._uri_hash, name))
+    current = fingerprint(db)
+    if read(filename) == current:
+        return False
+    with open(filename + ".lock", "a") as lock:
+        portalocker.lock(lock, portalocker.LOCK_EX)
+        try:
+            # another process may have migrated while this one waited
+            if read(filename) == current:
+                return False
+            if logger:
+                logger.warning("the schema %s changed, migrating", name)
+            for tablename in db.tables:
+                db._adapter.create_table(
+                    db[tablename], migrate=True, fake_migrate=fake_migrate
+                )
+            db.commit()
+            with open(filename + ".tmp", "w") as stream:
+                stream.write(current)
+            os.replace(filename + ".tmp", filename)
+        finally:
+            portalocker.unlock(lock)
+    return True
+
+
+def read(filename):
+    try:
+        with open(filename) as stream:
+            return stream.read()
+    except FileNotFoundError:
+        return None
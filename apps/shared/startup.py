@@ -0,0 +1,83 @@
+"""
+Startup profile of the app (settings.STARTUP_PROFILE)
+
+    startup = StartupProfiler(settings.STARTUP_PROFILE)
+    ...
+    startup.mark("connect to db")
+    ...
+    startup.report(logger)
+
+mark(name) records the time since the previous mark (or since the profiler
+was created) as the step name, so the sections of common.py and models.py
+are timed by marking their end. While profiling, the modules imported for
+the first time are timed too, each with the modules it imports in turn: the
+import hook is only installed when enabled. report() logs the steps in order
+and the slowest imports at INFO (a diagnostic, the default LOGGERS do not
+show it) and stops timing the imports, call it in a finally so that the
+hook is removed even if the app fails to load (a profiler created by the
+next load also removes the hook of one that was never reported). When
+disabled every method is a no-op and imports run untouched.
+"""
+import builtins
+import sys
+import threading
+import time
+
+
+class StartupProfiler:
+    def __init__(self, enabled=True, top=15):
+        self.enabled = enabled
+        self.top = top
+        self.steps = []
+        self.imports = []
+        self.started = self.last = time.perf_counter()
+        self.local = threading.local()
+        self._import = None
+        if enabled:
+            self._import = builtins.__import__
+            previous = getattr(self._import, "__self__", None)
+            if isinstance(previous, StartupProfiler):
+                self._import = previous._import
+            builtins.__import__ = self._timed_import
+
+    def mark(self, name):
+        """Ends the step name, it started at the previous mark"""
+        if self.enabled:
+            now = time.perf_counter()
+            self.steps.append((name, now - self.last))
+            self.last = now
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        fullname = name
+        if level and globals:
+            package = globals.get("__package__") or ""
+            package = package.rsplit(".", level - 1)[0] if level > 1 else package
+            fullname = package + "." + name if name else package
+        depth = getattr(self.local, "depth", 0)
+        if depth or fullname in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        # only the outermost new import, it includes the ones it triggers
+        self.local.depth = 1
+        t0 = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self.local.depth = 0
+            self.imports.append((fullname, time.perf_counter() - t0))
+
+    def report(self, logger):
+        """Logs the profile and stops timing the imports"""
+        if not self.enabled:
+            return
+        self.stop()
+        lines = ["startup took %.1f ms" % (1000 * (self.last - self.started))]
+        lines += ["  step   %8.1f ms  %s" % (1000 * t, name) for name, t in self.steps]
+        slowest = sorted(self.imports, key=lambda item: -item[1])[: self.top]
+        lines += ["  import %8.1f ms  %s" % (1000 * t, name) for name, t in slowest]
+        logger.info("\n".join(lines))
+        self.enabled = False
+
+    def stop(self):
+        """Stops timing the imports"""
+        if builtins.__import__ == self._timed_import:
+            builtins.__import__ = self._import
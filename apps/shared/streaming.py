@@ -0,0 +1,182 @@
+"""
+Streams uploaded files, used by the download action in common.py
+
+Unlike py4web.utils.downloader it does not need the db fixture: the table
+metadata is enough to find a file on disk, a connection is borrowed only by
+the fields that read the db (authorize, blobs) and never held while the body
+is sent. It supports HEAD, single Range requests (and If-Range),
+ETag/If-None-Match and sends long-lived cache headers for the pydal upload
+names, which embed a uuid and therefore never change content.
+Full bodies go through wsgi.file_wrapper (sendfile where the server has it),
+ranges are read in chunks.
+"""
+import email.utils
+import mimetypes
+import os
+import re
+import tempfile
+from urllib.parse import quote
+
+from py4web import HTTP, request
+from py4web.core import bottle
+from pydal.exceptions import NotAuthorizedException, NotFoundException
+from pydal.helpers.regex import REGEX_UPLOAD_PATTERN
+
+CHUNK_SIZE = 256 * 1024
+IMMUTABLE = "public, max-age=31536000, immutable"
+REGEX_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def stream_upload(db, path, filename, chunk_size=CHUNK_SIZE):
+    """Raises the HTTP response that streams the uploaded file filename"""
+    items = re.match(REGEX_UPLOAD_PATTERN, filename)
+    if not items:
+        raise HTTP(404)
+    try:
+        field = db[items.group("table")][items.group("field")]
+    except (AttributeError, KeyError):
+        raise HTTP(404)
+    path = field.uploadfolder or path
+    if field.uploadseparate:
+        folder = "%s.%s" % (field.tablename, field.name)
+        path = os.path.join(path, folder, items.group("uuidkey")[:2])
+    fullpath = os.path.abspath(os.path.join(path, filename))
+    if not fullpath.startswith(os.path.abspath(path) + os.sep):
+        raise HTTP(403)
+    original_name = retrieve(db, field, filename, path, fullpath)
+    download = original_name if request.query.get("attachment") else None
+    stream_file(fullpath, download=download, chunk_size=chunk_size)
+
+
+def retrieve(db, field, filename, path, fullpath):
+    """Returns the original name of the upload, checks field.authorize
+
+    Files stored in a blob are copied once to disk, then streamed from there.
+    """
+    uses_db = field.authorize or field.custom_retrieve or field.uploadfield is not True
+    if uses_db:
+        db = getattr(db, "primary", db)
+        db.get_connection_from_pool_or_new()
+    # committed only if the file was found and authorized
+    action = "rollback"
+    try:
+        original_name, stream = field.retrieve(filename, path, nameonly=True)
+        if not os.path.isfile(fullpath):
+            if not hasattr(stream, "read"):
+                raise HTTP(404)
+            os.makedirs(path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path)
+            with stream, os.fdopen(fd, "wb") as target:
+                target.write(stream.read())
+            os.replace(tmp, fullpath)
+        elif hasattr(stream, "close"):
+            stream.close()
+        action = "commit"
+        return original_name
+    except NotAuthorizedException:
+        raise HTTP(403)
+    except (NotFoundException, IOError):
+        raise HTTP(404)
+    finally:
+        if uses_db:
+            db.recycle_connection_in_pool_or_close(action)
+
+
+def stream_file(
+    fullpath,
+    download=None,
+    chunk_size=CHUNK_SIZE,
+    cache_control=IMMUTABLE,
+    headers=None,
+    content_encoding=None,
+):
+    """
+    Raises the HTTP response (200, 206, 304, 416) for the file at fullpath.
+    content_encoding is the one of a file compressed by the build step (the
+    Content-Type is then the one of the uncompressed file), any other file
+    is sent as it is: an upload named *.gz is not decompressed by the client
+    """
+    stat = os.stat(fullpath)
+    size = stat.st_size
+    etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+    headers = dict(headers or {})
+    headers.update(
+        {
+            "ETag": etag,
+            "Last-Modified": email.utils.formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": cache_control,
+            "Accept-Ranges": "bytes",
+        }
+    )
+    mimetype, encoding = mimetypes.guess_type(fullpath)
+    if encoding and not content_encoding:
+        mimetype = None
+    headers["Content-Type"] = mimetype or "application/octet-stream"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    if download:
+        headers["Content-Disposition"] = "attachment; filename*=UTF-8''%s" % quote(
+            download
+        )
+
+    if etag_matches(request.headers.get("If-None-Match", ""), etag):
+        raise bottle.HTTPResponse(status=304, **headers)
+
+    status, offset, length = 200, 0, size
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    if range_header and (not if_range or if_range == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            headers["Content-Range"] = "bytes */%i" % size
+            raise bottle.HTTPResponse(status=416, **headers)
+        offset, end = byte_range
+        status, length = 206, end - offset
+        headers["Content-Range"] = "bytes %i-%i/%i" % (offset, end - 1, size)
+    headers["Content-Length"] = str(length)
+
+    if request.method == "HEAD":
+        raise bottle.HTTPResponse("", status=status, **headers)
+    stream = open(fullpath, "rb")
+    if status == 200:
+        # the server can use sendfile through wsgi.file_wrapper
+        body = stream
+    else:
+        body = iter_range(stream, offset, length, chunk_size)
+    raise bottle.HTTPResponse(body, status=status, **headers)
+
+
+def etag_matches(header, etag):
+    """True if the If-None-Match header lists etag (weak comparison) or is *"""
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in [tag[2:] if tag[:2] == "W/" else tag for tag in tags]
+
+
+def parse_range(header, size):
+    """Returns (start, end) of a single byte range, end excluded, or None"""
+    match = REGEX_RANGE.match(header.strip())
+    if not match or not size:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        start, end = max(0, size - int(end)), size
+    else:
+        start = int(start)
+        end = min(int(end) + 1, size) if end else size
+    if start >= end:
+        return None
+    return start, end
+
+
+def iter_range(stream, offset, length, chunk_size):
+    """Yields length bytes from offset in chunks, then closes the file"""
+    with stream:
+        stream.seek(offset)
+        while length > 0:
+            data = stream.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
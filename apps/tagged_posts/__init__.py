@@ -3,11 +3,22 @@ import py4web
 
 assert py4web.check_compatible("0.1.20190709.1")
 
-# by importing db you expose it to the _dashboard/dbadmin
-from .models import db
+from .common import logger, startup
 
-# by importing controllers you expose the actions defined in it
-from . import controllers
+try:
+    # by importing db you expose it to the _dashboard/dbadmin
+    from .models import db
+
+    startup.mark("models")
+
+    # by importing controllers you expose the actions defined in it
+    from . import controllers
+
+    startup.mark("controllers")
+finally:
+    # log the startup profile, if settings.STARTUP_PROFILE (see startup.py),
+    # its import hook is removed even if the app fails to load
+    startup.report(logger)
 
 # optional parameters
 __version__ = "0.0.0"
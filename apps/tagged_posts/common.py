@@ -5,13 +5,26 @@ These are fixtures that every app needs so probably you will not be editing this
 import os
 import sys
 import logging
-from py4web import Session, Cache, Translator, Flash, DAL, Field, action
-from py4web.utils.mailer import Mailer
+from . import settings
+from ..shared.startup import StartupProfiler
+
+# times the loading of the app, reported by __init__.py (see startup.py)
+startup = StartupProfiler(settings.STARTUP_PROFILE)
+
+from py4web import Session, Cache, Flash, DAL, Field, action, response
 from py4web.utils.auth import Auth
-from py4web.utils.downloader import downloader
 from pydal.tools.tags import Tags
 from py4web.utils.factories import ActionFactory
-from . import settings
+from ..shared.assets import Assets
+from ..shared.catalogs import CatalogTranslator
+from ..shared.concurrency import ConcurrencyLimit
+from .jobs import JobQueue
+from ..shared.log_pipeline import LogPipeline, make_handler
+from ..shared.metrics import Metrics, MeteredCache, MeteredStore, authorize_scrape
+from ..shared.profiler import QueryProfiler
+from ..shared.ratelimit import RateLimiter, MemoryStore
+
+startup.mark("imports")
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -20,32 +33,85 @@ logger = logging.getLogger("py4web:" + settings.APP_NAME)
 formatter = logging.Formatter(
     "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s"
 )
-for item in settings.LOGGERS:
-    level, filename = item.split(":", 1)
-    if filename in ("stdout", "stderr"):
-        handler = logging.StreamHandler(getattr(sys, filename))
-    else:
-        handler = logging.FileHandler(filename)
-    handler.setFormatter(formatter)
-    logger.setLevel(getattr(logging, level.upper(), "DEBUG"))
-    logger.addHandler(handler)
+handlers = [
+    make_handler(
+        item,
+        formatter,
+        max_bytes=settings.LOG_MAX_BYTES,
+        max_seconds=settings.LOG_MAX_SECONDS,
+        backup_count=settings.LOG_BACKUP_COUNT,
+    )
+    for item in settings.LOGGERS
+]
+# each handler filters by its own level, the logger lets all of them through
+logger.setLevel(min([handler.level for handler in handlers] or [logging.WARNING]))
+# on app reload, close the handlers (and the writer thread) of the previous load
+for handler in list(logger.handlers):
+    logger.removeHandler(handler)
+    handler.close()
+if settings.LOG_QUEUE_SIZE:
+    log_pipeline = LogPipeline(handlers, queue_size=settings.LOG_QUEUE_SIZE)
+    log_pipeline.start()
+    logger.addHandler(log_pipeline.handler)
+else:
+    for handler in handlers:
+        logger.addHandler(handler)
+startup.mark("loggers")
 
 # #######################################################
 # connect to db
 # #######################################################
+# with DB_SCHEMA_FINGERPRINT models.py migrates, only if the schema changed
 db = DAL(
     settings.DB_URI,
     folder=settings.DB_FOLDER,
     pool_size=settings.DB_POOL_SIZE,
-    migrate=settings.DB_MIGRATE,
+    migrate=settings.DB_MIGRATE and not settings.DB_SCHEMA_FINGERPRINT,
     fake_migrate=settings.DB_FAKE_MIGRATE,
 )
 
+# #######################################################
+# optionally route safe requests to read replicas
+# #######################################################
+if settings.DB_READ_URIS:
+    from ..shared.replicas import ReplicaRouter
+
+    db = ReplicaRouter(
+        db,
+        settings.DB_READ_URIS,
+        sticky_seconds=settings.DB_STICKY_SECONDS,
+        cookie_name="%s_db_primary_until" % settings.APP_NAME,
+    )
+startup.mark("connect to db")
+
+# #######################################################
+# collect metrics, use @action.uses(metrics, ...) to time an action
+# #######################################################
+metrics = Metrics(settings.APP_NAME, multiprocess_dir=settings.METRICS_MULTIPROCESS_DIR)
+metrics.instrument_db(getattr(db, "primary", db), "primary")
+for k, replica in enumerate(getattr(db, "replicas", [])):
+    metrics.instrument_db(replica, "replica%i" % (k + 1))
+
 # #######################################################
 # define global objects that may or may not be used by the actions
 # #######################################################
-cache = Cache(size=1000)
-T = Translator(settings.T_FOLDER)
+cache = MeteredCache(metrics, size=1000)
+# catalogs compiled once and translations memoized, see catalogs.py
+T = CatalogTranslator(settings.T_FOLDER, cache_folder=settings.T_CACHE_FOLDER)
+# to profile the queries of an action: @action.uses(profiler, "page.html", ...)
+profiler = QueryProfiler(
+    db,
+    logger,
+    settings.APP_FOLDER,
+    slow_ms=settings.QUERY_SLOW_MS,
+    repeats=settings.QUERY_REPEATS,
+)
+# injects asset('js/utils.js') in the templates, see assets.py for the build step
+assets = Assets(settings.ASSETS_FOLDER)
+# at most DB_CONCURRENCY requests of the JSON API use the db at once, see concurrency.py
+db_limit = ConcurrencyLimit(
+    settings.DB_CONCURRENCY, timeout=settings.DB_CONCURRENCY_TIMEOUT, metrics=metrics
+)
 
 # #######################################################
 # pick the session type that suits you best
@@ -63,16 +129,38 @@ elif settings.SESSION_TYPE == "redis":
         if ct(k) >= 0
         else cs(k, v, e)
     )
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    storage = MeteredStore(conn, metrics, "redis")
+    session = Session(secret=settings.SESSION_SECRET_KEY, storage=storage)
 elif settings.SESSION_TYPE == "memcache":
     import memcache, time
 
     conn = memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    storage = MeteredStore(conn, metrics, "memcache")
+    session = Session(secret=settings.SESSION_SECRET_KEY, storage=storage)
 elif settings.SESSION_TYPE == "database":
     from py4web.utils.dbstore import DBStore
 
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
+    # sessions are written on every request so they must use the primary
+    storage = MeteredStore(DBStore(getattr(db, "primary", db)), metrics, "database")
+    session = Session(secret=settings.SESSION_SECRET_KEY, storage=storage)
+startup.mark("fixtures and session")
+
+# #######################################################
+# Rate limits for the write actions, checked before auth and db
+# #######################################################
+if settings.RATE_LIMIT_STORE:
+    from ..shared.ratelimit import SQLiteStore
+
+    rate_limit_store = SQLiteStore(os.path.join(settings.DB_FOLDER, settings.RATE_LIMIT_STORE))
+else:
+    rate_limit_store = MemoryStore()
+write_limit = RateLimiter(
+    *settings.RATE_LIMIT_WRITES,
+    per=("user", "route"),
+    session=session,
+    store=rate_limit_store,
+    metrics=metrics,
+)
 
 # #######################################################
 # Instantiate the object and actions that handle auth
@@ -89,6 +177,7 @@ auth.param.block_previous_password_num = 3
 auth.param.default_login_enabled = settings.DEFAULT_LOGIN_ENABLED
 auth.define_tables()
 auth.fix_actions()
+startup.mark("auth tables")
 
 flash = auth.flash
 
@@ -96,6 +185,8 @@ flash = auth.flash
 # Configure email sender for auth
 # #######################################################
 if settings.SMTP_SERVER:
+    from py4web.utils.mailer import Mailer
+
     auth.sender = Mailer(
         server=settings.SMTP_SERVER,
         sender=settings.SMTP_SENDER,
@@ -177,42 +268,83 @@ if settings.OAUTH2OKTA_CLIENT_ID:
             callback_url="auth/plugin/oauth2okta/callback",
         )
     )
+startup.mark("auth plugins")
 
 # #######################################################
 # Define a convenience action to allow users to download
 # files uploaded and reference by Field(type='upload')
 # #######################################################
 if settings.UPLOAD_FOLDER:
+    from ..shared.streaming import stream_upload
+
     @action('download/<filename>')
-    @action.uses(db)
+    @action.uses(metrics)
     def download(filename):
-        return downloader(db, settings.UPLOAD_FOLDER, filename)
+        # no db fixture, stream_upload borrows a connection if the field needs one
+        return stream_upload(db, settings.UPLOAD_FOLDER, filename)
     # To take advantage of this in Form(s)
     # for every field of type upload you MUST specify:
     #
     # field.upload_path = settings.UPLOAD_FOLDER
     # field.download_url = lambda filename: URL('download/%s' % filename)
+    #
+    # Responses support Range requests and are cached by the browser,
+    # append ?attachment=1 to the url to download with the original name.
 
 # #######################################################
-# Optionally configure celery
+# Serve the built assets with immutable cache headers
 # #######################################################
-if settings.USE_CELERY:
-    from celery import Celery
+@action("assets/<path:path>")
+@action.uses(metrics)
+def assets_file(path):
+    return assets.serve(path)
 
-    # to use "from .common import scheduler" and then use it according
-    # to celery docs, examples in tasks.py
-    scheduler = Celery(
-        "apps.%s.tasks" % settings.APP_NAME, broker=settings.CELERY_BROKER
-    )
+# #######################################################
+# Expose query counts and latencies of the db connections
+# #######################################################
+if settings.DB_READ_URIS:
+    @action("db/stats")
+    @action.uses(metrics, auth.user)
+    def db_stats():
+        return db.stats()
+
+# #######################################################
+# Expose the metrics in the Prometheus text format
+# #######################################################
+@action("metrics")
+def metrics_page():
+    authorize_scrape(settings.METRICS_TOKEN)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
+
+# #######################################################
+# Local job queue, the database is the broker (see jobs.py)
+# #######################################################
+# to use "from .common import jobs", tasks are defined in tasks.py,
+# it connects to JOBS_DB_URI when a job is first enqueued (or run)
+jobs = JobQueue(
+    settings.JOBS_DB_URI or settings.DB_URI,
+    settings.DB_FOLDER,
+    app_db=getattr(db, "primary", db),
+    logger=logger,
+    metrics=metrics,
+    visibility_timeout=settings.JOBS_VISIBILITY_TIMEOUT,
+    retries=settings.JOBS_RETRIES,
+    backoff=settings.JOBS_BACKOFF,
+    schema_fingerprint=settings.DB_SCHEMA_FINGERPRINT,
+    keep=settings.JOBS_KEEP_SECONDS,
+)
+startup.mark("job queue")
 
 
 # #######################################################
 # Enable authentication
 # #######################################################
-auth.enable(uses=(session, T, db), env=dict(T=T))
+auth.enable(uses=(metrics, assets, session, T, db), env=dict(T=T))
 
 # #######################################################
 # Define convenience decorators
 # #######################################################
-unauthenticated = ActionFactory(db, session, T, flash, auth)
-authenticated = ActionFactory(db, session, T, flash, auth.user)
+unauthenticated = ActionFactory(metrics, assets, db, session, T, flash, auth)
+authenticated = ActionFactory(metrics, assets, db, session, T, flash, auth.user)
+startup.mark("auth actions")
@@ -1,54 +1,267 @@
-from py4web import action, request
-from .common import auth
-from .models import db, parse_post_content
+import datetime
+import itertools
+import json
+from py4web import action, request, HTTP
+from .common import auth, profiler, metrics, assets, db_limit, settings, write_limit
+from .models import db, parse_post_content, REGEX_TAG, authors
+from ..shared.compact import column, compact_json, requested_layout, select_compact
+from ..shared.export import export
 
 @action("index")
-@action.uses("index.html", auth.user)
+@action.uses(metrics, assets, "index.html", auth.user)
 def index():
     return dict(message="hello world")
 
-@action("api/tags", method="GET")
-@action.uses(auth.user)
-def get_api_tags():
-    """retrieve known tags"""
+def select_tags():
     rows = db(db.tag_item).select(
         db.tag_item.name,
         orderby=db.tag_item.name,
         groupby=db.tag_item.name)
     return {"tags": [row.name for row in rows]}
 
-@action("api/posts", method="GET")
-@action.uses(auth.user)
-def get_api_posts():
-    """retrieve posts and users metadata"""
-    if "tags" in request.query:
-        tags = request.query.get("tags").split(",")
-        query = (db.post_item.id==db.tag_item.post_item_id)&(db.tag_item.name.belongs(tags))
+@action("api/tags", method="GET")
+@action.uses(metrics, db_limit, auth.user)
+def get_api_tags():
+    """retrieve known tags"""
+    return select_tags()
+
+def select_posts(tags=None, layout="records"):
+    if tags is not None:
+        query = (db.post_item.id==db.tag_item.post_item_id)&(db.tag_item.name.belongs(tags.split(",")))
     else:
         query = db.post_item
-    # get selected posts
-    rows = db(query).select(
-        db.post_item.ALL,
+    # get selected posts, as plain records (or columns), see compact.py
+    posts = select_compact(
+        db(query),
+        list(db.post_item),
+        layout,
         groupby=db.post_item.id,
         orderby=~db.post_item.created_on,
         limitby=(0,100))
     # get usernames for authors of those posts
-    users = {
-        user.id: user.username for user in
-        db(db.auth_user.id.belongs(row.created_by for row in rows)).select()}
-    return {"posts": rows.as_list(), "users": users}
+    created_by = column(posts, "created_by")
+    users = {}
+    if authors:
+        users = {
+            user_id: username
+            for user_id, username in zip(created_by, column(posts, "author_username"))
+            if username is not None}
+    # the posts without copies (not denormalized, or not backfilled yet)
+    missing = set(created_by) - set(users)
+    if missing:
+        users.update(
+            (user.id, user.username) for user in
+            db(db.auth_user.id.belongs(missing)).select(
+                db.auth_user.id, db.auth_user.username))
+    return {"posts": posts, "users": users}
+
+@action("api/posts", method="GET")
+@action.uses(metrics, db_limit, profiler, auth.user)
+def get_api_posts():
+    """retrieve posts and users metadata, ?layout=columns for column arrays"""
+    return compact_json(select_posts(request.query.get("tags"), requested_layout()))
+
+def insert_post(content, user_id, read_your_writes=False):
+    # the signature fields are not writable, validate the content only
+    fields, errors = validate_post({"content": content})
+    post_item_id = fields and db.post_item.insert(
+        content=fields["content"], created_by=user_id, modified_by=user_id)
+    res = {"id": post_item_id, "errors": errors, "success": post_item_id is not None}
+    if res["id"]:
+        if read_your_writes or not settings.BACKGROUND_INDEXING:
+            parse_post_content(content, res["id"])
+        else:
+            # the index_posts task extracts the tags in batches
+            db.post_index_queue.insert(post_item_id=res["id"])
+    return res
 
 @action("api/posts", method="POST")
-@action.uses(auth.user)
+@action.uses(metrics, write_limit, db_limit, auth.user)
 def post_api_posts():
-    """submit a new post"""
-    content = request.json.get("content")
-    res = db.post_item.validate_and_insert(content=content)
-    if res["id"]: parse_post_content(content, res["id"])
-    return res
+    """submit a new post, {"read_your_writes": true} indexes its tags right away"""
+    return insert_post(
+        request.json.get("content"),
+        auth.user_id,
+        read_your_writes=bool(request.json.get("read_your_writes")))
+
+def validate_post(item):
+    """returns (fields, errors) for one item of a bulk import"""
+    if not isinstance(item, dict):
+        return None, {"item": "must be an object"}
+    content, error = db.post_item.content.validate(item.get("content"))
+    if error or not isinstance(content, str) or not content:
+        return None, {"content": error or "must be a non empty string"}
+    created_on = item.get("created_on")
+    if created_on is not None:
+        # historical posts keep their date
+        try:
+            created_on = datetime.datetime.fromisoformat(created_on)
+        except (TypeError, ValueError):
+            return None, {"created_on": "must be an ISO date and time"}
+        if created_on.tzinfo is not None:
+            # stored as naive UTC, like the dates of the other posts
+            created_on = created_on.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return {"content": content, "created_on": created_on}, {}
+
+def insert_posts(items, user_id=None, chunk_size=None, read_your_writes=False):
+    """
+    bulk import of items ({"content": ..., "created_on": optional ISO date}),
+    committed every chunk_size items, returns one {"id", "errors"} per item
+    """
+    chunk_size = chunk_size or settings.BULK_CHUNK_SIZE
+    index_now = read_your_writes or not settings.BACKGROUND_INDEXING
+    results, items = [], iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return results
+        validated = [validate_post(item) for item in chunk]
+        posts = [fields for fields, errors in validated if fields]
+        ids = bulk_insert_posts(posts, user_id, index_now)
+        if ids is None:
+            # refused by a _before_insert callback, nothing of the chunk is kept
+            db.rollback()
+            results.extend(
+                {"id": None, "errors": errors or {"item": "refused"}}
+                for fields, errors in validated)
+            continue
+        ids = iter(ids)
+        results.extend(
+            {"id": next(ids) if fields else None, "errors": errors}
+            for fields, errors in validated)
+        db.commit()
+
+def sql_value(field, value):
+    """value as the adapter stores it in field, for a query parameter"""
+    if callable(value):
+        value = value()
+    if value is None:
+        return None
+    if field.type == "boolean":
+        return "T" if value else "F"
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")[:19]
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+def insert_many(table, items):
+    """
+    inserts the items (dicts of field values) like Table.bulk_insert, with
+    the defaults and the _before_insert/_after_insert callbacks, but on sqlite
+    as a single executemany instead of one INSERT per item. Returns their ids,
+    None if a _before_insert callback refused them (then nothing is inserted)
+    """
+    if not items:
+        return []
+    adapter = table._db._adapter
+    if adapter.dbengine != "sqlite":
+        # the ids of the rows of an executemany are only known on sqlite
+        return table.bulk_insert(items) or None
+    rows = [table._fields_and_values_for_insert(item) for item in items]
+    if any(f(row) for row in rows for f in table._before_insert):
+        return None
+    fields = [field for field, value in rows[0].op_values()]
+    command = "INSERT INTO %s (%s) VALUES (%s);" % (
+        table._rname,
+        ", ".join(field._rname for field in fields),
+        ", ".join(["?"] * len(fields)))
+    # the execution handlers (profiler, metrics) see one query
+    handlers = adapter._build_handlers_for_execution()
+    for handler in handlers:
+        handler.before_execute(command)
+    adapter.cursor.executemany(command, [
+        tuple(sql_value(field, row[field.name]) for field in fields) for row in rows])
+    for handler in handlers:
+        handler.after_execute(command)
+    # the transaction holds the write lock, the rows got consecutive ids
+    last_id = adapter.cursor.execute("SELECT last_insert_rowid();").fetchone()[0]
+    ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    for f in table._after_insert:
+        for row, row_id in zip(rows, ids):
+            f(row, row_id)
+    return ids
+
+def bulk_insert_posts(posts, user_id, index_now):
+    """
+    inserts the validated posts and their tags (or queue entries), returns
+    their ids, None if refused by a _before_insert callback
+    """
+    if not posts:
+        return []
+    now = datetime.datetime.utcnow()
+    ids = insert_many(db.post_item, [
+        dict(content=post["content"],
+             created_on=post["created_on"] or now,
+             modified_on=post["created_on"] or now,
+             created_by=user_id,
+             modified_by=user_id)
+        for post in posts])
+    if ids is None:
+        return None
+    if index_now:
+        done = insert_many(db.tag_item, [
+            dict(name=word[1:], post_item_id=post_id)
+            for post, post_id in zip(posts, ids)
+            for word in REGEX_TAG.findall(post["content"])])
+    else:
+        done = insert_many(db.post_index_queue, [dict(post_item_id=post_id) for post_id in ids])
+    return None if done is None else ids
+
+def read_posts():
+    """the items of the request body, a JSON array or NDJSON (one post per line)"""
+    if request.content_type.split(";")[0].strip() == "application/json":
+        # request.json stops at MEMFILE_MAX, imports can be much larger
+        try:
+            items = json.load(request.body)
+        except ValueError:
+            raise HTTP(400)
+        if not isinstance(items, list):
+            raise HTTP(400)
+        return items
+    return read_ndjson(request.body)
+
+def read_ndjson(stream):
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # reported as an invalid item
+                yield None
+
+@action("api/posts/bulk", method="POST")
+@action.uses(metrics, write_limit, db_limit, auth.user)
+def post_api_posts_bulk():
+    """import many posts (JSON array or NDJSON), returns the result of each"""
+    return {"results": insert_posts(
+        read_posts(),
+        auth.user_id,
+        read_your_writes=request.query.get("read_your_writes") == "true")}
 
 @action("api/posts/<post_item_id:int>", method="DELETE")
-@action.uses(auth.user)
+@action.uses(metrics, write_limit, db_limit, auth.user)
 def delete_api_posts(post_item_id):
     """delete a a post"""
     return {"deleted": db(db.post_item.id==post_item_id).delete()}
+
+def expand_tags(db, posts):
+    """adds the list of its tags to every post"""
+    tags = {}
+    rows = db(db.tag_item.post_item_id.belongs([post["id"] for post in posts])).select(
+        db.tag_item.post_item_id, db.tag_item.name, orderby=db.tag_item.id)
+    for row in rows:
+        tags.setdefault(row.post_item_id, []).append(row.name)
+    for post in posts:
+        post["tags"] = tags.get(post["id"], [])
+
+@action("export/posts", method="GET")
+@action.uses(metrics, auth.user)
+def export_posts():
+    """stream all posts with their tags (?format=ndjson|csv, resume with ?after=<id>)"""
+    export(
+        db,
+        db.post_item,
+        [db.post_item.id, db.post_item.content, db.post_item.created_on, db.post_item.created_by],
+        expand=expand_tags,
+        filename="posts")
@@ -0,0 +1,344 @@
+"""
+A local job queue that uses a database as the broker
+
+No redis, no celery: jobs are rows of the job table of JOBS_DB_URI (an
+SQLite file by default, or the app database). Tasks are defined in tasks.py
+
+    @jobs.task(retries=3)
+    def extract_tags(post_item_id):
+        ...
+
+    jobs.every(10, my_task)             # like celery beat_schedule
+    extract_tags.delay(post_item_id)    # enqueue from an action
+
+and run by worker processes, started with:
+
+    py4web call apps tagged_posts.jobs.worker --args '{"processes": 2, "beat": true}'
+
+Each worker keeps its connections open and commits (or rolls back) the app
+db after every job. A claimed job is invisible to the other workers for
+visibility_timeout seconds, a lease the worker renews while the job runs:
+when the worker dies the job is claimed again, or marked failed if that
+was its last attempt. A failing job is retried
+after backoff * 2 ** (attempt - 1) seconds and marked failed when it runs
+out of retries. The worker started with beat also deletes the jobs
+finished more than keep seconds ago, every hour.
+
+The queue connects to its database on first use, so the processes that
+only import it (the web servers) open nothing.
+"""
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+
+from pydal import DAL, Field
+
+from ..shared.schema import migrate_on_change
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobQueue:
+    def __init__(
+        self,
+        uri,
+        folder,
+        app_db=None,
+        logger=None,
+        metrics=None,
+        visibility_timeout=60,
+        retries=3,
+        backoff=2.0,
+        poll_interval=1.0,
+        schema_fingerprint=False,
+        keep=24 * 3600,
+    ):
+        self.uri = uri
+        self.folder = folder
+        self.app_db = app_db
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics
+        self.visibility_timeout = visibility_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.schema_fingerprint = schema_fingerprint
+        self.keep = keep
+        self.tasks = {}
+        self.schedules = {}
+        self.purged_at = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        """The DAL of the queue, connected (and migrated) on first use"""
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    self._db = self._connect()
+        return self._db
+
+    def _connect(self):
+        # a DAL of its own, so enqueuing commits independently of the action
+        # with schema_fingerprint it migrates only if the tables changed
+        db = DAL(
+            self.uri, folder=self.folder, pool_size=0, migrate=not self.schema_fingerprint
+        )
+        db.define_table(
+            "job",
+            Field("name"),
+            Field("args", "text"),
+            Field("status", default=QUEUED),
+            Field("attempts", "integer", default=0),
+            Field("max_attempts", "integer"),
+            Field("run_at", "double"),
+            Field("locked_until", "double"),
+            Field("last_error", "text"),
+            Field("created_at", "double"),
+            Field("finished_at", "double"),
+        )
+        db.define_table(
+            "job_schedule",
+            Field("name", unique=True),
+            Field("next_run", "double"),
+        )
+        if self.schema_fingerprint:
+            migrate_on_change(db, self.folder, logger=self.logger, name="jobs")
+        if db._adapter.dbengine in ("sqlite", "postgres"):
+            db.executesql(
+                "CREATE INDEX IF NOT EXISTS job_status_run_at ON job (status, run_at);"
+            )
+        db.commit()
+        return db
+
+    # #######################################################
+    # defining and enqueuing tasks
+    # #######################################################
+
+    def task(self, func=None, name=None, retries=None):
+        """Decorator that registers func as a task and adds func.delay()"""
+        if func is None:
+            return lambda func: self.task(func, name=name, retries=retries)
+        name = name or func.__name__
+        self.tasks[name] = (func, self.retries if retries is None else retries)
+        func.delay = lambda *args, **kwargs: self.enqueue(name, *args, **kwargs)
+        return func
+
+    def every(self, seconds, func, args=()):
+        """Enqueues func(*args) every seconds, from the workers started with --beat"""
+        name = getattr(func, "__name__", func)
+        self.schedules["%s%s" % (name, json.dumps(list(args)))] = (seconds, name, args)
+
+    def enqueue(self, name, *args, **kwargs):
+        """Queues the task name, kwargs delay=seconds postpones it"""
+        delay = kwargs.pop("delay", 0)
+        if name not in self.tasks:
+            raise KeyError("unknown task %s" % name)
+        now = time.time()
+        job_id = self.db.job.insert(
+            name=name,
+            args=json.dumps([args, kwargs]),
+            max_attempts=self.tasks[name][1] + 1,
+            run_at=now + delay,
+            created_at=now,
+        )
+        self.db.commit()
+        return job_id
+
+    # #######################################################
+    # running jobs
+    # #######################################################
+
+    def claim(self):
+        """Atomically marks the next due job as running and returns it"""
+        db, now = self.db, time.time()
+        expired = (db.job.status == RUNNING) & (db.job.locked_until < now)
+        # the worker died on the last attempt, the job is not run again
+        if db(expired & (db.job.attempts >= db.job.max_attempts)).update(
+            status=FAILED, finished_at=now, last_error="the lease expired"
+        ):
+            db.commit()
+        due = ((db.job.status == QUEUED) & (db.job.run_at <= now)) | (
+            expired & (db.job.attempts < db.job.max_attempts)
+        )
+        for job in db(due).select(orderby=db.job.run_at, limitby=(0, 5)):
+            claimed = db(
+                (db.job.id == job.id)
+                & (db.job.status == job.status)
+                & (db.job.attempts == job.attempts)
+            ).update(
+                status=RUNNING,
+                attempts=job.attempts + 1,
+                locked_until=now + self.visibility_timeout,
+            )
+            db.commit()
+            if claimed:
+                job.attempts += 1
+                return job
+        db.commit()
+        return None
+
+    def run_next(self):
+        """Runs the next due job, returns False if there was none"""
+        job = self.claim()
+        if job is None:
+            return False
+        t0 = time.perf_counter()
+        # renew the lease while the job runs, so no other worker claims it
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(job, done), daemon=True)
+        renewer.start()
+        try:
+            func = self.tasks[job.name][0]
+            args, kwargs = json.loads(job.args)
+            func(*args, **kwargs)
+            if self.app_db is not None:
+                self.app_db.commit()
+        except Exception:
+            if self.app_db is not None:
+                self.app_db.rollback()
+            error = traceback.format_exc()
+            done.set()
+            renewer.join()
+            state = self._failed(job, error)
+        else:
+            done.set()
+            renewer.join()
+            state = DONE
+            self.db(self.db.job.id == job.id).update(
+                status=DONE, finished_at=time.time()
+            )
+            self.db.commit()
+        if self.metrics:
+            self.metrics.inc("py4web_task_runs_total", task=job.name, state=state)
+            self.metrics.observe(
+                "py4web_task_duration_seconds",
+                time.perf_counter() - t0,
+                task=job.name,
+            )
+        return True
+
+    def _renew(self, job, done):
+        """Extends the lease of the running job, until done is set"""
+        db = self.db
+        # a thread of its own, with a connection of its own
+        db.get_connection_from_pool_or_new()
+        try:
+            while not done.wait(self.visibility_timeout / 3.0):
+                db(
+                    (db.job.id == job.id)
+                    & (db.job.status == RUNNING)
+                    & (db.job.attempts == job.attempts)
+                ).update(locked_until=time.time() + self.visibility_timeout)
+                db.commit()
+        except Exception:
+            self.logger.exception("unable to renew the lease of job %i", job.id)
+            db.recycle_connection_in_pool_or_close("rollback")
+        else:
+            db.recycle_connection_in_pool_or_close("commit")
+
+    def _failed(self, job, error):
+        """Requeues job with a backoff or marks it failed, returns its status"""
+        now = time.time()
+        if job.attempts < job.max_attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            fields = dict(status=QUEUED, run_at=now + delay, last_error=error)
+            self.logger.warning("job %s:%i failed, retry in %is", job.name, job.id, delay)
+        else:
+            fields = dict(status=FAILED, finished_at=now, last_error=error)
+            self.logger.error("job %s:%i failed:\n%s", job.name, job.id, error)
+        self.db(self.db.job.id == job.id).update(**fields)
+        self.db.commit()
+        return fields["status"]
+
+    def tick(self):
+        """Enqueues the scheduled tasks that are due (safe with many workers)"""
+        db, now = self.db, time.time()
+        # the finished jobs of the schedules would pile up
+        if self.keep is not None and now - self.purged_at > 3600:
+            self.purged_at = now
+            self.purge(self.keep)
+        for key, (seconds, name, args) in self.schedules.items():
+            row = db.job_schedule(name=key)
+            if row is None:
+                try:
+                    db.job_schedule.insert(name=key, next_run=now)
+                    db.commit()
+                except Exception:
+                    # another worker inserted it first
+                    db.rollback()
+                row = db.job_schedule(name=key)
+            if row.next_run > now:
+                continue
+            # only the worker that moves next_run forward enqueues the task
+            if db(
+                (db.job_schedule.id == row.id)
+                & (db.job_schedule.next_run == row.next_run)
+            ).update(next_run=now + seconds):
+                db.commit()
+                self.enqueue(name, *args)
+            else:
+                db.commit()
+
+    def work(self, beat=False, burst=False):
+        """Runs jobs until interrupted (or, with burst, until none is due)"""
+        while True:
+            if beat:
+                self.tick()
+            if not self.run_next():
+                if burst:
+                    return
+                time.sleep(self.poll_interval)
+
+    def run_workers(self, processes=1, beat=False, burst=False):
+        """Runs the workers, in this process or in as many forked processes"""
+        if processes == 1:
+            return self.work(beat=beat, burst=burst)
+        # every forked worker opens its own connections
+        self.close()
+        context = multiprocessing.get_context("fork")
+        workers = [
+            context.Process(
+                target=self.work, kwargs=dict(beat=beat and k == 0, burst=burst)
+            )
+            for k in range(processes)
+        ]
+        for process in workers:
+            process.start()
+        try:
+            for process in workers:
+                process.join()
+        except KeyboardInterrupt:
+            for process in workers:
+                process.terminate()
+
+    def close(self):
+        """Closes the connections of the current thread"""
+        for db in (self._db, self.app_db):
+            if db is not None:
+                db._adapter.close()
+
+    def purge(self, seconds=7 * 24 * 3600):
+        """Deletes the jobs done (or failed) more than seconds ago"""
+        db = self.db
+        db(db.job.finished_at < time.time() - seconds).delete()
+        db.commit()
+
+
+def worker(processes=1, beat=False, burst=False):
+    """py4web call apps tagged_posts.jobs.worker --args '{"processes": 2, "beat": true}'"""
+    # prevent circular imports, the tasks register themselves on import
+    from .tasks import jobs
+
+    jobs.run_workers(processes, beat=beat, burst=burst)
+
+
+def purge(seconds=7 * 24 * 3600):
+    """py4web call apps tagged_posts.jobs.purge"""
+    from .common import jobs
+
+    jobs.purge(seconds)
@@ -2,14 +2,23 @@
 This file defines the database models
 """
 
-from .common import db, Field, auth
+from .common import db, Field, auth, settings, logger
+from ..shared.authors import Authors
+from ..shared.schema import migrate_on_change
 from pydal.validators import *
 import re
 
+# optional copies of the author names in the posts (see authors.py)
+authors = Authors(db, logger=logger) if settings.DENORMALIZE_AUTHORS else None
+
 db.define_table(
     "post_item",
     Field("content", "text"),
-    auth.signature)
+    auth.signature,
+    *(authors.fields() if authors else []))
+
+if authors:
+    authors.track(db.post_item)
 
 db.define_table(
     "tag_item",
@@ -17,8 +26,42 @@ db.define_table(
     Field("post_item_id", "reference post_item")
 )    
 
+# posts waiting for the background indexing (settings.BACKGROUND_INDEXING)
+db.define_table(
+    "post_index_queue",
+    Field("post_item_id", "reference post_item")
+)
+
+# all the tables are defined, migrate them if they changed
+if settings.DB_MIGRATE and settings.DB_SCHEMA_FINGERPRINT:
+    migrate_on_change(
+        getattr(db, "primary", db),
+        settings.DB_FOLDER,
+        fake_migrate=settings.DB_FAKE_MIGRATE,
+        logger=logger,
+    )
+
+REGEX_TAG = re.compile(r"\#\w+")
+
 def parse_post_content(content, post_item_id):
-    for word in re.compile(r"\#\w+").findall(content):
+    for word in REGEX_TAG.findall(content):
         db.tag_item.insert(name=word[1:], post_item_id=post_item_id)    
+
+def index_pending_posts(batch_size=500):
+    """extract the tags of up to batch_size queued posts, returns their number"""
+    pending = db(db.post_index_queue).select(
+        orderby=db.post_index_queue.id, limitby=(0, batch_size))
+    if not pending:
+        return 0
+    # take the batch, if another worker took part of it leave it to them
+    if db(db.post_index_queue.id.belongs([row.id for row in pending])).delete() < len(pending):
+        db.rollback()
+        return 0
+    posts = db(db.post_item.id.belongs([row.post_item_id for row in pending])).select(
+        db.post_item.id, db.post_item.content)
+    db.tag_item.bulk_insert([
+        dict(name=word[1:], post_item_id=post.id)
+        for post in posts for word in REGEX_TAG.findall(post.content or "")])
+    return len(pending)
         
 
@@ -14,7 +14,7 @@ app.config.data = function() {
 app.config.methods = {};
 app.config.methods.submit = function() {
     if (!app.vue.content.trim()) return;
-    axios.post("/tagged_posts/api/posts", {"content": app.vue.content}).then(function(res){        
+    axios.post("/tagged_posts/api/posts", {"content": app.vue.content, "read_your_writes": true}).then(function(res){        
         app.vue.content = "";
         app.reload();
     });
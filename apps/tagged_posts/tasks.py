@@ -1,34 +1,43 @@
 """
-To use celery tasks:
-1) pip install -U "celery[redis]"
-2) In settings.py:
-   USE_CELERY = True
-   CELERY_BROKER = "redis://localhost:6379/0"
-3) Start "redis-server"
-4) Start "celery -A apps.{appname}.tasks beat"
-5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
+To run the tasks (no broker to install, see jobs.py):
+1) Define them below with @jobs.task, enqueue them with my_task.delay(...)
+2) Start the workers (and the schedules) with
+   py4web call apps {appname}.jobs.worker --args '{"processes": 2, "beat": true}'
 
 """
-from .common import settings, scheduler, db, Field
+from .common import jobs, db, settings, Field
+from .models import index_pending_posts, authors
 
 # example of task that needs db access
-@scheduler.task
+@jobs.task
 def my_task():
-    try:
-        # this task will be executed in its own thread, connect to db
-        db._adapter.reconnect()
-        # do something here
+    # the worker keeps its db connection, commits on success
+    # and rolls back if the task raises (then retries it later)
+    pass
+
+
+# to run my_task every 10 seconds (the worker started with beat enqueues it)
+# jobs.every(10.0, my_task)
+
+
+# extract the tags of the posts queued by POST api/posts (BACKGROUND_INDEXING)
+@jobs.task
+def index_posts():
+    # one transaction per batch until the queue is empty
+    while index_pending_posts(settings.INDEX_BATCH_SIZE):
         db.commit()
-    except:
-        # rollback on failure
-        db.rollback()
-
-
-# run my_task every 10 seconds
-scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
-        "args": (),
-    },
-}
+
+
+if settings.BACKGROUND_INDEXING:
+    jobs.every(1.0, index_posts)
+
+
+# copy the profile changes into the posts (DENORMALIZE_AUTHORS)
+if authors:
+
+    @jobs.task
+    def fixup_authors():
+        while authors.fixup():
+            db.commit()
+
+    jobs.every(5.0, fixup_authors)
@@ -1,21 +1,34 @@
+import csv
+import io
+import json
 import os
 import sys
 import time
 
 THIS_FOLDER = os.path.dirname(__file__)
 sys.path.append(os.path.join(THIS_FOLDER, "../../tools/"))
-from tester import Tester
+from tester import Tester, needs_browser
+
+
+USER = dict(
+    username="tester",
+    email="tester@example.com",
+    password="1234qwerQWER!@#$",
+    first_name="Tester",
+    last_name="TESTER",
+)
 
 
 class TestTaggedPosts:
-    def __init__(self):
-        self.tester = Tester(headless=True)
-        self.url = self.tester.start_py4web(THIS_FOLDER, port=8888)
+    def __init__(self, browser=True):
+        self.tester = Tester(headless=True, browser=browser)
+        self.url = self.tester.start_py4web(THIS_FOLDER)
         self.cookies = None
 
     def run(self):
         self.tester.run_steps(self)
 
+    @needs_browser
     def step_01(self):
         "check we can open the page"
         self.tester.open(self.url)
@@ -23,21 +36,18 @@ class TestTaggedPosts:
 
     def step_02(self):
         "check login"
-        user = dict(
-            username="tester",
-            email="tester@example.com",
-            password="1234qwerQWER!@#$",
-            first_name="Tester",
-            last_name="TESTER",
-        )
+        user = USER
         self.tester.create_user(user)
-        self.tester.auth_sign_in(user)
-        self.tester.open(self.url)
-        assert "tester" in self.tester.browser.page_source, "unable to login"
-        assert "logout" in self.tester.browser.page_source, "unable to login"
-        set_cookies = self.tester.browser.get_cookies()
-        assert len(set_cookies) >= 1, "server cookies not working"
-        self.cookies = {"tagged_posts_session": set_cookies[0]["value"]}
+        if self.tester.browser:
+            self.tester.auth_sign_in(user)
+            self.tester.open(self.url)
+            assert "tester" in self.tester.browser.page_source, "unable to login"
+            assert "logout" in self.tester.browser.page_source, "unable to login"
+            set_cookies = self.tester.browser.get_cookies()
+            assert len(set_cookies) >= 1, "server cookies not working"
+            self.cookies = {"tagged_posts_session": set_cookies[0]["value"]}
+        else:
+            self.cookies = self.tester.auth_api_sign_in(user)
         db = self.tester.app_as_module.db
         assert "post_item" in db.tables, "table post_item not found in models.py"
         post_item = db.post_item
@@ -89,6 +99,7 @@ class TestTaggedPosts:
         )
         assert res.get("id") == 1, "unable to store a post_item using API"
 
+        # created_on has a resolution of one second and the posts are sorted by it
         time.sleep(1)
 
         content = "This is a message about #boring #games"
@@ -142,6 +153,7 @@ class TestTaggedPosts:
         assert db(db.post_item).count() == 1, "unable to delete post"
         self.tester.notify("DELETE to /api/posts works", score=1.0)
 
+    @needs_browser
     def step_04(self):
         """check post items"""
         self.tester.open(self.url)
@@ -155,6 +167,7 @@ class TestTaggedPosts:
         ), "Exepcted to find a post_item"
         self.tester.notify("Feed column works", score=1.0)
 
+    @needs_browser
     def step_05(self):
         """check tags"""
         self.tester.find_first(".tags")
@@ -164,20 +177,22 @@ class TestTaggedPosts:
         assert "games" in tags[1].text, "Exepcted the games tag"
         self.tester.notify("Tags column works", score=1.0)
 
+    @needs_browser
     def step_06(self):
         """check filter by tags"""
         self.tester.open(self.url)
         content = "#hello #world"
         self.tester.find_first("textarea.post-content").send_keys(content)
         self.tester.find_first("button.submit-content").click()
-        time.sleep(1)
 
         db = self.tester.app_as_module.db
-        assert db(db.post_item).count() == 2, "record not inserted in database"
+        assert self.tester.wait_for(
+            lambda: db(db.post_item).count() == 2
+        ), "record not inserted in database"
         self.tester.notify("Posting from page works", score=0.5)
 
         self.tester.find_first(".feed")
-        items = self.tester.find_all(".feed .post_item")
+        items = self.tester.wait_for_all(".feed .post_item", 2)
         assert len(items) == 2, "Exepcted to find two post_items"
         assert "#hello" in items[0].get_attribute(
             "innerHTML"
@@ -187,7 +202,7 @@ class TestTaggedPosts:
         ), "Exepcted to find a post_item"
         self.tester.notify("Posting to the feed works", score=0.5)
 
-        tags = self.tester.find_all(".tags .tag")
+        tags = self.tester.wait_for_all(".tags .tag", 4)
         assert "boring" in tags[0].text, "Exepcted the boring tag"
         assert "games" in tags[1].text, "Exepcted the games tag"
         assert "hello" in tags[2].text, "Exepcted the hello tag"
@@ -195,8 +210,7 @@ class TestTaggedPosts:
         self.tester.notify("Tags refreshed correclty", score=1.0)
 
         tags[0].click()
-        time.sleep(1)
-        items = self.tester.find_all(".feed .post_item")
+        items = self.tester.wait_for_all(".feed .post_item", 1)
         assert len(items) == 1, "Exepcted to find one post_item"
         assert "#boring" in items[0].get_attribute(
             "innerHTML"
@@ -207,11 +221,11 @@ class TestTaggedPosts:
         self.tester.notify("Tags toggling works", score=0.5)
 
         tags[0].click()
-        time.sleep(1)
-        items = self.tester.find_all(".feed .post_item")
+        items = self.tester.wait_for_all(".feed .post_item", 2)
         assert len(items) == 2, "Exepcted to find two post_item"
         self.tester.notify("Tags untoggling works", score=0.5)
 
+    @needs_browser
     def step_07(self):
         """check delete item"""
         self.tester.open(self.url)
@@ -220,14 +234,90 @@ class TestTaggedPosts:
         assert len(items) == 2, "Expected two post_items"
         assert len(buttons) == 2, "Expected a delete button per item"
         buttons[0].click()
-        time.sleep(1)
-        items = self.tester.find_all(".feed .post_item")
+        items = self.tester.wait_for_all(".feed .post_item", 1)
         assert len(items) == 1, "Expected the item to be deleted"
         self.tester.open(self.url)
         items = self.tester.find_all(".feed .post_item")
         assert len(items) == 1, "Expected the item to be deleted"
         self.tester.notify("Delete using the feed button works", score=1.0)
 
+    def step_08(self):
+        """check bulk import"""
+        db = self.tester.app_as_module.db
+        items = [
+            {"content": "bulk #one"},
+            {"content": ""},
+            "not an object",
+            {"content": "bulk #two", "created_on": "2020-01-02T03:04:05"},
+            {"content": "bulk #three", "created_on": "yesterday"},
+            {"content": "bulk #six", "created_on": "2020-01-02T05:04:05+02:00"},
+        ]
+        res = self.tester.fetch(
+            "POST", self.url + "api/posts/bulk", items, cookies=self.cookies
+        )
+        results = res["results"]
+        assert len(results) == 6, "expected one result per item"
+        assert [bool(item["id"]) for item in results] == [
+            True, False, False, True, False, True
+        ], "expected ids for the valid items only"
+        for item, result in zip(items, results):
+            if result["id"]:
+                post = db.post_item(result["id"])
+                assert post.content == item["content"], "wrong id for an item"
+        assert list(results[2]["errors"]) == ["item"], "expected an item error"
+        assert list(results[4]["errors"]) == ["created_on"], "expected a date error"
+        post = db.post_item(results[3]["id"])
+        assert post.content == "bulk #two", "post not imported"
+        assert str(post.created_on) == "2020-01-02 03:04:05", "created_on not kept"
+        post = db.post_item(results[5]["id"])
+        assert str(post.created_on) == "2020-01-02 03:04:05", "expected UTC dates"
+        tags = db(db.tag_item.post_item_id == results[0]["id"]).select()
+        assert [tag.name for tag in tags] == ["one"], "tags not extracted"
+        self.tester.notify("Bulk import as JSON works", score=1.0)
+
+        lines = ['{"content": "bulk #four"}', "{not json", '{"content": "bulk #five"}']
+        response = self.tester.http.post(
+            self.url + "api/posts/bulk",
+            data="\n".join(lines) + "\n",
+            headers={"Content-Type": "application/x-ndjson"},
+            cookies=self.cookies,
+        )
+        assert response.status_code == 200, "bulk import as NDJSON failed"
+        results = response.json()["results"]
+        assert [bool(item["id"]) for item in results] == [
+            True, False, True
+        ], "expected ids for the valid lines only"
+        assert results[1]["errors"], "expected the invalid line reported"
+        assert db.post_item(results[2]["id"]).content == "bulk #five", "not imported"
+        self.tester.notify("Bulk import as NDJSON works", score=1.0)
+
+    def step_09(self):
+        """check export"""
+        db = self.tester.app_as_module.db
+        ids = [row.id for row in db(db.post_item).select(orderby=db.post_item.id)]
+        assert len(ids) > 2, "expected the posts of the previous steps"
+        response = self.tester.http.get(
+            self.url + "export/posts?format=csv", cookies=self.cookies
+        )
+        assert response.status_code == 200, "unable to export as csv"
+        assert response.headers["Content-Type"].startswith("text/csv"), "not csv"
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [int(row["id"]) for row in rows] == ids, "expected all posts, by id"
+        post = db.post_item(ids[0])
+        assert rows[0]["content"] == post.content, "expected the content"
+        tags = db(db.tag_item.post_item_id == post.id).select(orderby=db.tag_item.id)
+        assert rows[0]["tags"] == " ".join(tag.name for tag in tags), "expected the tags"
+        self.tester.notify("Export as csv works", score=1.0)
+
+        response = self.tester.http.get(
+            self.url + "export/posts?after=%i" % ids[1], cookies=self.cookies
+        )
+        assert response.status_code == 200, "unable to export as ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert [record["id"] for record in records] == ids[2:], "expected ids > after"
+        self.tester.notify("Export resumed with ?after= works", score=1.0)
+
 
 if __name__ == "__main__":
-    TestTaggedPosts().run()
+    # --api only runs the steps that do not need a browser
+    TestTaggedPosts(browser="--api" not in sys.argv).run()
@@ -1,23 +1,33 @@
 import os
-from py4web import action, request, DAL, Field, Session, Cache, Condition
+from py4web import action, request, response, DAL, Field, Session, Condition
+from ..shared.compact import compact_json, requested_layout, select_compact
+from ..shared.concurrency import ConcurrencyLimit
+from ..shared.metrics import Metrics, MeteredCache, authorize_scrape
+
+# collect metrics, exposed by the metrics action below
+metrics = Metrics("todo")
 
 # define session and cache objects
 session = Session()
-cache = Cache(size=1000)
+cache = MeteredCache(metrics, size=1000)
 
 # define database and tables
 db = DAL(
     "sqlite://storage.db", folder=os.path.join(os.path.dirname(__file__), "databases")
 )
+metrics.instrument_db(db)
 db.define_table("todo", Field("info"))
 db.commit()
 
+# at most 4 API requests use the db at once, the others wait (up to 5s) for a turn
+db_limit = ConcurrencyLimit(4, timeout=5, metrics=metrics)
+
 # an example of a custom requirement
 user_in_session = Condition(lambda: session.get('user', False))
 
 # example index page using session, template and vue.js
 @action("index")  # the function below is exposed as a GET action
-@action.uses("index.html", session)  # we use the template index.html and session
+@action.uses(metrics, "index.html", session)  # we time it, use the template index.html and session
 def index():
     session["counter"] = session.get("counter", 0) + 1
     session["user"] = {"id": 1}  # store a user in session
@@ -28,21 +38,25 @@ def index():
 
 
 @action("api", method="GET")  # a GET API function
-@action.uses(session, db)  # we load the session and db
+@action.uses(metrics, db_limit, session, db)  # we wait for a turn, load the session and db
 @action.uses(user_in_session)  # then check we have a valid user in session
 def todo():
-    return dict(items=db(db.todo).select(orderby=~db.todo.id).as_list())
+    # plain records (or, with ?layout=columns, column arrays), see compact.py
+    items = select_compact(
+        db(db.todo), list(db.todo), requested_layout(), orderby=~db.todo.id
+    )
+    return compact_json(dict(items=items))
 
 
 @action("api", method="POST")
-@action.uses(session, db)
+@action.uses(metrics, db_limit, session, db)
 @action.uses(user_in_session)
 def todo():
     return dict(id=db.todo.insert(info=request.json.get("info")))
 
 
 @action("api/<id:int>", method="DELETE")
-@action.uses(session, db)
+@action.uses(metrics, db_limit, session, db)
 @action.uses(user_in_session)
 def todo(id):
     db(db.todo.id == id).delete()
@@ -51,7 +65,16 @@ def todo(id):
 
 # example of caching
 @action("uuid")
+@action.uses(metrics)
 @cache.memoize(expiration=5)  # here we cache the result for 5 seconds
 def uuid():
     import uuid
     return str(uuid.uuid4())
+
+
+# metrics in the Prometheus text format, served only to the requests from this host
+@action("metrics")
+def metrics_page():
+    authorize_scrape()
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
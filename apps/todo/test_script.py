@@ -0,0 +1,78 @@
+import os
+import sys
+
+THIS_FOLDER = os.path.dirname(__file__)
+sys.path.append(os.path.join(THIS_FOLDER, "../../tools/"))
+from tester import Tester, needs_browser
+
+
+class TestTodo:
+    def __init__(self, browser=True):
+        self.tester = Tester(headless=True, browser=browser)
+        self.url = self.tester.start_py4web(THIS_FOLDER)
+        self.cookies = None
+
+    def run(self):
+        self.tester.run_steps(self)
+
+    @needs_browser
+    def step_01(self):
+        "check we can open the page"
+        self.tester.open(self.url)
+        self.tester.notify("Success in opening page")
+
+    def step_02(self):
+        "check the session"
+        db = self.tester.app_as_module.db
+        assert "todo" in db.tables, "table todo not found"
+        assert "info" in db.todo.fields, "todo has no info field"
+        self.tester.notify("Table todo defined correctly", score=1.0)
+
+        # the index page stores a user in the session
+        response = self.tester.http.get(self.url + "index")
+        assert response.status_code == 200, "unable to open the index page"
+        self.cookies = response.cookies.get_dict()
+        assert self.cookies, "server cookies not working"
+        self.tester.notify("Session works", score=1.0)
+
+    def step_03(self):
+        "check api"
+        if not self.cookies:
+            self.tester.notify("Cannot proceed without a session")
+            self.tester.stop()
+        response = self.tester.http.get(self.url + "api")
+        assert response.status_code != 200, "api accessible without a session"
+
+        res = self.tester.fetch(
+            "POST", self.url + "api", {"info": "buy milk"}, cookies=self.cookies
+        )
+        assert res.get("id") == 1, "unable to store a todo using API"
+        res = self.tester.fetch(
+            "POST", self.url + "api", {"info": "walk the dog"}, cookies=self.cookies
+        )
+        assert res.get("id") == 2, "unable to store a todo using API"
+        self.tester.notify("POST to /api works", score=1.0)
+
+        res = self.tester.fetch("GET", self.url + "api", cookies=self.cookies)
+        assert [item["info"] for item in res["items"]] == [
+            "walk the dog",
+            "buy milk",
+        ], "expected the items, most recent first"
+        res = self.tester.fetch(
+            "GET", self.url + "api?layout=columns", cookies=self.cookies
+        )
+        assert res["items"] == {
+            "id": [2, 1],
+            "info": ["walk the dog", "buy milk"],
+        }, "expected the items as column arrays"
+        self.tester.notify("GET to /api works", score=1.0)
+
+        self.tester.fetch("DELETE", self.url + "api/1", cookies=self.cookies)
+        db = self.tester.app_as_module.db
+        assert db(db.todo).count() == 1, "unable to delete todo"
+        self.tester.notify("DELETE to /api works", score=1.0)
+
+
+if __name__ == "__main__":
+    # --api only runs the steps that do not need a browser
+    TestTodo(browser="--api" not in sys.argv).run()
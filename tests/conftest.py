@@ -0,0 +1,65 @@
+"""
+The tests of the modules shared by the apps (apps/shared) and of the tools,
+run with make test after the test scripts of the apps. The test scripts
+grade the behavior of each app, these check the building blocks.
+"""
+import os
+import sys
+import wsgiref.util
+
+import pytest
+from py4web import request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the apps are imported as apps.<app>, the way py4web loads them
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from tester import Tester
+
+USER = dict(
+    username="tester",
+    email="tester@example.com",
+    password="1234qwerQWER!@#$",
+    first_name="Tester",
+    last_name="TESTER",
+)
+
+
+@pytest.fixture
+def start_server():
+    """
+    Starts a server of an app with the given settings and signs USER in,
+    returns its tester, url and session cookies. Stopped after the test
+    """
+    testers, stops = [], []
+
+    def start(app_name="tagged_posts", **settings):
+        tester = Tester(browser=False)
+        testers.append(tester)
+        url = tester.start_py4web(os.path.join(ROOT, "apps", app_name), settings=settings)
+        # the log pipelines of the copy imported here write to the captured
+        # output of this test, stop them while it is open
+        stops.append(sys.modules["apps.shared.log_pipeline"].stop_all)
+        tester.create_user(USER)
+        return tester, url, tester.auth_api_sign_in(USER)
+
+    yield start
+    for stop in stops:
+        stop()
+    for tester in testers:
+        tester.stop_py4web()
+
+
+@pytest.fixture
+def environ():
+    """Sets up request.environ for the fixtures used outside of a server"""
+
+    def setup(method="GET", path="/", **headers):
+        environ = {"REQUEST_METHOD": method, "PATH_INFO": path}
+        environ.update(("HTTP_" + key.upper(), value) for key, value in headers.items())
+        wsgiref.util.setup_testing_defaults(environ)
+        request.environ = environ
+        return environ
+
+    return setup
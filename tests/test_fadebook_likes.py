@@ -0,0 +1,48 @@
+import os
+import signal
+import subprocess
+import sys
+
+from pydal import DAL, Field
+
+from conftest import ROOT
+
+SCRIPT = """
+import importlib.util
+import os
+import signal
+
+from pydal import DAL, Field
+
+spec = importlib.util.spec_from_file_location("likes", {likes!r})
+likes = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(likes)
+db = DAL("sqlite://storage.db", folder={folder!r})
+db.define_table(
+    "item_like",
+    Field("item_id", "integer"),
+    Field("created_by", "integer"),
+    Field("modified_by", "integer"),
+)
+buffer = likes.LikeBuffer(db, window=3600)
+assert buffer.toggle(1, 2)
+db.commit()
+os.kill(os.getpid(), signal.SIGTERM)
+"""
+
+
+def test_pending_likes_written_on_sigterm(tmp_path):
+    script = SCRIPT.format(
+        likes=os.path.join(ROOT, "apps", "fadebook", "likes.py"), folder=str(tmp_path)
+    )
+    process = subprocess.run([sys.executable, "-c", script])
+    assert process.returncode == -signal.SIGTERM, "expected the process terminated"
+    db = DAL("sqlite://storage.db", folder=str(tmp_path))
+    db.define_table(
+        "item_like",
+        Field("item_id", "integer"),
+        Field("created_by", "integer"),
+        Field("modified_by", "integer"),
+    )
+    assert db(db.item_like).count() == 1, "expected the pending like written"
+    db.close()
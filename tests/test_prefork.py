@@ -0,0 +1,54 @@
+import os
+import signal
+import subprocess
+import sys
+
+from conftest import ROOT
+from tester import free_port
+
+
+def test_prefork(start_server):
+    tester, url, cookies = start_server()
+    tags = tester.fetch("GET", url + "api/tags", cookies=cookies)
+    port = free_port()
+    # on the copy of the apps of the server, with its databases
+    master = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(ROOT, "tools", "prefork.py"),
+            tester.dest_apps,
+            "--app_names=tagged_posts",
+            "--workers=2",
+            "--port=%i" % port,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.STDOUT,
+    )
+    url = "http://127.0.0.1:%i/tagged_posts/" % port
+
+    def workers():
+        # the children of the master (linux only)
+        with open("/proc/%i/task/%i/children" % (master.pid, master.pid)) as stream:
+            return set(map(int, stream.read().split()))
+
+    try:
+        assert tester.wait_until_ready(url), "the pre-fork server did not start"
+        for _ in range(4):
+            res = tester.fetch("GET", url + "api/tags", cookies=cookies)
+            assert res == tags, "expected the same tags from the workers"
+
+        pids = workers()
+        assert len(pids) == 2, "expected two workers"
+        os.kill(min(pids), signal.SIGKILL)
+        assert tester.wait_for(
+            lambda: len(workers()) == 2 and workers() != pids
+        ), "expected the dead worker replaced"
+        res = tester.fetch("GET", url + "api/tags", cookies=cookies)
+        assert res == tags, "expected the same tags from the workers"
+
+        master.terminate()
+        assert master.wait(timeout=30) == 0, "expected a clean shutdown"
+    finally:
+        if master.poll() is None:
+            master.kill()
+            master.wait()
@@ -0,0 +1,52 @@
+import glob
+import json
+import os
+import shutil
+
+from apps.shared.catalogs import CatalogTranslator
+
+
+def test_catalogs_compiled(start_server, tmp_path):
+    tester, url, cookies = start_server()
+    # loading the app compiled its catalogs
+    settings = tester.app_as_module.settings
+    compiled = glob.glob(os.path.join(settings.T_CACHE_FOLDER, "it.*.marshal"))
+    assert len(compiled) == 1, "expected the compiled it catalog"
+
+    folder = os.path.join(tmp_path, "translations")
+    cache_folder = os.path.join(tmp_path, "cache")
+    shutil.copytree(settings.T_FOLDER, folder)
+    T = CatalogTranslator(folder, cache_folder=cache_folder, check_interval=0)
+    T.select("it")
+    hello = "Hello World from {name}"
+    assert str(T(hello).format(name="me")) == "Salve Mondo da me", "not translated"
+    (old,) = os.listdir(cache_folder)
+
+    source = os.path.join(folder, "it.json")
+    with open(source, "w") as stream:
+        json.dump({hello: {"0": "Ciao Mondo da {name}"}}, stream)
+    # a new mtime, even on file systems with a coarse resolution
+    mtime = os.stat(source).st_mtime + 2
+    os.utime(source, (mtime, mtime))
+    T.check()
+    T.select("it")
+    assert (
+        str(T(hello).format(name="me")) == "Ciao Mondo da me"
+    ), "expected the edited catalog reloaded"
+    (new,) = os.listdir(cache_folder)
+    assert new != old, "expected the catalog compiled again"
+
+
+def test_plain_string_translations(tmp_path):
+    folder = os.path.join(tmp_path, "translations")
+    os.makedirs(folder)
+    with open(os.path.join(folder, "it.json"), "w") as stream:
+        json.dump({"Hello": "Ciao", "Bye": {"0": "Addio"}}, stream)
+    # not a catalog
+    with open(os.path.join(folder, "notes.json"), "w") as stream:
+        json.dump({"Hello": "Salve"}, stream)
+    T = CatalogTranslator(folder, cache_folder=os.path.join(tmp_path, "cache"))
+    assert sorted(T.languages) == ["it"], "expected the it catalog only"
+    T.select("it")
+    assert str(T("Hello")) == "Ciao", "expected the plain string translation"
+    assert str(T("Bye")) == "Addio", "expected the translation"
@@ -0,0 +1,27 @@
+import pytest
+from py4web import HTTP
+
+from apps.shared.concurrency import ConcurrencyLimit
+
+
+def test_concurrency_limit(environ):
+    limit = ConcurrencyLimit(1, timeout=0.1)
+    environ("POST", "/todo/api")
+    limit.on_request({})
+    with pytest.raises(HTTP) as raised:
+        limit.on_request({})
+    assert raised.value.status == 503, "expected a 503 over the limit"
+    assert raised.value.headers.get("Retry-After") == "1", "expected a Retry-After"
+    limit.on_success({})
+    limit.on_request({})
+    limit.on_error({})
+    limit.on_request({})
+
+
+def test_no_concurrency_limit(environ):
+    limit = ConcurrencyLimit(0, timeout=0.1)
+    environ("POST", "/todo/api")
+    for _ in range(3):
+        limit.on_request({})
+    limit.on_success({})
+    limit.on_error({})
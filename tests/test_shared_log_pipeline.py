@@ -0,0 +1,24 @@
+import json
+import logging
+import os
+
+from apps.shared import log_pipeline
+
+
+def test_queued_records_keep_the_traceback(tmp_path):
+    filename = os.path.join(tmp_path, "errors.jsonl")
+    pipeline = log_pipeline.LogPipeline([log_pipeline.make_handler("ERROR:" + filename, None)])
+    pipeline.start()
+    logger = logging.getLogger("test_log_pipeline")
+    logger.addHandler(pipeline.handler)
+    try:
+        {}["missing"]
+    except KeyError:
+        logger.exception("failed %s", "lookup")
+    logger.removeHandler(pipeline.handler)
+    pipeline.handler.close()
+    assert pipeline not in log_pipeline.PIPELINES, "expected the pipeline stopped"
+    with open(filename) as stream:
+        (item,) = [json.loads(line) for line in stream]
+    assert item["message"] == "failed lookup", "expected the message alone"
+    assert "KeyError: 'missing'" in item.get("exception", ""), "no traceback"
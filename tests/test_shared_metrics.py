@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+
+from py4web import HTTP, action, response
+from py4web.core import bottle
+
+from apps.shared.metrics import Metrics
+
+
+def test_metrics_page(start_server, tmp_path):
+    folder = str(tmp_path)
+    # the file of a process that died without removing it
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    stale = os.path.join(folder, "tagged_posts-%i.json" % process.pid)
+    with open(stale, "w") as stream:
+        json.dump([["py4web_rate_limited_total", [["route", "stale"]], 7]], stream)
+    tester, url, cookies = start_server(METRICS_TOKEN="secret", METRICS_MULTIPROCESS_DIR=folder)
+    response = tester.http.get(url + "metrics")
+    assert response.status_code == 403, "expected the token required"
+    response = tester.http.get(url + "metrics", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200, "expected the page with the token"
+    assert "stale" not in response.text, "expected the dead process skipped"
+    assert not os.path.exists(stale), "expected the dead process file removed"
+
+
+def test_metrics_page_served_to_this_host(start_server):
+    tester, url, cookies = start_server()
+    response = tester.http.get(url + "metrics")
+    assert response.status_code == 200, "expected the page served to this host"
+
+
+def test_metrics_file_removed_on_close(tmp_path):
+    metrics = Metrics("closed", multiprocess_dir=str(tmp_path))
+    metrics.inc("py4web_rate_limited_total")
+    metrics.flush()
+    assert os.path.exists(metrics.filename), "expected the file of the process"
+    metrics.close()
+    assert not os.path.exists(metrics.filename), "expected the file removed"
+
+
+def test_status_of_the_actions(environ):
+    metrics = Metrics("status")
+
+    def not_modified():
+        raise bottle.HTTPResponse(status=304)
+
+    def created():
+        response.status = 201
+        return "created"
+
+    def teapot():
+        raise HTTP(418)
+
+    def not_found():
+        raise bottle.HTTPError(404)
+
+    for func in (not_modified, created, teapot, not_found):
+        environ("GET", "/status")
+        try:
+            action.uses(metrics)(func)()
+        except (HTTP, bottle.HTTPResponse):
+            pass
+    response.status = 200
+    statuses = sorted(
+        dict(labels)["status"]
+        for (name, labels) in metrics.totals()
+        if name == "py4web_action_requests_total"
+    )
+    assert statuses == ["201", "304", "404", "418"], "expected the sent statuses"
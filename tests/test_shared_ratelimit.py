@@ -0,0 +1,32 @@
+import os
+import time
+
+from apps.shared.ratelimit import SQLiteStore
+
+
+def test_writes_over_the_limit(start_server):
+    # bursts of 2 writes, refilled at one write every 100 seconds
+    tester, url, cookies = start_server(RATE_LIMIT_WRITES=(0.01, 2))
+    for _ in range(2):
+        tester.fetch("POST", url + "api/posts", {"content": "#burst"}, cookies=cookies)
+    response = tester.http.post(url + "api/posts", json={"content": "#over"}, cookies=cookies)
+    assert response.status_code == 429, "expected 429 over the limit"
+    retry_after = int(response.headers["Retry-After"])
+    assert 1 <= retry_after <= 100, "expected the seconds to the next token"
+    db = tester.app_as_module.db
+    assert db(db.post_item).count() == 2, "the rejected post was stored"
+    # the limit is per route, reads are not limited
+    tester.fetch("GET", url + "api/posts", cookies=cookies)
+
+
+def test_idle_buckets_purged(tmp_path):
+    store = SQLiteStore(
+        os.path.join(tmp_path, "buckets.db"), purge_interval=0.01, idle_seconds=0.01
+    )
+    store.take("idle", 1, 1)
+    time.sleep(0.05)
+    store.take("busy", 1, 1)
+    keys = [row[0] for row in store.connection().execute("SELECT key FROM bucket;")]
+    store.close()
+    assert "idle" not in keys, "expected the idle bucket purged"
+    assert "busy" in keys, "expected the busy bucket kept"
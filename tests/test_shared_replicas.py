@@ -0,0 +1,23 @@
+def test_sqlite_replicas(start_server, environ):
+    tester, url, cookies = start_server(DB_READ_URIS=["sqlite://replica1.db"])
+    # without the cookie that pins a client to the primary after its writes
+    sticky = "tagged_posts_db_primary_until"
+    cookies = {key: value for key, value in cookies.items() if key != sticky}
+    # the router of this process, on the same files as the server
+    db = tester.app_as_module.db
+    db.sync_sqlite_replicas()
+    for k, tag in enumerate(["first", "second"]):
+        tester.fetch("POST", url + "api/posts", {"content": "#" + tag}, cookies=cookies)
+        tester.http.cookies.clear()
+        res = tester.fetch("GET", url + "api/posts", cookies=cookies)
+        assert len(res["posts"]) == k, "expected the requests not to sync"
+        db.sync_sqlite_replicas()
+        res = tester.fetch("GET", url + "api/posts", cookies=cookies)
+        assert len(res["posts"]) == k + 1, "expected the replica synced"
+    stats = tester.fetch("GET", url + "db/stats", cookies=cookies)
+    assert stats["replica1"]["queries"], "expected reads from the replica"
+
+    environ("GET", "/tagged_posts/index")
+    db.on_request({})
+    db.on_success({})
+    assert "auth_user_tag_groups" in db.replicas[0].tables, "not mirrored"
@@ -0,0 +1,18 @@
+from pydal import Field
+
+from apps.shared import schema
+
+
+def test_schema_fingerprint(start_server):
+    tester, url, cookies = start_server(DB_SCHEMA_FINGERPRINT=True)
+    db = tester.app_as_module.db
+    folder = tester.app_as_module.settings.DB_FOLDER
+    # the server migrated on its first boot and stored the fingerprint
+    assert not schema.migrate_on_change(db, folder), "expected no migration"
+    tester.fetch("POST", url + "api/posts", {"content": "#boot"}, cookies=cookies)
+
+    db.define_table("fingerprint_check", Field("name"))
+    assert schema.migrate_on_change(db, folder), "expected a migration"
+    db.fingerprint_check.insert(name="migrated")
+    db.commit()
+    assert not schema.migrate_on_change(db, folder), "expected no migration"
@@ -0,0 +1,37 @@
+import builtins
+import logging
+
+from apps.shared.startup import StartupProfiler
+
+
+def test_import_hook_removed_by_report():
+    original = builtins.__import__
+    startup = StartupProfiler()
+    assert builtins.__import__ != original, "expected the hook installed"
+    import colorsys
+
+    startup.mark("import")
+    startup.report(logging.getLogger("test_startup"))
+    assert builtins.__import__ is original, "expected the hook removed"
+    assert "colorsys" in [name for name, t in startup.imports], "import not timed"
+
+
+def test_import_hook_of_a_failed_load_removed():
+    original = builtins.__import__
+    # a load that failed before its report
+    StartupProfiler()
+    StartupProfiler().report(logging.getLogger("test_startup"))
+    assert builtins.__import__ is original, "expected the hooks removed"
+
+
+def test_disabled_profiler_leaves_imports_untouched():
+    original = builtins.__import__
+    StartupProfiler(enabled=False)
+    assert builtins.__import__ is original, "expected no hook"
+
+
+def test_app_removes_the_import_hook(start_server):
+    original = builtins.__import__
+    # the tester imports the app, with the profile enabled, in this process
+    start_server(STARTUP_PROFILE=True)
+    assert builtins.__import__ is original, "expected the hook removed"
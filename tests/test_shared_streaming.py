@@ -0,0 +1,111 @@
+import gzip
+import io
+import os
+
+from py4web import HTTP
+from py4web.core import bottle
+from pydal import DAL, Field
+
+from apps.shared import streaming
+from apps.shared.assets import Assets, build
+
+
+def make_db(folder):
+    # streaming borrows connections of its own, not an in memory db
+    db = DAL("sqlite://storage.db", folder=folder)
+    db.define_table(
+        "doc",
+        Field("public", "boolean"),
+        Field("file", "upload", uploadfolder=folder, authorize=lambda row: row.public),
+    )
+    return db
+
+
+def store(db, public, filename="doc.txt", data=b"data"):
+    name = db.doc.file.store(io.BytesIO(data), filename)
+    db.doc.insert(public=public, file=name)
+    db.commit()
+    return name
+
+
+def serve(func, *args):
+    """Returns the status and the headers of the response raised by func"""
+    try:
+        func(*args)
+    except HTTP as http:
+        return http.status, {}
+    except bottle.HTTPResponse as response:
+        if hasattr(response.body, "close"):
+            response.body.close()
+        return response.status_code, dict(response.headers)
+
+
+def test_stream_upload(environ, tmp_path):
+    folder = str(tmp_path)
+    db = make_db(folder)
+    names = {public: store(db, public) for public in (True, False)}
+
+    def get(filename, **headers):
+        environ("GET", "/download", **headers)
+        return serve(streaming.stream_upload, db, folder, filename)
+
+    status, headers = get(names[True])
+    etag = headers.get("ETag")
+    assert status == 200, "expected the authorized file"
+    assert get(names[False])[0] == 403, "expected a 403 for an unauthorized file"
+
+    assert get(names[True], if_none_match=etag)[0] == 304, "expected a 304"
+    assert get(names[True], if_none_match='"x", W/' + etag)[0] == 304, "expected a 304"
+    # a substring is not a match
+    assert get(names[True], if_none_match="'%s'" % etag)[0] == 200, "expected a 200"
+    db.close()
+
+
+def test_connection_rolled_back_on_errors(environ, tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    db = make_db(folder)
+    names = {public: store(db, public) for public in (True, False)}
+    actions = []
+    recycle = db.recycle_connection_in_pool_or_close
+
+    def recorded(action):
+        actions.append(action)
+        recycle(action)
+
+    monkeypatch.setattr(db, "recycle_connection_in_pool_or_close", recorded)
+    environ("GET", "/download")
+    serve(streaming.stream_upload, db, folder, names[True])
+    serve(streaming.stream_upload, db, folder, names[False])
+    assert actions == ["commit", "rollback"], "expected a rollback on errors"
+    db.close()
+
+
+def test_compressed_uploads_sent_as_they_are(environ, tmp_path):
+    folder = str(tmp_path)
+    db = make_db(folder)
+    name = store(db, True, "doc.txt.gz", gzip.compress(b"data"))
+    environ("GET", "/download")
+    status, headers = serve(streaming.stream_upload, db, folder, name)
+    assert status == 200, "expected the file"
+    assert "Content-Encoding" not in headers, "expected no Content-Encoding"
+    assert headers["Content-Type"] == "application/octet-stream", "expected bytes"
+    db.close()
+
+
+def test_compressed_assets(environ, tmp_path):
+    static = os.path.join(tmp_path, "static")
+    os.makedirs(os.path.join(static, "js"))
+    with open(os.path.join(static, "js", "utils.js"), "w") as stream:
+        stream.write("var x = 1;\n" * 100)
+    assets = Assets(os.path.join(tmp_path, "assets"))
+    hashed = build(static, assets.build_folder)["js/utils.js"]
+
+    environ("GET", "/assets/" + hashed, accept_encoding="gzip, deflate")
+    status, headers = serve(assets.serve, hashed)
+    assert status == 200, "expected the asset"
+    assert headers["Content-Encoding"] == "gzip", "expected the gzipped asset"
+    assert "javascript" in headers["Content-Type"], "expected the type of the asset"
+
+    environ("GET", "/assets/" + hashed)
+    status, headers = serve(assets.serve, hashed)
+    assert "Content-Encoding" not in headers, "expected the asset as it is"
@@ -0,0 +1,25 @@
+def test_denormalized_authors(start_server):
+    tester, url, cookies = start_server(DENORMALIZE_AUTHORS=True)
+    db = tester.app_as_module.db
+    authors = tester.app_as_module.authors
+    res = tester.fetch("POST", url + "api/posts", {"content": "#new"}, cookies=cookies)
+    post = db.post_item(res["id"])
+    assert post.author_username == "tester", "expected the author copied on insert"
+
+    # a post written before the setting was turned on
+    old_id = db.post_item.insert(content="#old", created_by=1)
+    db(db.post_item.id == old_id).update(
+        author_username=None, author_first_name=None, author_last_name=None
+    )
+    db.commit()
+    res = tester.fetch("GET", url + "api/posts", cookies=cookies)
+    assert res["users"] == {"1": "tester"}, "expected the author from auth_user"
+
+    while authors.fixup():
+        db.commit()
+    assert db.post_item(old_id).author_first_name == "Tester", "not backfilled"
+    db(db.auth_user.id == 1).update(first_name="Renamed")
+    while authors.fixup():
+        db.commit()
+    names = set(row.author_first_name for row in db(db.post_item).select())
+    assert names == {"Renamed"}, "profile change not copied into the posts"
@@ -0,0 +1,27 @@
+import importlib
+
+
+def test_bulk_import_copies_the_authors(start_server):
+    tester, url, cookies = start_server(DENORMALIZE_AUTHORS=True)
+    items = [{"content": "bulk #one"}, {"content": "bulk #two"}]
+    res = tester.fetch("POST", url + "api/posts/bulk", items, cookies=cookies)
+    ids = [item["id"] for item in res["results"]]
+    db = tester.app_as_module.db
+    for item, post_id in zip(items, ids):
+        post = db.post_item(post_id)
+        assert post.content == item["content"], "wrong id for an item"
+        assert post.author_username == "tester", "expected the author copied"
+        assert post.is_active, "expected the defaults"
+
+
+def test_refused_bulk_import(start_server):
+    tester, url, cookies = start_server()
+    db = tester.app_as_module.db
+    # the copy the server runs
+    controllers = importlib.import_module("apps.tagged_posts.controllers")
+    db.post_item._before_insert.append(lambda fields: True)
+    results = controllers.insert_posts([{"content": "#refused"}, "not an object"], 1)
+    assert [item["id"] for item in results] == [None, None], "expected no ids"
+    assert results[0]["errors"] == {"item": "refused"}, "expected the item refused"
+    assert results[1]["errors"] == {"item": "must be an object"}, "expected its error"
+    assert db(db.post_item).count() == 0, "expected nothing inserted"
@@ -0,0 +1,42 @@
+import importlib
+
+
+def test_background_indexing(start_server):
+    tester, url, cookies = start_server(BACKGROUND_INDEXING=True)
+    db = tester.app_as_module.db
+    tester.fetch("POST", url + "api/posts", {"content": "#later"}, cookies=cookies)
+    res = tester.fetch("GET", url + "api/tags", cookies=cookies)
+    assert res == {"tags": []}, "expected the tags left to the worker"
+    assert db(db.post_index_queue).count() == 1, "expected the post queued"
+
+    tester.fetch(
+        "POST",
+        url + "api/posts",
+        {"content": "#now", "read_your_writes": True},
+        cookies=cookies,
+    )
+    res = tester.fetch("GET", url + "api/tags", cookies=cookies)
+    assert res == {"tags": ["now"]}, "expected read_your_writes to index at once"
+
+    # a worker (with the schedules) of the copy the server runs, until idle
+    importlib.import_module("apps.tagged_posts.jobs").worker(beat=True, burst=True)
+    res = tester.fetch("GET", url + "api/tags", cookies=cookies)
+    assert res == {"tags": ["later", "now"]}, "expected the worker to index"
+    assert db(db.post_index_queue).count() == 0, "expected the queue empty"
+
+
+def test_expired_leases(start_server, tmp_path):
+    start_server()
+    # the module of the copy the server runs
+    jobs = importlib.import_module("apps.tagged_posts.jobs")
+    queue = jobs.JobQueue("sqlite://jobs.db", str(tmp_path), visibility_timeout=-1)
+    queue.task(lambda: None, name="noop", retries=1)
+    job_id = queue.enqueue("noop")
+    db = queue.db
+    # claimed by workers that died, the lease expired at once
+    for attempts in (1, 2):
+        job = queue.claim()
+        assert job and job.id == job_id, "expected the expired job claimed again"
+        assert job.attempts == attempts, "expected one more attempt"
+    assert queue.claim() is None, "expected no attempt after the last one"
+    assert db.job(job_id).status == jobs.FAILED, "expected the job failed"
@@ -0,0 +1,393 @@
+"""
+Load tests the example apps on the server bootstrap of tester.py
+
+    python tools/benchmark.py --clients 32 --seconds 5 --output bench.json
+    python tools/benchmark.py --baseline bench_baseline.json --tolerance 0.25
+    python tools/benchmark.py --apps tagged_posts --compare-concurrency
+
+For every app it starts py4web on a fresh copy of it (Tester.start_py4web,
+with the rate limits lifted), seeds a dataset of --users users and --size
+posts through the app models (once, later runs restore a snapshot of it,
+see Tester.seed_db), then runs each workload of WORKLOADS from the seeded
+data with --clients asyncio clients, each logged in as one of the users
+and keeping its connection alive, for --seconds. The report (JSON) has, per workload,
+the throughput, the p50/p95/p99 latency, the error rate and the queries
+run by the server per request (from the metrics page of the app).
+
+With --baseline the results are compared with a previous report and the
+run fails if a workload is slower, fails more often or runs more queries
+than the baseline allows (--tolerance). --save-baseline writes the report
+as the new baseline.
+
+With --compare-concurrency every app also runs its workloads with
+DB_CONCURRENCY=0, without the limit on the requests that use the db at
+once (apps/shared/concurrency.py), reported as "<workload> unbounded".
+The throughput and p99 latency of the shipped limit are printed next to
+those of this baseline.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from tester import Tester
+
+APPS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "apps")
+PASSWORD = "Bench!1234qwer"
+TAGS = ["tag%i" % k for k in range(50)]
+
+# name -> function(rng, size) returning (method, path, json body)
+WORKLOADS = {
+    "tagged_posts": {
+        "GET api/posts": lambda rng, size: ("GET", "api/posts", None),
+        "GET api/posts?tags": lambda rng, size: (
+            "GET",
+            "api/posts?tags=%s" % rng.choice(TAGS),
+            None,
+        ),
+        "GET api/tags": lambda rng, size: ("GET", "api/tags", None),
+        "POST api/posts": lambda rng, size: (
+            "POST",
+            "api/posts",
+            {"content": "benchmark #%s #%s" % (rng.choice(TAGS), rng.choice(TAGS))},
+        ),
+    },
+    "fadebook": {
+        "GET feed": lambda rng, size: ("GET", "feed", None),
+        "POST like": lambda rng, size: ("POST", "like/%i" % rng.randint(1, size), None),
+    },
+}
+
+# no rate limits, the clients would only measure the 429s
+SETTINGS = {
+    "RATE_LIMIT_WRITES": (1e9, 1e9),
+    "RATE_LIMIT_HOT_POST": (1e9, 1e9),
+}
+
+# the baseline of --compare-concurrency, by the suffix of its workloads
+UNBOUNDED = (" unbounded", {"DB_CONCURRENCY": 0})
+
+
+############################################################################
+# Convenience functions
+############################################################################
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def seed_tagged_posts(db, users, size):
+    rng = random.Random(0)
+    for k in range(size):
+        tags = rng.sample(TAGS, 3)
+        user_id = rng.choice(users)
+        post_id = db.post_item.insert(
+            content="post %i #%s" % (k, " #".join(tags)),
+            created_by=user_id,
+            modified_by=user_id,
+        )
+        db.tag_item.bulk_insert([dict(name=tag, post_item_id=post_id) for tag in tags])
+
+
+def seed_fadebook(db, users, size):
+    rng = random.Random(0)
+    for k in range(size):
+        user_id = rng.choice(users)
+        db.feed_item.insert(
+            body="item %i" % k, created_by=user_id, modified_by=user_id
+        )
+    # everybody is friends with the next 5 users
+    for k, user_id in enumerate(users):
+        for friend_id in users[k + 1 : k + 6]:
+            db.friend_request.insert(
+                from_user=user_id, to_user=friend_id, status="accepted"
+            )
+
+
+SEEDS = {"tagged_posts": seed_tagged_posts, "fadebook": seed_fadebook}
+
+
+class Connection:
+    """A minimal HTTP/1.1 keep-alive client on asyncio streams"""
+
+    def __init__(self, host, port, cookie):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        """Returns (status, body) of the response"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+        data = json.dumps(body).encode() if body is not None else b""
+        head = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            f"Cookie: {self.cookie}",
+            f"Content-Length: {len(data)}",
+        ]
+        if body is not None:
+            head.append("Content-Type: application/json")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            key, value = line.decode("latin1").split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            content = b""
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                content += await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            content = await self.reader.readexactly(
+                int(headers.get("content-length", 0))
+            )
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, content
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+############################################################################
+# Benchmark
+############################################################################
+
+
+class Benchmark(Tester):
+    """A Tester without browser, it only uses the server bootstrap"""
+
+    def __init__(self):
+        super().__init__(browser=False)
+
+    def seed(self, users, size):
+        """
+        Creates users and the dataset of the app, the first time, then
+        restores them from the snapshot saved by seed_db
+        """
+
+        def seed(db):
+            db.auth_user.password.writable = True
+            user_ids = []
+            for k in range(users):
+                name = "bench%i" % k
+                res = db.auth_user.validate_and_insert(
+                    username=name,
+                    email=name + "@example.com",
+                    password=PASSWORD,
+                    first_name="Bench",
+                    last_name="Mark%i" % k,
+                )
+                assert res.get("id"), res.get("errors")
+                user_ids.append(res["id"])
+            SEEDS[self.app_name](db, user_ids, size)
+
+        self.snapshot = self.seed_db(seed, name="bench-%i-%i" % (users, size))
+
+    def login(self, users):
+        """Returns the session cookie header of each user"""
+        cookies = []
+        for k in range(users):
+            user = dict(username="bench%i" % k, password=PASSWORD)
+            cookies.append(
+                "; ".join(
+                    f"{key}={value}"
+                    for key, value in self.auth_api_sign_in(user).items()
+                )
+            )
+        return cookies
+
+    def query_count(self):
+        """The queries run so far by the server, from the metrics page"""
+        text = self.http.get(self.base_url + "metrics").text
+        return sum(
+            float(line.rsplit(" ", 1)[1])
+            for line in text.splitlines()
+            if line.startswith("py4web_db_queries_total{")
+        )
+
+    async def drive(self, make_request, cookies, clients, seconds, size):
+        """Runs the clients for seconds, returns (latencies, errors)"""
+        host, port = self.base_url.split("/")[2].split(":")
+        prefix = "/%s/" % self.app_name
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + seconds
+        latencies, errors = [], []
+
+        async def client(k):
+            rng = random.Random(k)
+            connection = Connection(host, int(port), cookies[k % len(cookies)])
+            while loop.time() < deadline:
+                method, path, body = make_request(rng, size)
+                t0 = time.perf_counter()
+                try:
+                    status, _ = await connection.request(method, prefix + path, body)
+                    ok = status == 200
+                except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                    connection.close()
+                    ok = False
+                (latencies if ok else errors).append(time.perf_counter() - t0)
+            connection.close()
+
+        await asyncio.gather(*(client(k) for k in range(clients)))
+        return latencies, errors
+
+    def run_workloads(self, clients, seconds, users, size):
+        """Runs all the workloads of the app, returns their results"""
+        cookies = self.login(users)
+        results = {}
+        for name, make_request in WORKLOADS[self.app_name].items():
+            # every workload starts from the same data
+            self.restore_snapshot(self.snapshot)
+            queries = self.query_count()
+            t0 = time.perf_counter()
+            latencies, errors = asyncio.run(
+                self.drive(make_request, cookies, clients, seconds, size)
+            )
+            elapsed = time.perf_counter() - t0
+            queries = self.query_count() - queries
+            count = len(latencies) + len(errors)
+            results[f"{self.app_name} {name}"] = {
+                "requests": count,
+                "rps": round(len(latencies) / elapsed, 1),
+                "p50_ms": round(1000 * percentile(latencies, 50), 2),
+                "p95_ms": round(1000 * percentile(latencies, 95), 2),
+                "p99_ms": round(1000 * percentile(latencies, 99), 2),
+                "error_rate": round(len(errors) / count, 4) if count else 0.0,
+                "queries_per_request": round(queries / count, 2) if count else 0.0,
+            }
+        return results
+
+
+def benchmark_app(app_name, args, settings=None):
+    """Starts, seeds and benchmarks the app (with settings), returns the results"""
+    benchmark = Benchmark()
+    try:
+        benchmark.start_py4web(
+            os.path.join(APPS_FOLDER, app_name),
+            port=args.port,
+            settings=dict(SETTINGS, **(settings or {})),
+        )
+        benchmark.seed(args.users, args.size)
+        return benchmark.run_workloads(
+            args.clients, args.seconds, args.users, args.size
+        )
+    finally:
+        benchmark.stop_py4web()
+
+
+def compare(report, baseline, tolerance):
+    """Returns the list of regressions of report with respect to baseline"""
+    regressions = []
+    for name, base in baseline["workloads"].items():
+        result = report["workloads"].get(name)
+        if result is None:
+            continue
+        checks = [
+            ("rps", result["rps"] < base["rps"] * (1 - tolerance)),
+            ("p95_ms", result["p95_ms"] > base["p95_ms"] * (1 + tolerance)),
+            ("error_rate", result["error_rate"] > base["error_rate"] + 0.01),
+            (
+                "queries_per_request",
+                result["queries_per_request"]
+                > base["queries_per_request"] * (1 + tolerance),
+            ),
+        ]
+        for key, failed in checks:
+            if failed:
+                regressions.append(
+                    f"{name}: {key} {result[key]} (baseline {base[key]})"
+                )
+    return regressions
+
+
+def compare_concurrency(report):
+    """Returns a line per workload, its rps and p99 next to the unbounded ones"""
+    lines = []
+    suffix = UNBOUNDED[0]
+    for name, base in report["workloads"].items():
+        result = report["workloads"].get(name[: -len(suffix)])
+        if name.endswith(suffix) and result:
+            lines.append(
+                f"{name[: -len(suffix)]}: {result['rps']} rps, p99 {result['p99_ms']} ms"
+                f" (unbounded {base['rps']} rps, p99 {base['p99_ms']} ms)"
+            )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--apps", nargs="+", default=list(WORKLOADS))
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--size", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=8889)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--compare-concurrency", action="store_true")
+    args = parser.parse_args()
+
+    report = {
+        "clients": args.clients,
+        "seconds": args.seconds,
+        "users": args.users,
+        "size": args.size,
+        "workloads": {},
+    }
+    # one process per app, the models of an app register its routes on import
+    variants = [("", None)]
+    if args.compare_concurrency:
+        variants.append(UNBOUNDED)
+    context = multiprocessing.get_context("fork")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        for app_name in args.apps:
+            for suffix, settings in variants:
+                results = pool.apply(benchmark_app, (app_name, args, settings))
+                report["workloads"].update(
+                    (name + suffix, result) for name, result in results.items()
+                )
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as stream:
+            stream.write(output + "\n")
+    if args.compare_concurrency:
+        print("\n".join(compare_concurrency(report)))
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as stream:
+            stream.write(output + "\n")
+    elif args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as stream:
+            regressions = compare(report, json.load(stream), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
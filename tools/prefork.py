@@ -0,0 +1,212 @@
+"""
+Serves the apps from forked workers that share the state loaded by a master
+
+    python tools/prefork.py apps --port 8000 --workers 4
+    python tools/prefork.py apps --app_names fadebook --warm /fadebook/ /fadebook/feed
+
+`py4web run` serves every app from a single process. Here the master loads
+the apps once (the models with their table definitions, the translations
+of T_FOLDER, the precompiled templates), warms them up by serving the --warm
+paths in process (by default the index of every app) so the templates used
+and the caches are filled too, and then forks --workers workers. They share
+all of that with the master, copy-on-write, and accept the connections of
+the same listening socket, each with a Rocket3 server of its own.
+
+Before forking the master closes its db connections and empties the pydal
+pools: a worker opens its own (DB_POOL_SIZE of them per app). The apps
+restart the threads they own in every worker (the log pipeline, the
+metrics flusher, the author fixups, ...) with os.register_at_fork and the
+master freezes its objects (gc.freeze), so the garbage collector of a
+worker never writes to, and copies, the pages it shares.
+
+The master only restarts the workers that die and stops them all on
+SIGTERM or SIGINT. State a worker writes after the fork (sessions in
+memory, caches, buffered likes) is its own: use the db or redis backed
+settings for what must be shared.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import wsgiref.util
+
+from py4web.core import wsgi
+from pydal.base import THREAD_LOCAL
+from pydal.connection import ConnectionPool
+from rocket3 import Rocket3, THREAD_STOP_CHECK_INTERVAL
+
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+############################################################################
+# Convenience functions
+############################################################################
+
+
+def warm_up(app, paths):
+    """Serves GET paths in process, returns their status lines"""
+    statuses = []
+    for path in paths:
+        environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET"}
+        wsgiref.util.setup_testing_defaults(environ)
+        status = []
+        body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+        for _ in body:
+            pass
+        if hasattr(body, "close"):
+            body.close()
+        statuses.append(status[0] if status else "?")
+    return statuses
+
+
+def release_connections():
+    """Closes the db connections of this process, pooled ones included"""
+    for instances in list(getattr(THREAD_LOCAL, "_pydal_db_instances_", {}).values()):
+        for db in list(instances):
+            db._adapter.close(action="commit", really=True)
+    for pool in ConnectionPool.POOLS.values():
+        while pool:
+            try:
+                pool.pop().close()
+            except Exception:
+                pass
+    ConnectionPool.POOLS.clear()
+
+
+def serve(app, sock):
+    """Serves app on the listening socket sock until SIGTERM/SIGINT"""
+    for signum in STOP_SIGNALS:
+        signal.signal(signum, interrupt)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+    host, port = sock.getsockname()[:2]
+    # Rocket3 binds its own sockets, give it an ephemeral port and swap it.
+    # Its signal handlers would call stop() while start() holds the lock
+    # they need (a worker stopped while starting would hang), interrupt it
+    server = Rocket3((host, 0), "wsgi", dict(wsgi_app=app), handle_signals=False)
+    for listener in server.listeners:
+        listener.listener.close()
+        sock.settimeout(THREAD_STOP_CHECK_INTERVAL)
+        listener.listener = sock
+        listener.interface = (host, port)
+        listener.port = port
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        # raised before start() waits, which stops the server itself
+        server.stop()
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+############################################################################
+# Master
+############################################################################
+
+
+class Master:
+    def __init__(self, app, sock, workers):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.pids = {}
+        self.stopping = False
+
+    def spawn(self):
+        # until serve() installs its handlers a worker would run the master's
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(self.app, self.sock)
+            except KeyboardInterrupt:
+                pass
+            # a normal exit, the atexit handlers flush what the worker buffered
+            sys.exit(0)
+        self.pids[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        for signum in STOP_SIGNALS:
+            signal.signal(signum, self.stop)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_on = self.pids.pop(pid, None)
+            if started_on is None or self.stopping:
+                continue
+            print("worker %i exited (%i), restarting it" % (pid, status), flush=True)
+            # do not fork in a loop a worker that cannot start
+            if time.monotonic() - started_on < 1:
+                time.sleep(1)
+            self.spawn()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("apps_folder")
+    parser.add_argument("--app_names", default="", help="comma separated, all by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--warm", nargs="*", help="paths to GET before forking")
+    args = parser.parse_args()
+
+    apps_folder = os.path.abspath(args.apps_folder)
+    kwargs = dict(apps_folder=apps_folder, yes=True)
+    if args.app_names:
+        kwargs["app_names"] = args.app_names
+    app_names = args.app_names.split(",") if args.app_names else sorted(
+        name
+        for name in os.listdir(apps_folder)
+        if os.path.exists(os.path.join(apps_folder, name, "__init__.py"))
+    )
+
+    t0 = time.perf_counter()
+    app = wsgi(**kwargs)
+    paths = args.warm if args.warm is not None else ["/%s/" % name for name in app_names]
+    statuses = warm_up(app, paths)
+    print(
+        "loaded %s in %.2fs, warmed up %s"
+        % (
+            ", ".join(app_names),
+            time.perf_counter() - t0,
+            ", ".join("%s %s" % (p, s.split()[0]) for p, s in zip(paths, statuses)),
+        ),
+        flush=True,
+    )
+
+    release_connections()
+    family = socket.AF_INET6 if ":" in args.host else socket.AF_INET
+    sock = socket.create_server(
+        (args.host, args.port), family=family, backlog=socket.SOMAXCONN
+    )
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # what the master loaded is never collected, keep its pages shared
+    gc.collect()
+    gc.freeze()
+    print(
+        "serving on %s:%i with %i workers" % (args.host, args.port, args.workers),
+        flush=True,
+    )
+    Master(app, sock, args.workers).run()
+
+
+if __name__ == "__main__":
+    main()
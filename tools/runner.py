@@ -0,0 +1,124 @@
+"""
+Runs the test scripts of the apps in parallel and reports their scores
+
+    python tools/runner.py --api
+    python tools/runner.py apps/todo/test_script.py apps/fadebook/test_script.py
+
+Without arguments it runs apps/*/test_script.py. Every script runs in a
+process of its own with --jobs scripts at once (by default one per core).
+Each one starts py4web on its own copy of the app, with an empty databases
+folder and on a free port (Tester.start_py4web), so they do not interfere.
+The steps of a script still run in order, they depend on each other.
+
+The scores, the status and the time of every step are collected from the
+report each script writes (the TESTER_REPORT file, see Tester.run_steps)
+and printed as a table, --output also saves them as JSON.
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def run_script(script, options):
+    """Runs a test script, returns its report"""
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "report.json")
+        env = dict(os.environ, TESTER_REPORT=filename)
+        started_on = time.monotonic()
+        process = subprocess.run(
+            [sys.executable, script] + options,
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        seconds = round(time.monotonic() - started_on, 3)
+        report = {"app": os.path.basename(os.path.dirname(script)), "steps": []}
+        if os.path.exists(filename):
+            with open(filename) as stream:
+                report.update(json.load(stream))
+        report.update(
+            script=os.path.relpath(script, ROOT),
+            returncode=process.returncode,
+            # includes starting the server, not in the time of the steps
+            seconds=seconds,
+            output=process.stdout.decode(errors="replace"),
+        )
+        # a script that crashed before reporting (e.g. the app does not load)
+        report.setdefault("score", 0)
+        report["failed"] = report.get("failed", True) or process.returncode != 0
+        return report
+
+
+def print_report(reports, seconds):
+    print("=" * 80)
+    for report in reports:
+        status = "FAILED" if report["failed"] else "PASS"
+        print(
+            f"{report['app']:20} {status:8} score {report['score']:6.1f}"
+            f" {report['seconds']:8.2f}s"
+        )
+        for step in report["steps"]:
+            print(
+                f"    {step['name']:16} {step['status']:8}"
+                f" score {step.get('score', 0):6.1f} {step.get('seconds', 0):8.2f}s"
+            )
+    print("=" * 80)
+    print(
+        f"TOTAL SCORE = {sum(report['score'] for report in reports)}"
+        f" in {seconds:.2f}s"
+    )
+    print("=" * 80)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("scripts", nargs="*")
+    parser.add_argument("--api", action="store_true", help="without a browser")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    scripts = args.scripts or sorted(
+        glob.glob(os.path.join(ROOT, "apps", "*", "test_script.py"))
+    )
+    scripts = [os.path.abspath(script) for script in scripts]
+    options = ["--api"] if args.api else []
+    started_on = time.monotonic()
+    # threads are enough, each of them waits for a process
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        reports = list(executor.map(lambda s: run_script(s, options), scripts))
+    seconds = time.monotonic() - started_on
+
+    for report in reports:
+        if report["failed"]:
+            print(report["output"])
+    print_report(reports, seconds)
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(
+                {
+                    "seconds": round(seconds, 3),
+                    "score": sum(report["score"] for report in reports),
+                    "scripts": [
+                        {k: v for k, v in report.items() if k != "output"}
+                        for report in reports
+                    ],
+                },
+                stream,
+                indent=2,
+            )
+    if any(report["failed"] for report in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import argparse
+import atexit
+import hashlib
 import io
+import json
 import os
 import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
@@ -13,12 +18,16 @@ from importlib.machinery import SourceFileLoader
 if __name__ != "__main__":
     import py4web
     import requests
-    import selenium
-    from bs4 import BeautifulSoup as Soup
-    from selenium import webdriver
-    from selenium.webdriver.chrome.service import Service
-    from selenium.webdriver.common.by import By
-    from selenium.webdriver.common.keys import Keys
+    from http.cookiejar import DefaultCookiePolicy
+    from requests.adapters import HTTPAdapter
+
+# selenium is imported by make_chrome_driver, only if a browser is needed
+
+# the servers started with start_py4web(reuse=True), by app and settings
+SERVERS = {}
+
+# the seeded databases saved by Tester.seed_db, reused across runs
+SNAPSHOTS_FOLDER = os.path.join(tempfile.gettempdir(), "py4web_snapshots")
 
 
 # The rest of the code except "dockerize" is intended to run in this image
@@ -63,6 +72,9 @@ def run(cmd):
 
 
 def make_chrome_driver(headless=False):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+
     options = webdriver.ChromeOptions()
     service = Service("/usr/lib/chromium/chromedriver")
     options.binary_location = "/usr/lib/chromium/chromium"
@@ -86,6 +98,101 @@ def make_chrome_driver(headless=False):
     return webdriver.Chrome(options=options, service=service)
 
 
+def free_port():
+    """A TCP port nobody listens on, for a server of this test run"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def copy_app(source_apps, dest_apps, app_name):
+    """
+    Copies the app (without its databases), apps/__init__.py and the
+    modules of apps/shared the apps import, as hard links where possible:
+    files are only read by the server and the tester only creates new ones
+    (settings_private.py is removed before writing)
+    """
+
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    os.makedirs(dest_apps)
+    init = os.path.join(source_apps, "__init__.py")
+    if os.path.exists(init):
+        link_or_copy(init, os.path.join(dest_apps, "__init__.py"))
+    for name in (app_name, "shared"):
+        if os.path.isdir(os.path.join(source_apps, name)):
+            shutil.copytree(
+                os.path.join(source_apps, name),
+                os.path.join(dest_apps, name),
+                ignore=shutil.ignore_patterns("databases", "__pycache__"),
+                copy_function=link_or_copy,
+            )
+    # an empty one, not every app creates it
+    os.mkdir(os.path.join(dest_apps, app_name, "databases"))
+
+
+def read_lines(stream, lines):
+    """Appends the lines of stream to lines, until it is closed"""
+    for line in stream:
+        lines.append(line.decode(errors="replace").rstrip())
+
+
+def app_fingerprint(path):
+    """A hash of the python files of the app, the schema is defined there"""
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(path)):
+        dirs[:] = sorted(d for d in dirs if d not in ("databases", "__pycache__"))
+        for name in sorted(files):
+            if name.endswith(".py"):
+                filename = os.path.join(root, name)
+                digest.update(os.path.relpath(filename, path).encode())
+                with open(filename, "rb") as stream:
+                    digest.update(stream.read())
+    return digest.hexdigest()[:16]
+
+
+def copy_sqlite(source, dest):
+    """Copies the database file source into dest with the online backup API"""
+    src, dst = sqlite3.connect(source), sqlite3.connect(dest, timeout=30)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+
+
+def stop_servers():
+    """Stops the servers kept for reuse"""
+    for server in SERVERS.values():
+        server["server"].kill()
+        server["server"].wait()
+        shutil.rmtree(os.path.dirname(server["dest_apps"]), ignore_errors=True)
+    SERVERS.clear()
+
+
+def make_http_session(pool_size=4):
+    """
+    A requests session that keeps its connections alive. It does not store
+    cookies, they are passed explicitly to each request (so a test can
+    still make an anonymous request after logging in)
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    return session
+
+
+def needs_browser(func):
+    """Marks a step that is skipped when the tester has no browser"""
+    func.needs_browser = True
+    return func
+
+
 def find_repo_root(path):
     path = os.path.abspath(path)
     root = path
@@ -108,33 +215,54 @@ class StopTester(Exception):
 
 
 class Tester:
-    def __init__(self, headless=True, post_grade=None):
-        """Creates a tester instance"""
+    def __init__(self, headless=True, post_grade=None, browser=True):
+        """Creates a tester instance, without a browser only the API can be tested"""
         self._notifications = []
-        self.browser = make_chrome_driver(headless)
+        self.browser = make_chrome_driver(headless) if browser else None
+        self.http = make_http_session()
         # the vars below are defined when py4web starts
         self.base_url = None
         self.app_as_module = None
         self.dest_apps = None
         self.post_grade = {}
 
-    def start_py4web(self, path, port=8888, expect_db=True):
-        """Starts py4web server and returns the base URL for the app"""
-        source_apps, app_name = os.path.split(path)
+    def start_py4web(
+        self, path, port=None, expect_db=True, settings=None, reuse=False, timeout=60
+    ):
+        """
+        Starts py4web server and returns the base URL for the app,
+        settings (a dict) are written to settings_private.py of the copy.
+        Without a port it picks a free one, so several tests can run at once.
+        With reuse a server already started by this process for the same app
+        and settings is used again, after emptying its database (reset_db)
+        """
+        source_apps, app_name = os.path.split(os.path.abspath(path))
+        key = (source_apps, app_name, repr(sorted((settings or {}).items())))
+        if reuse and key in SERVERS:
+            print("Reusing the server")
+            self.__dict__.update(SERVERS[key])
+            self.reset_db()
+            return self.base_url
+        port = port or free_port()
         print("Starting the server")
         self.app_name = app_name
         self.dest_apps = os.path.join(tempfile.mkdtemp(), "apps")
         url = f"http://127.0.0.1:{port}/{app_name}/"
-        shutil.rmtree(self.dest_apps, ignore_errors=True)
-        if not os.path.exists(source_apps):
-            print(f"{source_apps} does not exist!")
+        if not os.path.exists(os.path.join(source_apps, app_name)):
+            print(f"{os.path.join(source_apps, app_name)} does not exist!")
             self.stop()
-        run(f"cp -r {source_apps} {self.dest_apps}")
-        subprocess.run(
-            ["rm", "-rf", os.path.join(self.dest_apps, app_name, "databases")]
-        )
+        copy_app(source_apps, self.dest_apps, app_name)
+        if settings:
+            filename = os.path.join(self.dest_apps, app_name, "settings_private.py")
+            # a link to the one of the source app, do not write through it
+            if os.path.exists(filename):
+                os.remove(filename)
+            with open(filename, "w") as stream:
+                for key_, value in settings.items():
+                    stream.write(f"{key_} = {value!r}\n")
         self.server = None
-        cmd = f"py4web run {self.dest_apps} --port={port} --app_names={app_name}"
+        # exec, so that stop_py4web kills the server and not just the shell
+        cmd = f"exec py4web run {self.dest_apps} --port={port} --app_names={app_name}"
         print("Running:", cmd)
         try:
             self.server = subprocess.Popen(
@@ -147,22 +275,39 @@ class Tester:
         except Exception:
             print("Unable to start py4web")
             self.stop()
-        started = False
-        while True:
-            self.server.stdout.flush()
-            line = self.server.stdout.readline().decode().rstrip()
-            print(line)
-            if "[X]" in line:
-                started = True
-            if "127.0.0.1:" in line:
-                break
+        # keep reading the log, else the server blocks once the pipe is full
+        self.server_log = []
+        threading.Thread(
+            target=read_lines, args=(self.server.stdout, self.server_log), daemon=True
+        ).start()
+        ready = self.wait_until_ready(url, timeout)
+        # apps are loaded before the server listens, wait for the reader
+        started = ready and self.wait_for(
+            lambda: any("[X]" in line for line in self.server_log), timeout=5
+        )
+        print("\n".join(self.server_log))
+        if not ready:
+            print(f"The server did not answer within {timeout} seconds")
+            self.stop()
         if not started:
             print("The app has errors and was unable to start it")
             self.stop()
-        sys.path.append(self.dest_apps)
+        # imported as apps.<app>, the way py4web loads it, so that the
+        # relative imports of apps/shared resolve. A copy started before by
+        # this process (e.g. with other settings) was imported as apps too,
+        # this one takes its place (its modules stay with its tester)
+        for name in [name for name in sys.modules if name.split(".")[0] == "apps"]:
+            del sys.modules[name]
+        # with the routes it registered
+        py4web.core.Reloader.clear_routes()
+        sys.path.insert(0, os.path.dirname(self.dest_apps))
         env = {}
         py4web.Session.SECRET = "304c7585-5b74-469f-85ad-e32c5646258d"
-        exec("import tagged_posts.models as app_as_module", env)
+        if os.path.exists(os.path.join(self.dest_apps, app_name, "models.py")):
+            exec(f"import apps.{app_name}.models as app_as_module", env)
+        else:
+            # the app defines its tables and actions in __init__.py (e.g. todo)
+            exec(f"import apps.{app_name} as app_as_module", env)
         self.app_as_module = env.get("app_as_module")
         assert self.app_as_module
         if expect_db:
@@ -170,29 +315,110 @@ class Tester:
                 self.app_as_module, "db"
             ), "no db defined models.py"
         self.base_url = url
+        self.reused = reuse
+        if reuse:
+            SERVERS[key] = {
+                name: getattr(self, name)
+                for name in (
+                    "app_name",
+                    "dest_apps",
+                    "server",
+                    "server_log",
+                    "app_as_module",
+                    "base_url",
+                    "reused",
+                )
+            }
         return url
 
+    def wait_until_ready(self, url, timeout=60, delay=0.05, max_delay=1.0):
+        """Polls url with an increasing delay until the server answers"""
+        deadline = time.monotonic() + timeout
+        while self.server.poll() is None:
+            try:
+                self.http.get(url, timeout=max_delay, allow_redirects=False)
+                return True
+            except requests.RequestException:
+                pass
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, max_delay)
+        return False
+
+    def reset_db(self):
+        """Empties all the tables of the app, the server keeps running"""
+        db = self.app_as_module.db
+        # the referencing tables first
+        for tablename in reversed(db.tables):
+            db[tablename].truncate()
+        db.commit()
+
+    def db_path(self):
+        """The file of the sqlite database of the app"""
+        db = self.app_as_module.db
+        db = getattr(db, "primary", db)
+        assert db._dbname == "sqlite", "snapshots need an sqlite database"
+        return db._adapter.dbpath
+
+    def save_snapshot(self, filename):
+        """Saves a copy of the database of the app to filename"""
+        self.app_as_module.db.commit()
+        # to a temporary file first, then renamed, a reader never sees half of it
+        copy_sqlite(self.db_path(), filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+
+    def restore_snapshot(self, filename):
+        """
+        Replaces the content of the database of the app with the one saved
+        in filename. It is copied into the database (not over its file), so
+        the connections the server holds see the restored content
+        """
+        self.app_as_module.db.commit()
+        copy_sqlite(filename, self.db_path())
+
+    def seed_db(self, seed, name="seed"):
+        """
+        Fills the database of the app with seed(db), unless a snapshot of
+        the result is already saved (for this name and this version of the
+        app), then it is restored instead. Returns the snapshot filename,
+        pass it to restore_snapshot() to go back to the seeded state
+        """
+        source = os.path.join(self.dest_apps, self.app_name)
+        filename = os.path.join(
+            SNAPSHOTS_FOLDER, f"{self.app_name}-{name}-{app_fingerprint(source)}.db"
+        )
+        if os.path.exists(filename):
+            print(f"Restoring {filename}")
+            self.restore_snapshot(filename)
+        else:
+            print(f"Seeding the database, saved as {filename}")
+            self.reset_db()
+            seed(self.app_as_module.db)
+            os.makedirs(SNAPSHOTS_FOLDER, exist_ok=True)
+            self.save_snapshot(filename)
+        return filename
+
     def stop_py4web(self):
-        """Stops the py4web server"""
-        if getattr(self, "server", None):
+        """Stops the py4web server (a reused one only when the process exits)"""
+        if getattr(self, "server", None) and not getattr(self, "reused", False):
             self.server.kill()
-            self.server = None
-            shutil.rmtree(self.dest_apps)
+            self.server.wait()
+            shutil.rmtree(os.path.dirname(self.dest_apps))
+        self.server = None
 
     def __del__(self):
         self.stop_py4web()
 
     def fetch(self, method, url, body={}, cookies=None):
-        """Uses mechanize to fetch a page"""
+        """Uses requests to fetch a page, on a kept alive connection"""
         print(f"Trying {method} {body or ''} to {url} ...")
-        if method == "GET":
-            response = requests.get(url, allow_redirects=True, cookies=cookies)
-        if method == "PUT":
-            response = requests.put(url, json=body, cookies=cookies)
-        if method == "POST":
-            response = requests.post(url, json=body, cookies=cookies)
-        if method == "DELETE":
-            response = requests.delete(url, cookies=cookies)
+        # no empty body, an action that does not read it would leave it on the
+        # kept alive connection, where it would be parsed as the next request
+        if method in ("PUT", "POST") and body:
+            response = self.http.request(method, url, json=body, cookies=cookies)
+        else:
+            response = self.http.request(method, url, cookies=cookies)
         assert (
             response.status_code == 200
         ), f"Expected 200 OK but received {response.status_code}"
@@ -208,10 +434,33 @@ class Tester:
         return json
 
     def open(self, url):
-        """Uses selenium to open a page"""
-        self.browser.get(url)
+        """Uses selenium to open a page, waits until it is loaded"""
         self.browser.implicitly_wait(10)
-        time.sleep(4)
+        self.browser.get(url)
+        self.wait_for(
+            lambda: self.browser.execute_script("return document.readyState")
+            == "complete"
+        )
+
+    def wait_for(self, condition, timeout=10, interval=0.1):
+        """Waits until condition() is true, returns its value or False on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            value = condition()
+            if value or time.monotonic() > deadline:
+                return value
+            time.sleep(interval)
+
+    def wait_for_all(self, selector, count, timeout=10):
+        """Waits until the page has count elements matching selector, returns them"""
+        elements = []
+
+        def found():
+            elements[:] = self.browser.find_elements("css selector", selector)
+            return len(elements) == count
+
+        self.wait_for(found, timeout)
+        return elements
 
     def create_user(self, user={}):
         """Assume py4web login and register"""
@@ -237,6 +486,17 @@ class Tester:
         password.send_keys(user["password"])
         submit.click()
 
+    def auth_api_sign_in(self, user={}):
+        """Signs in with py4web's auth/api/login, returns the session cookies"""
+        print(f"Signing in as {user['username']} ...")
+        response = self.http.post(
+            self.base_url + "auth/api/login",
+            json=dict(email=user["username"], password=user["password"]),
+        )
+        assert response.status_code == 200, "unable to login"
+        assert response.cookies, "server cookies not working"
+        return response.cookies.get_dict()
+
     def auth_logout(self):
         """Assume p[y4web login and logout"""
         pass
@@ -247,7 +507,7 @@ class Tester:
         proxy for selenium's find_elements(By.CSS_SELECTOR, selector)
         """
         print(f'Looking for "{selector}" in page')
-        return self.browser.find_elements(By.CSS_SELECTOR, selector)
+        return self.browser.find_elements("css selector", selector)
 
     def find_first(self, selector):
         """Uses selenium to find the selection in the page (first only)"""
@@ -279,6 +539,8 @@ class Tester:
         self._stopped = False
         self._output = ""
         self._stdout = sys.stdout
+        report = {"app": self.app_name, "steps": []}
+        started_on = time.monotonic()
         steps = [name for name in dir(obj) if name.startswith("step_")]
         steps.sort(key=lambda name: int(name[5:]))
         for step in steps:
@@ -286,19 +548,27 @@ class Tester:
             func = getattr(obj, step)
             self.write(f"{step.title()}: {func.__doc__}")
             self.write("-" * 80)
+            if self.browser is None and getattr(func, "needs_browser", False):
+                self.write("SKIPPED (no browser)")
+                report["steps"].append(dict(name=step, status="skipped"))
+                continue
+            score, failed = self._score, False
+            step_started_on = time.monotonic()
             sys.stdout = io.StringIO()
             try:
                 func()
             except StopTester:
-                self._failed = True
+                failed = True
                 self._stopped = True
             except AssertionError as err:
+                failed = True
                 print("AssertionError:", err)
             except Exception:
-                self._failed = True
+                failed = True
                 print(traceback.format_exc())
             finally:
-                if self._failed:
+                self._failed = self._failed or failed
+                if failed:
                     self.write(sys.stdout.getvalue())
                     self.write(f"FAILED")
                     if self._stopped:
@@ -306,10 +576,27 @@ class Tester:
                 else:
                     self.write(f"PASS")
             sys.stdout = self._stdout
+            report["steps"].append(
+                dict(
+                    name=step,
+                    status="failed" if failed else "pass",
+                    score=self._score - score,
+                    seconds=round(time.monotonic() - step_started_on, 3),
+                )
+            )
         self.write("\n" + "=" * 80)
         self.write(f"TOTAL SCORE = {self._score}")
         self.write("=" * 80)
         print(self._output)
+        # the runner (tools/runner.py) collects the reports of the scripts
+        if os.environ.get("TESTER_REPORT"):
+            report.update(
+                score=self._score,
+                failed=self._failed,
+                seconds=round(time.monotonic() - started_on, 3),
+            )
+            with open(os.environ["TESTER_REPORT"], "w") as stream:
+                json.dump(report, stream)
         if self.post_grade:
             subprocess.run(
                 [
@@ -378,5 +665,7 @@ def dockerize(path, args=[]):
         )
 
 
+atexit.register(stop_servers)
+
 if __name__ == "__main__":
     dockerize(sys.argv[1], sys.argv[2:])